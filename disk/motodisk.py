@@ -8,10 +8,23 @@ from time import sleep
 import sys
 import os
 import argparse
+import collections
+import errno
+import fnmatch
+import json
+import select
+import signal
 
 import serial
 
 import packets
+import versionstore
+
+# the flight recorder and job checker are shared with the remote/ tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'remote'))
+import flightrecorder
+import jobcheck
 
 
 def log(message):
@@ -21,9 +34,14 @@ def log(message):
     return message
 
 
-def warn(message, force=False):
-    """ Print the given message to stderr, flush stderr """
-    if DEBUG or force:
+def warn(message, *args, **kwargs):
+    """
+    Print the given message to stderr, flush stderr. If args are given, the
+    message is a format string that is only formatted when it is printed
+    """
+    if DEBUG or kwargs.get("force", False):
+        if args:
+            message = message.format(*args)
         sys.stderr.write(message + "\n")
         sys.stderr.flush()
     return message
@@ -59,185 +77,414 @@ def namefix(filename, filedata):
     return "\r\n".join(result) + "\r\n"
 
 
-class SoftFC1(object):
-    """ Emulate the FC1 disk controller """
-    com = None
-    input_packets = None
+class DirectoryStorage(object):
+    """
+    Files kept as they are in a directory. Saves over an existing file are
+    renamed unless overwriting is allowed. The directory is only listed
+    again when it changes
+    """
+    directory = "."
     filelist = None
-    overwrite = False
+    _listing = None  # (directory mtime, filenames)
 
-    def __init__(self, filelist=None, overwrite=False, baudrate=4800, port='/dev/ttyS0'):
-        self.com = serial.Serial(port, baudrate,
-                                 parity=serial.PARITY_EVEN, timeout=None)
-        sleep(1)  # wait for the port to be ready (an arbitrary period)
-        log("opened serial port")
-        self.input_packets = self.input_packet_streamer()  # NOTE: generator
+    def __init__(self, directory=".", filelist=None):
+        self.directory = directory
         self.filelist = filelist
+
+    def path(self, filename):
+        """ Return the path of the named file """
+        return os.path.join(self.directory, filename)
+
+    def available(self, filename):
+        """ Return True if the named file exists and may be served """
+        if self.filelist:
+            return filename in self.filelist and \
+                os.path.isfile(self.path(filename))
+        return os.path.basename(filename) == filename and \
+            os.path.isfile(self.path(filename))
+
+    def names(self):
+        """ Return the names of the files that can be served """
+        if self.filelist:
+            return [filename for filename in self.filelist
+                    if os.path.exists(self.path(filename))]
+        mtime = os.stat(self.directory).st_mtime
+        if self._listing is None or self._listing[0] != mtime:
+            self._listing = (mtime, sorted(
+                filename for filename in os.listdir(self.directory)
+                if filename.endswith(".JBI") and 4 < len(filename) < 17))
+        return self._listing[1]
+
+    def version(self, filename):
+        """ Return a value that changes whenever the named file does """
+        stat = os.stat(self.path(filename))
+        return (stat.st_mtime, stat.st_size)
+
+    def read(self, filename):
+        """ Return the content of the named file """
+        with open(self.path(filename)) as inputfh:
+            return inputfh.read()
+
+    def save(self, filename, filedata, overwrite=False, port=None):
+        """
+        Store a file written by a robot, return the name it was stored under.
+        Unless overwrite is set, an existing TEST.JBI is kept and the new
+        file becomes TEST-1.JBI (or TEST-2.JBI, and so on)
+        """
+        if not overwrite and os.path.exists(self.path(filename)):
+            (root, extension) = os.path.splitext(filename)
+            rename_counter = 1
+            original_filename = filename
+            while os.path.exists(self.path(filename)):
+                filename = "{}-{}{}".format(root, rename_counter, extension)
+                rename_counter += 1
+            warn("Renaming {} to {}", original_filename, filename)
+        with open(self.path(filename), "w") as outputfh:
+            outputfh.write(filedata)
+        return filename
+
+
+class FileIndex(object):
+    """
+    The files served to the robots, shared by every port and kept by a
+    storage backend: a DirectoryStorage, or a versionstore.VersionStore.
+    The encoded FSZ/FRD packets of a file are kept until the file changes,
+    so a job loaded by several robots is read, checked and framed once
+    """
+    storage = None
+    check_jobs = True  # refuse to serve jobs that jobcheck finds faults in
+    _frames = None  # filename -> (version, encoded packets or None)
+
+    def __init__(self, directory=".", filelist=None, storage=None):
+        self.storage = storage or DirectoryStorage(directory, filelist)
+        self._frames = dict()
+
+    def available(self, filename):
+        """ Return True if the named file exists and may be served """
+        return self.storage.available(filename)
+
+    def names(self):
+        """ Return the names of the files that can be served """
+        return self.storage.names()
+
+    def frames(self, filename):
+        """
+        Return the encoded FSZ and FRD packets that send the named file, or
+        None if it is a job with faults the robot would reject it for
+        """
+        version = self.storage.version(filename)
+        cached = self._frames.get(filename)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        # autocorrect any filename/jobname discontinuity
+        filedata = namefix(filename, self.storage.read(filename))
+        frames = None
+        if not (self.check_jobs and refuse_bad_job(filename, filedata)):
+            # the file goes in 255 byte blocks
+            frames = [packets.encode("FSZ{:08}".format(len(filedata)))] + [
+                packets.encode("FRD" + chunk)
+                for chunk in chunks(filedata, 255)]
+        self._frames[filename] = (version, frames)
+        return frames
+
+    def save(self, filename, filedata, overwrite=False, port=None):
+        """ Store a file written by the robot on the given port """
+        return self.storage.save(filename, filedata, overwrite, port)
+
+
+def refuse_bad_job(filename, filedata):
+    """
+    Check a job before serving it. If it has faults the ERC would reject it
+    for, log them and return True
+    """
+    if not jobcheck.is_job(filename):
+        return False
+    problems = jobcheck.check(filedata, os.path.splitext(filename)[0])
+    for problem in problems:
+        log("{}: {}".format(filename, jobcheck.describe(problem)))
+    problems = jobcheck.faults(problems)
+    if problems:
+        log("Refusing to send {}, the robot would reject it".format(filename))
+    return bool(problems)
+
+
+class PortPolicy(object):
+    """ What the robot on one port may do """
+    patterns = ("*",)  # the files it can see and load
+    overwrite = False  # whether its saves replace existing files
+
+    def __init__(self, patterns=None, overwrite=False):
+        if patterns:
+            self.patterns = tuple(patterns)
         self.overwrite = overwrite
 
+    def visible(self, filename):
+        """ Return True if the robot may see and load the named file """
+        return any(fnmatch.fnmatch(filename, pattern)
+                   for pattern in self.patterns)
+
+
+class PortStats(object):
+    """ Counters of the traffic on one port """
+    FIELDS = ("bytes_in", "bytes_out", "packets_in", "files_sent",
+              "files_saved", "refused", "retries", "bad_packets", "resets")
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def __str__(self):
+        return ", ".join("{} {}".format(field.replace("_", " "),
+                                        getattr(self, field))
+                         for field in self.FIELDS)
+
+
+class SoftFC1(object):
+    """
+    Emulate the FC1 disk controller on one serial port. The FC1 protocol is
+    run as a state machine that is fed whatever bytes have arrived, so one
+    select() loop (see serve()) can drive any number of ports
+    """
+    com = None
+    port = None
+    index = None
+    policy = None
+    stats = None
+    parse_buffer = ""
+    state = "idle"  # "idle", "sending" (awaiting ACKs) or "receiving" (FWT)
+    outbox = None  # encoded packets to send, each once the last is ACKed
+    trailer = None  # the encoded packet sent unconfirmed after the outbox
+    limit = 10  # failed confirmations before a transfer is abandoned
+    failures = 0
+    incoming = None  # (filename, list of data) of the file being written
+
+    def __init__(self, filelist=None, overwrite=False, baudrate=4800,
+                 port='/dev/ttyS0', index=None, policy=None):
+        self.com = serial.Serial(port, baudrate,
+                                 parity=serial.PARITY_EVEN, timeout=0)
+        sleep(1)  # wait for the port to be ready (an arbitrary period)
+        log("opened serial port {}".format(port))
+        self.port = port
+        self.index = index or FileIndex(filelist=filelist)
+        self.policy = policy or PortPolicy(overwrite=overwrite)
+        self.stats = PortStats()
+        self.outbox = collections.deque()
+        flightrecorder.RECORDER.install()
+
+    def fileno(self):
+        """ The serial port's file descriptor, for select() """
+        return self.com.fileno()
+
     def raw_read(self):
-        """ Return the contents of incoming raw data on the serial port """
-        input_buffer = []
-        while not self.com.inWaiting():
-            sleep(0.05)
-        while self.com.inWaiting():
-            input_buffer.append(self.com.read(size=self.com.inWaiting()))
-            sleep(0.005)
-        result = "".join(input_buffer)
-        warn("raw_read {} bytes: {}".format(len(result), result.__repr__()))
+        """ Return the raw data waiting on the serial port """
+        result = self.com.read(self.com.inWaiting() or 1)
+        self.stats.bytes_in += len(result)
+        flightrecorder.record(flightrecorder.READ, result)
+        warn("{} raw_read {} bytes: {!r}", self.port, len(result), result)
         return result
 
     def raw_write(self, message):
         """ Send raw data on the serial port """
         self.com.write(message)
-        warn("raw_write {} bytes: {}".format(len(message),
-                                             message.__repr__()))
+        self.stats.bytes_out += len(message)
+        flightrecorder.record(flightrecorder.WRITE, message)
+        warn("{} raw_write {} bytes: {!r}", self.port, len(message), message)
 
     def write(self, message):
         """ encode and send the given message to the serial port """
         self.raw_write(packets.encode(message))
 
-    def confirmed_write(self, message, limit=10):
-        """ send a message, repeating as needed until we get an ack """
-        message_received = False
-        while not message_received:
-            self.write(message)
-            packet = next(self.input_packets)
-            if packet == "ACK":
-                message_received = True
-                break
-            elif packet == "CAN":
-                raise IOError(warn("ERC sent CANcel during confirmed write"))
-            else:
-                limit -= 1
-            if limit < 1:
-                raise RuntimeError(warn("Can't to confirm write of {}".format(
-                    message.__repr__())))
-        warn("Confirmed write of {}".format(message))
-        return True
-
-    def input_packet_streamer(self):
+    def confirmed_write(self, frames, trailer="EOF"):
         """
-        Generator which returns a parsed packet from the buffer, getting more
-        data as necessary to complete the packet
+        Start sending the given encoded packets, each one once the last is
+        acknowledged (and repeated until it is), then the trailer message
         """
-        parse_buffer = []
-        while True:
-            if len(parse_buffer) < 6:
-                parse_buffer.extend(self.raw_read())
-
+        self.outbox.extend(frames)
+        self.trailer = packets.encode(trailer)
+        self.failures = 0
+        self.state = "sending"
+        self.raw_write(self.outbox[0])
+
+    def on_readable(self):
+        """ Read what has arrived, feed each complete packet to the protocol """
+        self.parse_buffer += self.raw_read()
+        while self.parse_buffer:
             try:
-                (data, bytes_consumed) = packets.decode("".join(parse_buffer))
-                parse_buffer = parse_buffer[bytes_consumed:]
-                yield data
+                (packet, bytes_consumed) = packets.decode(self.parse_buffer)
             except packets.InvalidPacketHeader:
                 # slide out a byte of unusable data
-                parse_buffer.pop(0)
+                self.parse_buffer = self.parse_buffer[1:]
+                continue
             except packets.NeedMoreInput:
-                # get some more data from the serial
-                parse_buffer.extend(self.raw_read())
+                break
+            except ValueError as error:
+                warn("{} {}", self.port, error)
+                self.stats.bad_packets += 1
+                self.parse_buffer = self.parse_buffer[1:]
+                continue
+            self.parse_buffer = self.parse_buffer[bytes_consumed:]
+            self.stats.packets_in += 1
+            try:
+                self.handle(packet)
+            except IOError:
+                self.reset()
+
+    def reset(self):
+        """ Abandon the current transfer after a CANcel """
+        self.stats.resets += 1
+        self.state = "idle"
+        self.outbox.clear()
+        self.incoming = None
+        flightrecorder.record(flightrecorder.NOTE, "CAN reset " + self.port)
+        log("{}: resetting on CANcel, flight recorder dumped to {}".format(
+            self.port, flightrecorder.RECORDER.dump()))
+        self.write("ACK")
+
+    def handle(self, packet):
+        """ Advance the protocol state machine by one incoming packet """
+        if packet == 'CAN':
+            raise IOError(warn("Received general CANcel packet"))
+        if self.state == "sending":
+            self.handle_confirmation(packet)
+        elif self.state == "receiving":
+            self.handle_file_write(packet)
+        else:
+            self.handle_request(packet)
+
+    def handle_confirmation(self, packet):
+        """ While sending: move on after an ACK, otherwise resend """
+        if packet == "ACK":
+            warn("Confirmed write of {!r}", self.outbox[0])
+            self.outbox.popleft()
+            if self.outbox:
+                self.raw_write(self.outbox[0])
+                return
+            self.raw_write(self.trailer)
+            self.state = "idle"
+            return
+
+        self.failures += 1
+        self.stats.retries += 1
+        if self.failures >= self.limit:
+            log("{}: can't confirm write of {!r}, abandoning it".format(
+                self.port, self.outbox[0]))
+            self.outbox.clear()
+            self.state = "idle"
+            return
+        self.raw_write(self.outbox[0])
+
+    def handle_file_write(self, packet):
+        """ While receiving a file: store FWT data until EOF """
+        if packet.startswith("FWT"):
+            self.incoming[1].append(packet[3:])
+            self.write("ACK")
+            return
+        if packet == "EOF":
+            self.write("ACK")
+            (filename, data) = self.incoming
+            self.incoming = None
+            self.state = "idle"
+            saved = self.index.save(filename, "".join(data),
+                                    self.policy.overwrite, self.port)
+            self.stats.files_saved += 1
+            log("{}: saved {}".format(self.port, saved))
+            return
+        warn("Unexpected packet during write: {}", packet)
+
+    def handle_request(self, packet):
+        """ While idle: answer the robot's requests """
+        if packet == 'ENQ':
+            warn("Responding to ENQuiry packet")
+            self.write('ACK')
+            return
+
+        if packet == 'EOT':
+            warn("Received EndOfTransmission packet")
+            return
+
+        if packet == 'ACK':
+            warn("Received unexpected ACKnowledge packet")
+            return
+
+        if packet == 'LST':
+            warn("Responding to LiST packet")
+            job_files = ["{:12}".format(filename) for filename
+                         in self.index.names() if self.policy.visible(filename)]
+            self.confirmed_write([packets.encode("LST{:04}{}".format(
+                len(job_files), "".join(job_files)))])
+            return
+
+        if packet == 'DSZ':
+            warn("Responding to DiskSiZe packet")
+            self.confirmed_write([packets.encode("DSZ00729088")])
+            return
+
+        if packet.startswith('FRD'):
+            warn("Responding to FileReaD packet")
+            filename = packet[3:].rstrip()
+            frames = None
+            if not (self.index.available(filename) and
+                    self.policy.visible(filename)):
+                log("{}: {} is not available to this robot".format(
+                    self.port, filename))
+            else:
+                frames = self.index.frames(filename)
+            if frames is None:
+                self.stats.refused += 1
+                self.write("CAN")
+                return
+            self.stats.files_sent += 1
+            self.confirmed_write(frames)
+            return
+
+        if packet.startswith('FWT'):
+            warn("Responding to FileWriTe packet")
+            self.incoming = (packet[3:].rstrip(), [])
+            self.state = "receiving"
+            self.write("ACK")
+            return
+
+        warn("Unhandled packet: {}", packet)
 
     def emulate(self):
         """ Loop, responding to serial requests as needed """
+        serve([self])
 
-        while True:
-            try:
-                packet = next(self.input_packets)
-
-                if packet == 'ENQ':
-                    warn("Responding to ENQuiry packet")
-                    self.write('ACK')
-                    continue
-
-                if packet == 'EOT':
-                    warn("Received EndOfTransmission packet")
-                    continue
-
-                if packet == 'CAN':
-                    raise IOError(warn("Received general CANcel packet"))
-
-                if packet == 'ACK':
-                    warn("Received unexpected ACKnowledge packet")
-                    continue
-
-                if packet == 'LST':
-                    warn("Responding to LiST packet")
-
-                    if self.filelist:
-                        job_files = ["{:12}".format(filename) for filename
-                                     in self.filelist
-                                     if os.path.exists(filename)]
-                    else:
-                        job_files = ["{:12}".format(filename) for filename
-                                     in os.listdir('.')
-                                     if filename.endswith(".JBI") and
-                                     4 < len(filename) < 17]
-
-                    self.confirmed_write("LST{:04}{}".format(
-                        len(job_files), "".join(job_files)))
-                    self.write("EOF")
-                    continue
-
-                if packet == 'DSZ':
-                    warn("Responding to DiskSiZe packet")
-                    self.confirmed_write("DSZ00729088")
-                    self.write("EOF")
-                    continue
-
-                if packet.startswith('FRD'):
-                    warn("Responding to FileReaD packet")
-                    filename = packet[3:].rstrip()
-                    if self.filelist and filename not in self.filelist:
-                        raise RuntimeError(warn(
-                            "The requested filename does not appear on the "
-                            "command line", force=True))
-                    with open(filename) as inputfh:
-                        # autocorrect any filename/jobname discontinuity
-                        filedata = namefix(filename, inputfh.read())
-
-                    self.confirmed_write("FSZ{:08}".format(len(filedata)))
-                    # send the file in 255 byte blocks, retrying as necessary
-                    for chunk in chunks(filedata, 255):
-                        self.confirmed_write("FRD" + chunk)
-                    self.write("EOF")
-                    continue
-
-                if packet.startswith('FWT'):
-                    warn("Responding to FileWriTe packet")
-                    filename = packet[3:].rstrip()
-                    if not self.overwrite and os.path.exists(filename):
-                        # we're going to rename TEST.JBI to TEST-1.JBI and
-                        # keep incrementing the number until we find one that
-                        # doesn't exist
-                        original_filename = filename
-                        rename_counter = 1
-                        while os.path.exists(filename):
-                            filename = "{0}-{2}{1}".format(
-                                list(os.path.splitext(original_filename)) +
-                                [rename_counter])
-                            rename_counter += 1
-                        warn("Renaming {} to {}".format(original_filename,
-                                                        filename))
-                    with open(filename, "w") as outputfh:
-                        self.write("ACK")
-                        while True:
-                            packet = next(self.input_packets)
-                            if packet.startswith("FWT"):
-                                outputfh.write(packet[3:])
-                                self.write("ACK")
-                                continue
-                            if packet == "EOF":
-                                self.write("ACK")
-                                break
-                            warn("Unexpected packet during write: {}".format(
-                                packet))
-                    continue
-
-                warn("Unhandled packet: {}".format(packet))
 
-            except IOError:
-                log("Resetting on CANcel")
-                self.write("ACK")
+def serve(disks):
+    """
+    Run the given SoftFC1s until interrupted. One select() call waits on
+    every port, so idle ports cost no CPU however many there are
+    """
+    by_fd = dict((disk.fileno(), disk) for disk in disks)
+    while True:
+        try:
+            (readable, _, _) = select.select(list(by_fd), [], [])
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                continue  # a signal, such as the SIGUSR1 stats request
+            raise
+        for fd in readable:
+            by_fd[fd].on_readable()
+
+
+def load_policies(filename):
+    """
+    Return a dict mapping port names to PortPolicy objects, read from a JSON
+    file like {"/dev/ttyS0": {"files": ["A*.JBI"], "overwrite": false}}
+    """
+    with open(filename) as inputfh:
+        config = json.load(inputfh)
+    return dict((str(port), PortPolicy(
+        [str(pattern) for pattern in settings.get("files", ["*"])],
+        settings.get("overwrite", False))) for port, settings in config.items())
+
+
+def log_stats(disks):
+    """ Log the statistics of each port """
+    for disk in disks:
+        log("{}: {}".format(disk.port, disk.stats))
 
 
 def main():
@@ -249,9 +496,10 @@ def main():
 
     argp = argparse.ArgumentParser(description=(
         "MotoDisk: a software emulator for the YASNAC FC1 floppy disk drive"))
-    argp.add_argument('-p', '--port', default='/dev/ttyS0', help=(
-        "serial port to use"))
-    argp.add_argument('-b', '--baud', default=4800, help=(
+    argp.add_argument('-p', '--port', action="append", help=(
+        "serial port to use. Give it once for each robot to serve several "
+        "from one process; the default is /dev/ttyS0"))
+    argp.add_argument('-b', '--baud', type=int, default=4800, help=(
         "serialport baudrate to use"))
     argp.add_argument('-d', '--debug', action="store_true", help=(
         "enable debugging output"))
@@ -262,12 +510,38 @@ def main():
         "robot, list those files on the command line. For example this "
         "allows you to send just a single file instead of all job (.JBI) "
         "files in the current working directory"))
+    argp.add_argument('-n', '--no-check', action="store_true", help=(
+        "serve jobs even if they have faults the robot would reject them for"))
+    argp.add_argument('--store', metavar="DIR", help=(
+        "keep files in a versioned store in this directory instead of the "
+        "current directory: every save becomes a new version and robots "
+        "load the latest. See motoversions.py. Can't be combined with a "
+        "list of files"))
+    argp.add_argument('--policy', metavar="FILE", help=(
+        'a JSON file of per-port settings, for example {"/dev/ttyS1": '
+        '{"files": ["CELL2*.JBI"], "overwrite": true}}. Ports it leaves out '
+        'see every file and follow --overwrite'))
     args = argp.parse_args()
 
     DEBUG = args.debug
-
-    disk = SoftFC1(port=args.port, baudrate=args.baud, filelist=args.file, overwrite=args.overwrite)
-    disk.emulate()
+    if args.store and args.file:
+        argp.error("--store serves the whole store, it can't be limited to "
+                   "the listed files")
+
+    storage = versionstore.VersionStore(args.store) if args.store else None
+    index = FileIndex(filelist=args.file, storage=storage)
+    index.check_jobs = not args.no_check
+    policies = load_policies(args.policy) if args.policy else {}
+    disks = [SoftFC1(port=port, baudrate=args.baud, index=index,
+                     policy=policies.get(port, PortPolicy(
+                         overwrite=args.overwrite)))
+             for port in args.port or ['/dev/ttyS0']]
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: log_stats(disks))
+    try:
+        serve(disks)
+    finally:
+        log_stats(disks)
 
     return True
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+""" motoversions: List, compare and restore the versions motodisk has saved """
+import argparse
+import difflib
+import os
+import sys
+
+import versionstore
+
+
+def find_version(store, argument):
+    """
+    Return the Version an argument names: a version id, or a file name for
+    its latest version. Raise KeyError if there is no such version
+    """
+    version = store.get(int(argument)) if argument.isdigit() \
+        else store.latest(argument)
+    if version is None:
+        raise KeyError("There is no version {}".format(argument))
+    return version
+
+
+def list_versions(store, name):
+    """ Print each file's latest version, or every version of one file """
+    if name:
+        versions = store.versions(name)
+    else:
+        versions = [store.latest(filename) for filename in store.names()]
+    for version in versions:
+        print versionstore.describe(version)
+    return bool(versions)
+
+
+def diff_versions(store, first, second):
+    """ Print a unified diff between two Versions """
+    for line in difflib.unified_diff(
+            store.content(first).splitlines(True),
+            store.content(second).splitlines(True),
+            "{} (version {})".format(first.name, first.id),
+            "{} (version {})".format(second.name, second.id)):
+        sys.stdout.write(line.rstrip("\r\n") + "\n")
+    return True
+
+
+def main():
+    """
+    primary handler for command-line execution. return an exit status integer
+    or a bool type (where True indicates successful exection)
+    """
+    argp = argparse.ArgumentParser(description=(
+        "List, compare and restore the file versions saved by motodisk "
+        "--store"))
+    argp.add_argument(
+        'mode', choices=('list', 'diff', 'restore', 'add'), help=(
+            '"list" prints the latest version of each file, or every version '
+            'of the named file; "diff" compares two versions, by default the '
+            'last two of the named file; "restore" makes a version the latest '
+            'again (or with --to, writes it to a directory); "add" stores '
+            'files as new versions'))
+    argp.add_argument('arguments', nargs="*", help=(
+        "file names or version ids"))
+    argp.add_argument('-s', '--store', default="versions", help=(
+        'the version store directory. The default is "versions"'))
+    argp.add_argument('--to', metavar="DIR", help=(
+        "write restored versions into this directory instead"))
+    args = argp.parse_args()
+
+    store = versionstore.VersionStore(args.store)
+    try:
+        if args.mode == 'list':
+            return list_versions(store, (args.arguments or [None])[0])
+
+        if args.mode == 'diff':
+            if not 1 <= len(args.arguments) <= 2:
+                argp.error("diff takes a file name, or two versions")
+            if len(args.arguments) == 2:
+                return diff_versions(store, *[find_version(store, argument)
+                                              for argument in args.arguments])
+            versions = store.versions(args.arguments[0])
+            if len(versions) < 2:
+                raise KeyError("{} has fewer than two versions".format(
+                    args.arguments[0]))
+            return diff_versions(store, *versions[-2:])
+
+        if args.mode == 'add':
+            for filename in args.arguments:
+                with open(filename) as inputfh:
+                    print versionstore.describe(store.add(
+                        os.path.basename(filename), inputfh.read(), "add"))
+            return True
+
+        for argument in args.arguments:
+            version = find_version(store, argument)
+            if args.to:
+                if not os.path.isdir(args.to):
+                    os.makedirs(args.to)
+                with open(os.path.join(args.to, version.name), "w") as outputfh:
+                    outputfh.write(store.content(version))
+                print os.path.join(args.to, version.name)
+            else:
+                print versionstore.describe(store.restore(version.id))
+        return True
+    except KeyError as error:
+        print error.args[0]
+        return False
+
+
+if __name__ == '__main__':
+    RESULT = main()
+    sys.exit(int(not RESULT if isinstance(RESULT, bool) else RESULT))
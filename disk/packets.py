@@ -38,6 +38,8 @@ def decode(packet):
     """
     if not packet.startswith("\x02"):
         raise InvalidPacketHeader("Unknown packet format")
+    if len(packet) < 3:
+        raise NeedMoreInput  # the length hasn't all arrived yet
     length = struct.unpack("<H2", packet[1:3])[0]
     if len(packet) < length + 5:
         raise NeedMoreInput
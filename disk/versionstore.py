@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+A versioned, deduplicating store for the files robots save through motodisk
+
+Every save becomes a version: a row in an SQLite database with the file name,
+the SHA-1 of the content, its size, when it was saved and the port it came
+from. The content is kept once per digest in a snapshot.BlobStore, so saving
+an unchanged job costs one row. A second table maps each name to its latest
+version, so listing and loading files take the same time however many
+versions have been saved.
+"""
+import collections
+import os
+import sqlite3
+import sys
+import time
+
+# the blob store is shared with the remote/ tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'remote'))
+import snapshot
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    saved REAL NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS versions_by_name ON versions (name, id);
+CREATE TABLE IF NOT EXISTS latest (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL REFERENCES versions (id)
+);
+"""
+
+Version = collections.namedtuple("Version", 'id name digest size saved source')
+
+
+def describe(version):
+    """ Return a one line description of a Version """
+    return "{:>5}  {}  {:12}  {:>6} bytes  {}  from {}".format(
+        version.id, time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(version.saved)),
+        version.name, version.size, version.digest[0:10], version.source)
+
+
+class VersionStore(object):
+    """
+    Every version of every saved file. This is also a motodisk storage
+    backend (see motodisk.DirectoryStorage): robots see the latest version
+    of each file, and their saves add versions instead of overwriting
+    """
+    root = None
+    blobs = None
+    db = None
+
+    def __init__(self, root):
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.root = root
+        self.blobs = snapshot.BlobStore(os.path.join(root, "objects"))
+        self.db = sqlite3.connect(os.path.join(root, "versions.sqlite"))
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+
+    def add(self, name, content, source=None):
+        """ Store content as the latest version of the named file """
+        digest = self.blobs.put(content)
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO versions (name, digest, size, saved, source) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (name, digest, len(content), time.time(), source))
+            self.db.execute("INSERT OR REPLACE INTO latest (name, version) "
+                            "VALUES (?, ?)", (name, cursor.lastrowid))
+        return self.get(cursor.lastrowid)
+
+    def get(self, version_id):
+        """ Return the Version with the given id, or None """
+        row = self.db.execute("SELECT * FROM versions WHERE id = ?",
+                              (version_id,)).fetchone()
+        return Version(*row) if row else None
+
+    def latest(self, name):
+        """ Return the latest Version of the named file, or None """
+        row = self.db.execute(
+            "SELECT versions.* FROM latest JOIN versions "
+            "ON versions.id = latest.version WHERE latest.name = ?",
+            (name,)).fetchone()
+        return Version(*row) if row else None
+
+    def versions(self, name=None):
+        """ Return the Versions of the named file, or of all, oldest first """
+        if name is None:
+            rows = self.db.execute("SELECT * FROM versions ORDER BY id")
+        else:
+            rows = self.db.execute("SELECT * FROM versions WHERE name = ? "
+                                   "ORDER BY id", (name,))
+        return [Version(*row) for row in rows]
+
+    def content(self, version):
+        """ Return the content of a Version """
+        return self.blobs.get(version.digest)
+
+    def restore(self, version_id, source="restore"):
+        """
+        Make an older version the latest again, by adding it as a new
+        version, so the history is kept. Return the new Version
+        """
+        version = self.get(version_id)
+        if version is None:
+            raise KeyError("There is no version {}".format(version_id))
+        return self.add(version.name, self.content(version), source)
+
+    # the motodisk storage backend interface
+
+    def names(self):
+        """
+        Return the names of the stored jobs that can be listed to a robot:
+        like DirectoryStorage, only .JBI files of 5 to 16 characters
+        """
+        return [row[0] for row in
+                self.db.execute("SELECT name FROM latest ORDER BY name")
+                if row[0].endswith(".JBI") and 4 < len(row[0]) < 17]
+
+    def available(self, filename):
+        """ Return True if a version of the named file is stored """
+        return self.latest(filename) is not None
+
+    def version(self, filename):
+        """ Return the digest of the latest version of the named file """
+        return self.latest(filename).digest
+
+    def read(self, filename):
+        """ Return the content of the latest version of the named file """
+        return self.content(self.latest(filename))
+
+    def save(self, filename, filedata, overwrite=False, port=None):
+        """
+        Add a file written by a robot as a new version. Nothing is ever
+        overwritten, so overwrite is ignored. Return the file name
+        """
+        self.add(filename, filedata, port)
+        return filename
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Library for loading and comparing Intel HEX dumps of ERC controller CMOS
+(such as dat/CMOS2.HEX)
+
+Records are streamed straight into a sparse, memory mapped binary image, so
+a dump is never held in memory as text. The image remembers which address
+ranges the dump actually covered, and diff() reports the changed ranges of
+two images, labelled with the known CMOS regions they fall in.
+"""
+import binascii
+import mmap
+import tempfile
+
+import numpy
+
+# (start, end, label) of CMOS regions identified so far, as linear addresses;
+# the name table is the one found around 1800:0954 in dat/CMOS2.HEX
+KNOWN_REGIONS = (
+    (0x18950, 0x189a0, "name table"),
+)
+
+# Intel HEX record types
+DATA = 0x00
+END_OF_FILE = 0x01
+EXTENDED_SEGMENT_ADDRESS = 0x02
+START_SEGMENT_ADDRESS = 0x03
+EXTENDED_LINEAR_ADDRESS = 0x04
+START_LINEAR_ADDRESS = 0x05
+
+
+class HexFormatError(ValueError):
+    """ A record of the HEX file is malformed or fails its checksum """
+    def __init__(self, filename, line_number, reason):
+        super(HexFormatError, self).__init__("{}:{}: {}".format(
+            filename, line_number, reason))
+
+
+def segmented(address):
+    """
+    Return a linear address in the dump's SSSS:OOOO notation, which uses
+    32K segments such as 1800, 2000 and 2800
+    """
+    return "{:04X}:{:04X}".format((address >> 4) & 0xf800,
+                                  address & 0x7fff)
+
+
+def region_label(start, end):
+    """ Return the labels of the known regions overlapping [start, end) """
+    return ", ".join(label for (region_start, region_end, label)
+                     in KNOWN_REGIONS if start < region_end and
+                     end > region_start)
+
+
+class Image(object):
+    """
+    A sparse binary image backed by a memory mapped file. Unwritten bytes
+    read as zero and take no disk space
+    """
+    size = 0
+    ranges = None
+    _file = None
+    _map = None
+
+    def __init__(self, path=None, size=0x100000):
+        self._file = open(path, "w+b") if path else tempfile.TemporaryFile()
+        self.ranges = list()
+        self._resize(size)
+
+    def _resize(self, size):
+        """ Grow the backing file (sparsely) and remap it """
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self.size = size
+
+    def write(self, address, data):
+        """ Store data at the given linear address, record it as covered """
+        end = address + len(data)
+        if end > self.size:
+            size = self.size
+            while size < end:
+                size *= 2
+            self._resize(size)
+        self._map[address:end] = data
+
+        if self.ranges and self.ranges[-1][1] == address:
+            self.ranges[-1][1] = end
+        else:
+            self.ranges.append([address, end])
+
+    def coverage(self):
+        """ Return the sorted, merged [start, end) ranges that were written """
+        merged = list()
+        for (start, end) in sorted(self.ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.ranges = merged
+        return [tuple(item) for item in merged]
+
+    def read(self, start, end):
+        """ Return the bytes of [start, end) """
+        return self._map[start:min(end, self.size)]
+
+    def array(self):
+        """ Return a read-only uint8 numpy view of the whole image """
+        return numpy.frombuffer(self._map, dtype=numpy.uint8)
+
+    def close(self):
+        """ Unmap the image and close (and for temporary images, delete) it """
+        self._map.close()
+        self._file.close()
+
+
+def load(filename, image_path=None):
+    """
+    Parse the named Intel HEX file into an Image, validating every record's
+    length and checksum and following extended segment and linear address
+    records. If image_path is given the image is kept in that file
+    """
+    image = Image(image_path)
+    base = 0
+    with open(filename) as inputfh:
+        for line_number, line in enumerate(inputfh, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(":"):
+                raise HexFormatError(filename, line_number,
+                                     "record doesn't start with ':'")
+            try:
+                record = bytearray(binascii.unhexlify(line[1:]))
+            except (TypeError, binascii.Error):
+                raise HexFormatError(filename, line_number, "invalid hex")
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise HexFormatError(filename, line_number,
+                                     "record length mismatch")
+            if sum(record) & 0xff:
+                raise HexFormatError(filename, line_number, "bad checksum")
+
+            record_type = record[3]
+            data = record[4:-1]
+            if record_type == DATA:
+                offset = (record[1] << 8) | record[2]
+                image.write(base + offset, bytes(data))
+            elif record_type == EXTENDED_SEGMENT_ADDRESS:
+                base = ((data[0] << 8) | data[1]) << 4
+            elif record_type == EXTENDED_LINEAR_ADDRESS:
+                base = ((data[0] << 8) | data[1]) << 16
+            elif record_type == END_OF_FILE:
+                break
+            elif record_type not in (START_SEGMENT_ADDRESS,
+                                     START_LINEAR_ADDRESS):
+                raise HexFormatError(filename, line_number,
+                                     "unknown record type {}".format(
+                                         record_type))
+    image.coverage()
+    return image
+
+
+def intersect(first, second):
+    """ Return the overlapping parts of two sorted lists of ranges """
+    result = list()
+    (index_a, index_b) = (0, 0)
+    while index_a < len(first) and index_b < len(second):
+        start = max(first[index_a][0], second[index_b][0])
+        end = min(first[index_a][1], second[index_b][1])
+        if start < end:
+            result.append((start, end))
+        if first[index_a][1] < second[index_b][1]:
+            index_a += 1
+        else:
+            index_b += 1
+    return result
+
+
+def subtract(ranges, removed):
+    """ Return the parts of the sorted ranges not covered by removed """
+    result = list()
+    for (start, end) in ranges:
+        for (cut_start, cut_end) in removed:
+            if cut_end <= start or cut_start >= end:
+                continue
+            if cut_start > start:
+                result.append((start, cut_start))
+            start = max(start, cut_end)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def diff(first, second, gap=8):
+    """
+    Compare two Images. Return a list of (start, end, kind, label) tuples,
+    where kind is "changed", "removed" (only covered by the first image) or
+    "added" (only covered by the second). Changed runs closer together than
+    gap bytes are reported as one range
+    """
+    (coverage_a, coverage_b) = (first.coverage(), second.coverage())
+    (bytes_a, bytes_b) = (first.array(), second.array())
+    result = list()
+
+    for (start, end) in intersect(coverage_a, coverage_b):
+        changed = numpy.flatnonzero(bytes_a[start:end] != bytes_b[start:end])
+        if not len(changed):
+            continue
+        # split the changed offsets into runs wherever they are gap apart
+        breaks = numpy.flatnonzero(numpy.diff(changed) > gap)
+        run_starts = numpy.concatenate([[0], breaks + 1])
+        run_ends = numpy.concatenate([breaks, [len(changed) - 1]])
+        for run_start, run_end in zip(run_starts, run_ends):
+            (low, high) = (start + int(changed[run_start]),
+                           start + int(changed[run_end]) + 1)
+            result.append((low, high, "changed", region_label(low, high)))
+
+    for (kind, ranges) in (("removed", subtract(coverage_a, coverage_b)),
+                           ("added", subtract(coverage_b, coverage_a))):
+        for (start, end) in ranges:
+            result.append((start, end, kind, region_label(start, end)))
+
+    return sorted(result)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Offline cycle time estimation for ERC job files
+
+The instruction stream of a job is interpreted without the robot: motion
+instructions are timed from the joint travel between consecutive positions,
+the axis speed and acceleration limits in PARAM.DAT and the instruction's
+speed tags, TIMER delays are added, and JUMP/CALL control flow and simple
+byte/integer variable arithmetic are followed so loops run the right number
+of times.
+"""
+import collections
+import os
+import re
+
+import numpy
+
+import jbi
+import kinematics
+
+# seconds added for a fine positioning (no CONT, PL=0) stop
+SETTLE_TIME = 0.1
+
+# upper limit on instructions interpreted per cycle, guards endless loops
+STEP_LIMIT = 100000
+
+CONDITION = re.compile(r'^([A-Z]\d+)(<>|<=|>=|=|<|>)(-?\d+)$')
+
+COMPARISONS = {'=': lambda a, b: a == b,
+               '<>': lambda a, b: a != b,
+               '<': lambda a, b: a < b,
+               '>': lambda a, b: a > b,
+               '<=': lambda a, b: a <= b,
+               '>=': lambda a, b: a >= b}
+
+Step = collections.namedtuple("Step", 'job line instruction seconds')
+
+
+class AxisLimits(object):
+    """ The per-axis speed (pulse/s) and acceleration (pulse/s^2) limits """
+    speed = None  # RC052 - RC057
+    acceleration = None  # RC034 - RC039
+    deceleration = None  # RC040 - RC045
+
+    def __init__(self, parameters):
+        rc_values = parameters["RC"]
+        self.speed = numpy.array(rc_values[52:58], dtype=float)
+        self.acceleration = numpy.array(rc_values[34:40], dtype=float)
+        self.deceleration = numpy.array(rc_values[40:46], dtype=float)
+
+    def joint_time(self, travel, percent, blended=False):
+        """
+        Return the seconds needed to move every axis through the given pulse
+        travel at percent of the maximum speed, using a trapezoidal speed
+        profile per axis. A blended (CONT) motion doesn't decelerate to a stop
+        """
+        travel = numpy.abs(numpy.asarray(travel, dtype=float))
+        speed = self.speed * percent / 100.0
+        accel = self.acceleration
+        decel = numpy.where(blended, numpy.inf, self.deceleration)
+
+        ramp = speed ** 2 / (2 * accel) + speed ** 2 / (2 * decel)
+        cruising = travel >= ramp
+        trapezoid = travel / speed + speed / (2 * accel) + speed / (2 * decel)
+        # the axis never reaches its speed limit, so it ramps up then down
+        peak = numpy.sqrt(2 * travel / (1 / accel + 1 / decel))
+        triangle = peak / accel + peak / decel
+        return float(numpy.where(cruising, trapezoid, triangle).max())
+
+
+def linear_time(distance, speed):
+    """ Return the seconds for a linear move of distance mm at speed mm/s """
+    return distance / speed if speed > 0 else 0.0
+
+
+class JobLibrary(object):
+    """
+    Loads jobs by name from a directory, with their positions in both pulse
+    and rectangular form
+    """
+    directory = None
+    geometry = None
+    jobs = None
+
+    def __init__(self, directory, geometry):
+        self.directory = directory
+        self.geometry = geometry
+        self.jobs = dict()
+
+    def load(self, name):
+        """
+        Return (job, instructions, positions, pulses, poses) for the named
+        job, where positions maps position names to rows of the pulse and
+        pose arrays
+        """
+        if name not in self.jobs:
+            filename = jbi.find_job(self.directory, name)
+            if filename is None:
+                raise IOError("Job {} not found in {}".format(
+                    name, self.directory))
+            self.add(jbi.read_job(filename), name)
+        return self.jobs[name]
+
+    def add(self, job, name=None):
+        """
+        Register an already parsed job under the given name (or its //NAME),
+        return its load() tuple
+        """
+        name = name or job.name
+        names = job.position_names()
+        values = numpy.array(job.position_values()).reshape(-1, 6)[:, 0:6] \
+            if names else numpy.zeros((0, 6))
+        if job.frame == "RECTAN" and len(values):
+            (pulses, poses) = (kinematics.inverse(self.geometry, values),
+                               values)
+        elif len(values):
+            (pulses, poses) = (values, kinematics.forward(self.geometry,
+                                                          values))
+        else:
+            (pulses, poses) = (values, values)
+        positions = dict((name, index) for index, name in enumerate(names))
+        self.jobs[name] = (job, job.parsed_instructions(), positions, pulses,
+                           poses)
+        return self.jobs[name]
+
+
+class Estimate(object):
+    """ The result of estimating one job: its cycle time and its steps """
+    job = None
+    steps = None
+    warnings = None
+
+    def __init__(self, job):
+        self.job = job
+        self.steps = list()
+        self.warnings = list()
+
+    @property
+    def cycle_time(self):
+        """ Total estimated seconds for one cycle of the job """
+        return sum(step.seconds for step in self.steps)
+
+    def hotspots(self, count=10):
+        """
+        Return the count slowest instructions as (seconds, executions, job,
+        line, instruction) tuples, summed over every time each ran per cycle
+        """
+        totals = collections.OrderedDict()
+        for step in self.steps:
+            key = (step.job, step.line, step.instruction)
+            (seconds, executions) = totals.get(key, (0.0, 0))
+            totals[key] = (seconds + step.seconds, executions + 1)
+        ranked = sorted(((seconds, executions) + key for key, (seconds,
+                         executions) in totals.items()), reverse=True)
+        return ranked[0:count]
+
+
+class Interpreter(object):
+    """
+    Interpret a job's instruction stream, accumulating estimated step times
+    """
+    library = None
+    limits = None
+    variables = None
+    position = None
+    estimate = None
+    executed = 0
+
+    def __init__(self, library, limits):
+        self.library = library
+        self.limits = limits
+
+    def run(self, name):
+        """
+        Return an Estimate for one steady-state cycle of the named job. The
+        cycle ends at END, or where an unconditional JUMP returns to an
+        earlier label. The job is run twice so that the second pass starts
+        from where the first one left the arm
+        """
+        self.position = None
+        for _ in range(2):
+            self.variables = collections.defaultdict(int)
+            self.estimate = Estimate(name)
+            self.executed = 0
+            self.execute(name)
+        return self.estimate
+
+    def warn(self, message):
+        """ Record a warning about the estimate, once """
+        if message not in self.estimate.warnings:
+            self.estimate.warnings.append(message)
+
+    def record(self, job_name, line, instruction, seconds):
+        """ Add a step to the estimate """
+        self.estimate.steps.append(Step(job_name, line, instruction.line,
+                                        seconds))
+
+    def condition(self, instruction):
+        """ Evaluate the IF clause of an instruction; True if there is none """
+        if "IF" not in instruction.args:
+            return True
+        clause = "".join(instruction.args[instruction.args.index("IF") + 1:])
+        match = CONDITION.match(clause)
+        if not match:
+            self.warn("can't evaluate {!r}, assumed false".format(clause))
+            return False
+        (variable, comparison, value) = match.groups()
+        return COMPARISONS[comparison](self.variables[variable], int(value))
+
+    def execute(self, name):
+        """
+        Interpret the named job until END or RET, return True instead if the
+        cycle ended with a JUMP back to an earlier label
+        """
+        try:
+            (job, instructions, positions, pulses, poses) = \
+                self.library.load(name)
+        except IOError as error:
+            self.warn("{}, not timed".format(error))
+            return False
+        labels = dict((instruction.opcode, index) for index, instruction
+                      in enumerate(instructions)
+                      if instruction.opcode.startswith("*"))
+
+        index = 0
+        while index < len(instructions):
+            self.executed += 1
+            if self.executed > STEP_LIMIT:
+                self.warn("stopped after {} instructions".format(STEP_LIMIT))
+                return True
+            instruction = instructions[index]
+            opcode = instruction.opcode
+            index += 1
+
+            if opcode in ("MOVJ", "MOVL", "MOVC", "MOVS"):
+                self.record(name, index - 1, instruction, self.motion_time(
+                    instruction, positions, pulses, poses))
+            elif opcode == "TIMER":
+                self.record(name, index - 1, instruction,
+                            float(instruction.tags.get("T", 0)))
+            elif opcode in ("PAUSE", "WAIT"):
+                self.warn("{} waits for an operator or signal, counted as "
+                          "0 s".format(opcode))
+                self.record(name, index - 1, instruction, 0.0)
+            elif opcode in ("SET", "INC", "DEC", "ADD", "SUB", "CLEAR"):
+                self.arithmetic(instruction)
+            elif opcode == "CALL":
+                target = jbi.job_reference(instruction)
+                if target and self.condition(instruction):
+                    if self.execute(target):
+                        self.warn("called job {} loops back, the cycle ends "
+                                  "there".format(target))
+                        return True
+            elif opcode == "JUMP":
+                if not self.condition(instruction):
+                    continue
+                target = jbi.job_reference(instruction)
+                if target:
+                    return self.execute(target)
+                label = instruction.args[0] if instruction.args else None
+                if label not in labels:
+                    self.warn("JUMP to unknown label {}".format(label))
+                    continue
+                if "IF" not in instruction.args and labels[label] < index:
+                    return True  # the job loops back, the cycle is complete
+                index = labels[label] + 1
+            elif opcode in ("END", "RET"):
+                return False
+            elif opcode in ("NOP",) or opcode.startswith("*"):
+                continue
+            else:
+                self.warn("{} is not timed".format(opcode))
+        return False
+
+    def arithmetic(self, instruction):
+        """ Apply a SET/INC/DEC/ADD/SUB/CLEAR to the variable table """
+        args = instruction.args
+        if not args:
+            return
+        variable = args[0]
+        try:
+            operand = int(args[1]) if len(args) > 1 else 0
+        except ValueError:
+            operand = self.variables[args[1]]
+        if instruction.opcode == "SET":
+            self.variables[variable] = operand
+        elif instruction.opcode == "INC":
+            self.variables[variable] += 1
+        elif instruction.opcode == "DEC":
+            self.variables[variable] -= 1
+        elif instruction.opcode == "ADD":
+            self.variables[variable] += operand
+        elif instruction.opcode == "SUB":
+            self.variables[variable] -= operand
+        elif instruction.opcode == "CLEAR":
+            self.variables[variable] = 0
+
+    def motion_time(self, instruction, positions, pulses, poses):
+        """ Return the estimated seconds for a motion instruction """
+        target = [arg for arg in instruction.args if arg in positions]
+        if not target:
+            self.warn("{} has no known position".format(instruction.line))
+            return 0.0
+        index = positions[target[0]]
+        (target_pulses, target_pose) = (pulses[index], poses[index])
+        if self.position is None:
+            self.position = (target_pulses, target_pose)
+        (start_pulses, start_pose) = self.position
+        self.position = (target_pulses, target_pose)
+
+        blended = ("CONT" in instruction.args or
+                   int(instruction.tags.get("PL", 0)) > 0)
+        travel = target_pulses - start_pulses
+        if instruction.opcode == "MOVJ":
+            percent = float(instruction.tags.get("VJ", 100))
+            seconds = self.limits.joint_time(travel, percent, blended)
+        else:
+            distance = numpy.linalg.norm(target_pose[0:3] - start_pose[0:3])
+            seconds = max(linear_time(distance,
+                                      float(instruction.tags.get("V", 0))),
+                          self.limits.joint_time(travel, 100.0, blended))
+        if not blended:
+            seconds += SETTLE_TIME
+        return seconds
+
+
+def estimate_file(filename, parameters):
+    """
+    Return the Estimate for one cycle of the named job file; called jobs are
+    loaded from the same directory
+    """
+    geometry = kinematics.Geometry.from_parameters(parameters)
+    library = JobLibrary(os.path.dirname(filename) or ".", geometry)
+    job = jbi.read_job(filename)
+    name = job.name or os.path.splitext(os.path.basename(filename))[0]
+    library.add(job, name)
+    return Interpreter(library, AxisLimits(parameters)).run(name)
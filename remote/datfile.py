@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Library for reading and writing the controller's DAT/PRO files (PARAM.DAT,
+TOOL.DAT, ISTATE.DAT and the like)
+
+These files are made of "/", "//" and "///" header lines, each followed by
+lines of comma separated values. Loading a file only indexes its headers;
+a section's values are parsed when they are first asked for. The original
+text is kept, so dumps() returns the file byte for byte apart from values
+changed with set_values(). Parsed values are cached on disk keyed by the
+file's hash, so repeated lookups across many backups skip the parsing; set
+YASNAC_NO_CACHE in the environment to leave the disk alone.
+"""
+import array
+import collections
+import cPickle as pickle
+import hashlib
+import os
+import re
+import tempfile
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "yasnac")
+
+HEADER = re.compile(r'^(/+)([^\r\n]*)(\r?\n|$)', re.M)
+NUMBER = re.compile(r'^-?\d+(\.(\d*))?$')
+
+Section = collections.namedtuple("Section", 'level title start end')
+
+
+def section_name(title):
+    """
+    Return the lookup name of a header title: "//SAVE DATE   : 2014/10/07"
+    is found as "SAVE DATE", "//RCPRM" as "RCPRM" and "//TOOL 1" as "TOOL 1"
+    """
+    return title.split(":", 1)[0].strip()
+
+
+def parse_number(field):
+    """ Return an int or float for a numeric field; empty fields are 0 """
+    if not field.strip():
+        return 0
+    if "." in field:
+        return float(field)
+    return int(field)
+
+
+def format_like(value, original):
+    """ Format a new value with the same number of decimals as original """
+    match = NUMBER.match(original.strip())
+    if match and match.group(1):
+        return "{:.{}f}".format(value, len(match.group(2)))
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class DatFile(object):
+    """
+    An indexed DAT/PRO file. Each Section covers its header line and body
+    lines up to the next header of the same or a higher level, so "//TOOL 0"
+    includes its "///NAME" subsection and the offsets that follow it
+    """
+    content = None
+    sections = None
+    digest = None
+    cache_path = None  # where the index and parsed values are cached
+    _values = None
+    _changes = None
+    _unsaved = False  # values were parsed since the cache was written
+
+    def __init__(self, content, cache_directory=None):
+        self.content = content
+        self.digest = hashlib.sha1(content).hexdigest()
+        if cache_directory:
+            self.cache_path = os.path.join(cache_directory,
+                                           self.digest + ".pickle")
+        self._values = dict()
+        self._changes = dict()
+
+        cached = self._read_cache()
+        if cached:
+            (self.sections, self._values) = cached
+        else:
+            self.sections = self._index()
+
+    def _index(self):
+        """ Find the headers in one pass, return the list of Sections """
+        headers = [(len(match.group(1)), match.group(2).rstrip(),
+                    match.start()) for match in HEADER.finditer(self.content)]
+        sections = list()
+        for index, (level, title, start) in enumerate(headers):
+            end = len(self.content)
+            for (other_level, _, other_start) in headers[index + 1:]:
+                if other_level <= level:
+                    end = other_start
+                    break
+            sections.append(Section(level, title, start, end))
+        return sections
+
+    def _read_cache(self):
+        """ Return the cached (sections, values) for this content, or None """
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, "rb") as inputfh:
+                (sections, values) = pickle.load(inputfh)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        return ([Section(*section) for section in sections], values)
+
+    def _write_cache(self):
+        """ Store the index and the parsed values, replacing atomically """
+        if not self.cache_path:
+            return
+        directory = os.path.dirname(self.cache_path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (handle, temporary) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle, "wb") as outputfh:
+                pickle.dump(([tuple(section) for section in self.sections],
+                             self._values), outputfh, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, self.cache_path)
+        except (IOError, OSError):
+            pass  # the cache is only an optimisation
+
+    def names(self):
+        """ Return the lookup names of the sections, in file order """
+        return [section_name(section.title) for section in self.sections]
+
+    def find(self, name):
+        """ Return the first Section with the given title or lookup name """
+        for section in self.sections:
+            if section.title == name or section_name(section.title) == name:
+                return section
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            self.find(name)
+        except KeyError:
+            return False
+        return True
+
+    def lines(self, name):
+        """
+        Return the body of the named section as a list of (line number,
+        text) pairs, leaving out header lines; line numbers start at 0
+        """
+        section = self.find(name)
+        first = self.content.count("\n", 0, section.start)
+        body = self.content[section.start:section.end].splitlines()
+        return [(first + offset, self._changes.get(first + offset, text))
+                for offset, text in enumerate(body)
+                if not text.startswith("/")]
+
+    def rows(self, name):
+        """ Return the body lines of the named section split into fields """
+        return [text.split(",") for (_, text) in self.lines(name)]
+
+    def values(self, name):
+        """
+        Return every value of the named section's body as one typed array:
+        array('l') if all values are integers, otherwise array('d'). Empty
+        fields are 0. ValueError is raised for non-numeric fields, and for
+        sections whose fields are all empty, such as unnamed IONAME.DAT
+        signals, which are text to be read with rows()
+        """
+        if name not in self._values:
+            fields = [field for row in self.rows(name) for field in row]
+            if fields and not any(field.strip() for field in fields):
+                raise ValueError("{} has no values, only empty fields".format(
+                    name))
+            try:
+                numbers = [parse_number(field) for field in fields]
+            except ValueError:
+                raise ValueError("{} has non-numeric fields".format(name))
+            typecode = "l" if all(isinstance(number, (int, long))
+                                  for number in numbers) else "d"
+            self._values[name] = array.array(typecode, numbers)
+            self._unsaved = True
+        return self._values[name]
+
+    def save_cache(self):
+        """
+        Write the values parsed so far to the cache, once, unless values
+        have been changed; called by parameters() and when the DatFile is
+        dropped
+        """
+        if self._unsaved and not self._changes:
+            self._write_cache()
+        self._unsaved = False
+
+    def __del__(self):
+        try:
+            self.save_cache()
+        except Exception:
+            pass  # at interpreter exit the modules may already be gone
+
+    def set_values(self, name, values):
+        """
+        Replace the values of the named section in order, keeping the line
+        layout and each field's number of decimals
+        """
+        values = list(values)
+        lines = self.lines(name)
+        count = sum(len(text.split(",")) for (_, text) in lines)
+        if count != len(values):
+            raise ValueError("{} has {} values, {} given".format(
+                name, count, len(values)))
+        position = 0
+        for (number, text) in lines:
+            fields = text.split(",")
+            for index, field in enumerate(fields):
+                fields[index] = format_like(values[position], field)
+                position += 1
+            self._changes[number] = ",".join(fields)
+        self._values.pop(name, None)
+
+    def dumps(self):
+        """ Return the file content, including any changed values """
+        if not self._changes:
+            return self.content
+        lines = self.content.splitlines(True)
+        for number, text in self._changes.items():
+            ending = lines[number][len(lines[number].rstrip("\r\n")):]
+            lines[number] = text + ending
+        return "".join(lines)
+
+    def parameters(self):
+        """
+        Return a dict mapping each //xxPRM section name of a parameter file
+        to its values, for example result["RC"][2] is RC002
+        """
+        result = dict((section_name(section.title)[:-3],
+                       self.values(section.title))
+                      for section in self.sections if section.level == 2 and
+                      section_name(section.title).endswith("PRM"))
+        self.save_cache()
+        return result
+
+
+def load(filename, cache=None):
+    """
+    Return a DatFile for the named file. With cache, parsed values are kept
+    in CACHE_DIRECTORY under the hash of the file. By default the cache is
+    used unless YASNAC_NO_CACHE is set
+    """
+    if cache is None:
+        cache = not os.environ.get("YASNAC_NO_CACHE")
+    with open(filename, "rb") as inputfh:
+        return DatFile(inputfh.read(), os.path.join(CACHE_DIRECTORY, "dat")
+                       if cache else None)
+
+
+def save(filename, datfile):
+    """ Write a DatFile back to the named file """
+    with open(filename, "wb") as outputfh:
+        outputfh.write(datfile.dumps())
@@ -10,8 +10,15 @@ import sys
 import time
 import collections
 import os
+import array
+import itertools
+import tempfile
+import threading
+import Queue
 
-import serial
+import flightrecorder
+import jobcheck
+import linksettings
 
 
 # general global constants
@@ -110,6 +117,11 @@ TRANSACTIONS = {
     '90,001': 'data response, variable number of digits/data sent as csv'
 }
 
+# the system data files, in the order of their 02,06x - 02,080 request codes
+SYSTEM_FILES = tuple(description[4:] for (_, description) in sorted(
+    TRANSACTIONS.items()) if description.startswith("get ") and
+                     description.endswith(".DAT"))
+
 ERRORS = {
     # 1xxx - command test
     '1010': 'command failure',
@@ -156,6 +168,29 @@ ERRORS = {
     '5200': 'data range exceeded'
 }
 
+VARIABLE_TYPES = {
+    # kind: (TRANSACTIONS description, array typecode, value conversion)
+    'byte': ('byte', 'B', int),
+    'integer': ('integer', 'h', int),
+    'double': ('double', 'i', int),
+    'real': ('real', 'd', float),
+    'pulse': ('position (pulse data)', 'i', int),
+    'rectangular': ('position (rectangular data)', 'd', float),
+    'external pulse': ('external axis (pulse data)', 'i', int),
+    'external rectangular': ('external axis (rectangular data)', 'd', float)
+}
+
+# variable kinds which hold a single value, the others hold a list of axes
+SCALAR_VARIABLES = ('byte', 'integer', 'double', 'real')
+
+
+# the names of the bits in the two RSTATS data bytes, least significant first
+RSTATS_BITS = ('cycle=step', 'cycle=1 cycle', 'cycle=auto', 'running',
+               'in-guard driving', 'undocumented_0_32', 'undocumented_0_64',
+               'undocumented_0_128',
+               'panel hold', 'teach-box hold', 'external hold', 'command hold',
+               'alarm', 'error', 'servos on', 'undocumented_1_128')
+
 
 Message = collections.namedtuple("Message", 'body header footer')
 
@@ -183,6 +218,11 @@ class InvalidBlockChecksum(Exception):
     pass
 
 
+class TransmissionFailed(Exception):
+    """ The ERC didn't acknowledge a transmission within the retry limits """
+    pass
+
+
 class InvalidTransaction(Exception):
     """ General communications failure, expected IO did not happen """
     def __init__(self, expected_value, received_value):
@@ -200,9 +240,16 @@ def log(message):
     return message
 
 
-def warn(message, force=False):
-    """ Print the given message to stderr, flush stderr """
-    if DEBUG or force:
+def warn(message, *args, **kwargs):
+    """
+    Print the given message to stderr, flush stderr. If args are given, the
+    message is a format string that is only formatted when it is printed
+    (DEBUG, or force=True), so pass args on busy paths and the formatted
+    string where the return value is used
+    """
+    if DEBUG or kwargs.get("force", False):
+        if args:
+            message = message.format(*args)
         sys.stderr.write(message + "\n")
         sys.stderr.flush()
     return message
@@ -223,13 +270,9 @@ def decode_rstats(rstats):
     string keywords that represent the active bits in the result.
     for example: decode_rstat([2,0]) returns ('')
     """
-    bits_0 = ('cycle=step', 'cycle=1 cycle', 'cycle=auto', 'running',
-              'in-guard driving', 'undocumented_0_32', 'undocumented_0_64',
-              'undocumented_0_128')
-    bits_1 = ('panel hold', 'teach-box hold', 'external hold', 'command hold',
-              'alarm', 'error', 'servos on', 'undocumented_1_128')
     result = list()
-    for byte, names in (int(rstats[0]), bits_0), (int(rstats[1]), bits_1):
+    for byte, names in ((int(rstats[0]), RSTATS_BITS[0:8]),
+                        (int(rstats[1]), RSTATS_BITS[8:16])):
         for index, bit_name in enumerate(names):
             if byte & (2 ** index):
                 result.append(bit_name)
@@ -260,37 +303,65 @@ def checksum(block, stop, start=1):
     return sum([ord(c) for c in block[start:stop]])
 
 
+def rechunk(pieces, chunksize):
+    """
+    Yield successive chunksize strings from an iterable of strings of any
+    length, holding no more than one chunk's worth of data at a time
+    """
+    buffered = list()
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= chunksize:
+            data = "".join(buffered)
+            for start in xrange(0, len(data) - chunksize + 1, chunksize):
+                yield data[start:start + chunksize]
+            remainder = data[len(data) - len(data) % chunksize:]
+            (buffered, length) = ([remainder], len(remainder))
+    if length:
+        yield "".join(buffered)
+
+
+def frame_blocks(header_code, body_chunks):
+    """
+    Lazily yield the raw blocks for the given header_code and iterable of
+    body chunks. One chunk is read ahead, to choose between ETB and ETX
+    """
+    body_chunks = iter(body_chunks)
+    chunk = next(body_chunks, "")
+    prefix = SOH + header_code + STX  # only the first block has the heading
+    while chunk is not None:
+        following = next(body_chunks, None)
+        block = "".join([prefix, chunk, ETB if following is not None else ETX])
+        block += struct.pack("<H", checksum(block, len(block) + 2))
+        yield block
+        (prefix, chunk) = (STX, following)
+
+
 def encode(header_code, body, name_block=False):
     """
     return a list of raw block strings which represent the given header_code
     and body
     """
-    # return a list of blocks properly formatted for transmission, based on
-    # the given header_code and body
     if name_block:
         # if this flag is set, the first line of the body is a filename that
         # needs to be in its own block
         (name, _, body_content) = body.partition('\r')
-        body_chunks = [name + '\r'] + list(chunks(body_content, 256))
+        body_chunks = itertools.chain([name + '\r'], chunks(body_content, 256))
     else:
-        body_chunks = list(chunks(body, 256))
-    final_chunk = len(body_chunks) - 1  # -1 because of zero list indexing
-    result = list()
+        body_chunks = chunks(body, 256)
+    return list(frame_blocks(header_code, body_chunks))
 
-    # handle the first block
-    block = "".join([SOH, header_code, STX, body_chunks.pop(0),
-                     ETB if final_chunk > 0 else ETX])
-    block += struct.pack("<H", checksum(block, len(block) + 2))
-    result.append(block)
-    final_chunk -= 1
 
-    # ...and now the rest
-    for index, chunk in enumerate(body_chunks):
-        block = "".join([STX, chunk, ETB if index < final_chunk else ETX])
-        block += struct.pack("<H", checksum(block, len(block) + 2))
-        result.append(block)
-
-    return result
+def encode_file(header_code, filename, lines):
+    """
+    Lazily yield the raw blocks of a file transfer: the name block, then the
+    given iterable of lines with the job name fixed, in 256 byte blocks
+    """
+    rootname = filename_to_rootname(filename)
+    return frame_blocks(header_code, itertools.chain(
+        [rootname + '\r'], rechunk(namefix_lines(rootname, lines), 256)))
 
 
 def decode(block):
@@ -299,6 +370,8 @@ def decode(block):
     """
     if block.startswith(SOH):
         header_bytes = 8
+        if len(block) < header_bytes:
+            raise InvalidBlockNeedMore
         header = struct.unpack("c6sc", block[0:header_bytes])[1]
     elif block.startswith(STX):
         header_bytes = 1
@@ -321,6 +394,8 @@ def decode(block):
 
     body = block[header_bytes:body_end]
     block_length = body_end + 3
+    if len(block) < block_length:
+        raise InvalidBlockNeedMore
     footer = struct.unpack("<cH", block[body_end:block_length])
     calculated_checksum = checksum(block, block_length - 2)
     if footer[1] != calculated_checksum:
@@ -344,18 +419,24 @@ def namefix(filename, content):
 
     WARNING: side effect: this function enforces \r\n line endings
     """
+    return "".join(namefix_lines(filename, content.splitlines()))
+
+
+def namefix_lines(filename, lines):
+    """
+    namefix() one line at a time: yield the given lines (with or without
+    line endings) with \r\n endings and the //NAME line corrected
+    """
     expected_jobname = filename_to_rootname(filename)
     expected_entry = "//NAME {}".format(expected_jobname)
 
-    result = []
-    for line in content.splitlines():
+    for line in lines:
+        line = line.rstrip("\r\n")
         if line.startswith("//NAME ") and line != expected_entry:
-            result.append(expected_entry)
-            warn('Altering job content: "{}" -> "{}"'.format(
-                line, expected_entry), force=True)
-            continue
-        result.append(line)
-    return "\r\n".join(result) + "\r\n"
+            warn('Altering job content: "{}" -> "{}"', line, expected_entry,
+                 force=True)
+            line = expected_entry
+        yield line + "\r\n"
 
 
 def header_code_lookup(mode, filename):
@@ -371,6 +452,14 @@ def header_code_lookup(mode, filename):
     else:
         key += os.path.basename(filename)  # keep the filename extension here
 
+    return transaction_lookup(key)
+
+
+def transaction_lookup(key):
+    """
+    return the transaction code for the given TRANSACTIONS description, for
+    example, given "get byte", the result is 03,051
+    """
     for transaction_code, description in TRANSACTIONS.items():
         if description == key:
             return transaction_code
@@ -378,6 +467,65 @@ def header_code_lookup(mode, filename):
     raise RuntimeError("Couldn't find code for transaction: {}".format(key))
 
 
+def variable_header_lookup(mode, kind):
+    """
+    return the header code used to get or put the given kind of variable, for
+    example, given "put" and "pulse", the result is 03,005
+    """
+    if kind not in VARIABLE_TYPES:
+        raise ValueError("Unknown variable kind: {!r}".format(kind))
+    return transaction_lookup(mode + " " + VARIABLE_TYPES[kind][0])
+
+
+def format_variable(kind, number, value):
+    """
+    Return the csv line that carries the given variable in a 03,0xx message,
+    for example, given "byte", 5 and 12, the result is "5,12"
+    """
+    if kind in SCALAR_VARIABLES:
+        value = [value]
+    converter = VARIABLE_TYPES[kind][2]
+    return ",".join([str(number)] + [str(converter(item)) for item in value])
+
+
+def parse_variable(kind, line):
+    """
+    Return a (number, value) tuple for the given csv line of a 03,0xx message.
+    Scalar variable values are returned as a number, position variables as an
+    array of axis values
+    """
+    fields = [field.strip() for field in line.split(",")]
+    typecode, converter = VARIABLE_TYPES[kind][1:]
+    value = array.array(typecode, [converter(field or 0)
+                                   for field in fields[1:]])
+    if kind in SCALAR_VARIABLES:
+        value = value[0]
+    return (int(fields[0]), value)
+
+
+def parse_incoming_file(message):
+    """
+    Return the (filename, content) carried by an incoming 02,0xx file message
+    """
+    (name, _, content) = message.body.partition('\r')
+    return (name + header_extension_lookup(message.header), content)
+
+
+def command_timeout(command_string, timeout):
+    """
+    Return how long to wait for the answer to a system command: timeout
+    seconds, plus the wait of a JWAIT, or -1 (forever) for JWAIT -1
+    """
+    words = command_string.split()
+    if len(words) > 1 and words[0] == "JWAIT":
+        try:
+            wait_seconds = int(words[1])
+        except ValueError:
+            return timeout
+        return -1 if wait_seconds < 0 else timeout + wait_seconds
+    return timeout
+
+
 def header_extension_lookup(header_code):
     """
     Return the filename extension associated with the given header code
@@ -392,13 +540,192 @@ def test():
     robot.loop()
 
 
+class IncomingFile(object):
+    """
+    Receives the body of an incoming file message block by block. The name
+    line is parsed first to choose the destination, the content goes to a
+    temporary file next to it, and close() renames that into place, so an
+    interrupted transfer never leaves a truncated file under the real name
+    """
+    directory = None  # the current directory
+    extension = None
+    filename = None
+    _name = ""
+    _file = None
+    _temporary = None
+
+    def __init__(self, header, directory=None):
+        self.extension = header_extension_lookup(header)
+        self.directory = directory
+
+    def write(self, data):
+        """ Append the body data of the next block """
+        if self._file is None:
+            (name, newline, data) = (self._name + data).partition("\r")
+            if not newline:
+                self._name = name  # the name line continues in the next block
+                return
+            # fixme: safety-check the filename
+            self.filename = os.path.basename(name) + self.extension
+            if self.directory:
+                self.filename = os.path.join(self.directory, self.filename)
+            (handle, self._temporary) = tempfile.mkstemp(
+                prefix=".incoming-", dir=self.directory or ".")
+            self._file = os.fdopen(handle, "w")
+        self._file.write(data)
+
+    def close(self):
+        """ Finish the file and move it to its real name, return that name """
+        if self._file is None:
+            raise InvalidTransaction("a file name line", self._name)
+        self._file.close()
+        os.chmod(self._temporary, 0644)
+        os.rename(self._temporary, self.filename)
+        return self.filename
+
+    def abort(self):
+        """ Discard the partly received file """
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._temporary)
+
+
+def wait(done):
+    """
+    Return the result of a WorkerPool task from its completion queue, or
+    raise the exception the task raised
+    """
+    while True:
+        try:
+            (result, error) = done.get(timeout=0.5)
+            break
+        except Queue.Empty:
+            continue  # a timeout keeps the wait interruptible with Ctrl-C
+    if error is not None:
+        raise error
+    return result
+
+
+class WorkerPool(object):
+    """
+    A fixed set of worker threads for the file system work of transfers the
+    ERC starts, so the thread speaking the protocol never waits on storage.
+    Tasks submitted with the same key run in order on the same worker. A
+    task's result, or exception, is put on the completion queue given with
+    it; tasks submitted without one are only logged if they fail
+    """
+    queues = None
+
+    def __init__(self, workers=2, depth=64):
+        self.queues = [Queue.Queue(depth) for _ in range(workers)]
+        for tasks in self.queues:
+            worker = threading.Thread(target=self.work, args=(tasks,))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Queue function(*args) on the worker for key, return the completion
+        queue (the done keyword argument, if given). This blocks only if
+        that worker is already depth tasks behind
+        """
+        done = kwargs.get("done")
+        self.queues[hash(key) % len(self.queues)].put((function, args, done))
+        return done
+
+    @staticmethod
+    def work(tasks):
+        """ Worker thread: run tasks in order, hand back each outcome """
+        while True:
+            (function, args, done) = tasks.get()
+            try:
+                outcome = (function(*args), None)
+            except Exception as error:
+                outcome = (None, error)
+            if done is not None:
+                done.put(outcome)
+            elif outcome[1] is not None:
+                warn("background {} failed: {}", function.__name__,
+                     outcome[1], force=True)
+
+
+class PooledIncomingFile(object):
+    """
+    An IncomingFile written by a WorkerPool: each block is handed to a
+    worker, so the next block can be acknowledged straight away. filename
+    waits for the worker to finish the file
+    """
+    pool = None
+    incoming = None
+    error = None  # the first error writing the file, raised by close
+    done = None
+
+    def __init__(self, pool, incoming):
+        self.pool = pool
+        self.incoming = incoming
+
+    def write(self, data):
+        """ Queue the body data of the next block """
+        self.pool.submit(self, self._write, data)
+
+    def close(self):
+        """ Queue finishing the file """
+        self.done = self.pool.submit(self, self._close, done=Queue.Queue(1))
+
+    def abort(self):
+        """ Queue discarding the partly received file """
+        self.pool.submit(self, self.incoming.abort)
+
+    def _write(self, data):
+        """ Worker side of write() """
+        if self.error is None:
+            try:
+                self.incoming.write(data)
+            except (IOError, OSError) as error:
+                self.error = error
+
+    def _close(self):
+        """ Worker side of close() """
+        if self.error is not None:
+            self.incoming.abort()
+            raise self.error
+        return self.incoming.close()
+
+    @property
+    def filename(self):
+        """ The name the file was saved under, once it is saved """
+        return wait(self.done)
+
+
 class ERC(object):
     """ Interface to the yasnac ERC series robots """
     handlers = None
     link = None
+    settings = None  # the linksettings the link was opened with
     ack_bit = False
-
-    def __init__(self):
+    last_error = None
+    reverse_interrupt = False  # the ERC sent RVI: it has data of its own
+    pending_message = None  # what the ERC sent after an RVI, not yet read
+    check_jobs = True  # check jobs with jobcheck before sending them
+    workers = 2  # threads doing the file system work of loop()
+    pool = None  # the WorkerPool while loop() runs
+    bytes_read = 0  # totals over the session, to measure commands by
+    bytes_written = 0
+
+    # link retry policy
+    reply_timeout = 3.0  # seconds to wait for an acknowledgement or block
+    response_timeout = 60.0  # seconds for the ERC to begin answering
+    max_retries = 5  # retransmissions after NAK, a wrong ACK or a timeout
+    max_wait = 30.0  # seconds to keep polling an ERC that replies WACK
+    backoff = 0.1  # initial delay between WACK polls, doubles each time
+    max_backoff = 2.0
+
+    def __init__(self, port=None, baudrate=None, parity=None, stopbits=None):
+        """
+        Open the link. Settings left as None are found by
+        linksettings.resolve: the environment, the config file, the setting
+        motoprobe recorded for the port, or /dev/ttyS0 at 9600 8E1
+        """
         self.handlers = dict({
             # Incoming files
             '02,001': self.handle_incoming_file,
@@ -431,30 +758,40 @@ class ERC(object):
             '02,073': self.handle_file_request,
             '02,080': self.handle_file_request,
         })
-        self.link = serial.Serial(port='/dev/ttyS0',
-                                  baudrate=9600,
-                                  bytesize=8,
-                                  parity=serial.PARITY_EVEN,
-                                  stopbits=serial.STOPBITS_ONE,
-                                  timeout=None)
+        self.settings = linksettings.resolve(port=port, baudrate=baudrate,
+                                             parity=parity, stopbits=stopbits)
+        warn("opening {}", linksettings.describe(self.settings))
+        self.link = linksettings.open_link(self.settings)
         self.ack_bit = False
+        flightrecorder.RECORDER.install()
 
-    def raw_read(self):
-        """ Return the contents of incoming raw data on the serial port """
+    def raw_read(self, timeout=None):
+        """
+        Return the contents of incoming raw data on the serial port. With a
+        timeout, return "" if nothing arrives within that many seconds
+        """
         input_buffer = []
+        deadline = None if timeout is None else time.time() + timeout
         while not self.link.inWaiting():
+            if deadline is not None and time.time() >= deadline:
+                warn("raw_read timed out after {}s", timeout)
+                return ""
             time.sleep(0.05)
         while self.link.inWaiting():
             input_buffer.append(self.link.read(size=self.link.inWaiting()))
             time.sleep(0.015)
         result = "".join(input_buffer)
-        warn("raw_read {} bytes: {!r}".format(len(result), result))
+        self.bytes_read += len(result)
+        flightrecorder.record(flightrecorder.READ, result)
+        warn("raw_read {} bytes: {!r}", len(result), result)
         return result
 
     def raw_write(self, message):
         """ Send raw data on the serial port """
         self.link.write(message)
-        warn("raw_write {} bytes: {!r}".format(len(message), message))
+        self.bytes_written += len(message)
+        flightrecorder.record(flightrecorder.WRITE, message)
+        warn("raw_write {} bytes: {!r}", len(message), message)
 
     def current_ack(self):
         """ Return the appropriate ACK message, flip self.ack_bit """
@@ -477,43 +814,158 @@ class ERC(object):
         """ receive an EOT control character, which resets the ACK bit """
         if read_from_wire:
             # There should be an EOT on the wire. Drain it.
-            raw_block = self.raw_read()
+            raw_block = self.read_block()
             if raw_block != EOT:
                 raise InvalidTransaction("EOT", raw_block)
         self.ack_bit = False
 
     def send_handshake(self):
-        """ Ping the robot """
-        # send ENQ then listen for an ACK0/ACK1
-        self.raw_write(ENQ)
-        expected_reply = self.current_ack()
-        raw_block = self.raw_read()
-        if raw_block != expected_reply:
-            raise InvalidTransaction(expected_reply, raw_block)
-        return True
-
-    def receive_handshake(self):
-        """ Ping the robot """
-        expected_input = ENQ
-        raw_block = self.raw_read()
-        if raw_block != expected_input:
-            raise InvalidTransaction(expected_input, raw_block)
+        """
+        Ping the robot. If it answers RVI it has a message of its own: that
+        is received first (see receive_interrupt), then the handshake is
+        tried again
+        """
+        while True:
+            # send ENQ then listen for an ACK0/ACK1
+            self.raw_write(ENQ)
+            self.await_ack(ENQ)
+            if not self.reverse_interrupt:
+                return True
+            self.send_eot()
+            self.receive_interrupt()
+
+    def receive_handshake(self, timeout=None):
+        """
+        Wait for the ERC to open a message with ENQ, for up to timeout
+        seconds (the default is response_timeout; -1 waits forever), and
+        acknowledge it. Raise TransmissionFailed if it doesn't
+        """
+        if timeout is None:
+            timeout = self.response_timeout
+        raw_block = self.raw_read(None if timeout < 0 else timeout)
+        if not raw_block:
+            raise TransmissionFailed(
+                "no message from the ERC within {}s".format(timeout))
+        if raw_block != ENQ:
+            raise InvalidTransaction(ENQ, raw_block)
         self.send_ack()
         return True
 
+    def receive_interrupt(self):
+        """
+        After an RVI and our EOT, receive the message the ERC wanted to send
+        and keep it in pending_message, for next_message or loop() to pick
+        up. Clear reverse_interrupt and return the message
+        """
+        self.reverse_interrupt = False
+        self.receive_handshake(self.reply_timeout)
+        self.pending_message = self.read_message()
+        warn("received {} after RVI", self.pending_message.header)
+        return self.pending_message
+
+    def next_message(self, sink=None, timeout=None):
+        """
+        Return the next message from the ERC: one received after an RVI, or
+        else the next one on the wire (see receive_handshake for timeout)
+        """
+        if self.pending_message is not None:
+            (message, self.pending_message) = (self.pending_message, None)
+            return message
+        self.receive_handshake(timeout)
+        return self.read_message(sink=sink)
+
     def confirmed_write(self, block):
         """ Send the given block, wait for the appropriate ack """
-        confirmed = False
-        while not confirmed:
-            self.raw_write(block)
-            expected_ack = self.current_ack()
-            raw_block = self.raw_read()
+        self.raw_write(block)
+        return self.await_ack(block)
+
+    def await_ack(self, sent):
+        """
+        Wait for the acknowledgement of what was just sent, then flip the ack
+        bit. The expected ACK0/ACK1, or RVI, confirms it. WACK means the ERC
+        is busy: it is polled with ENQ at a growing interval. NAK, the wrong
+        ACK or no reply within reply_timeout resends it. Raise
+        TransmissionFailed when the retry policy is exhausted
+        """
+        expected_ack = ACK1 if self.ack_bit else ACK0
+        (retries, waited, delay) = (0, 0.0, self.backoff)
+        while True:
+            raw_block = self.raw_read(self.reply_timeout)
             if raw_block == expected_ack:
-                confirmed = True
+                break
+            if raw_block == RVI:
+                warn("received RVI, the ERC has data to send")
+                self.reverse_interrupt = True
+                break
+            if raw_block == EOT:
+                self.ack_bit = False
+                raise TransmissionFailed("the ERC ended the transmission")
+            if raw_block == WACK:
+                if waited >= self.max_wait:
+                    raise TransmissionFailed(
+                        "the ERC stayed busy (WACK) for {:.1f}s".format(waited))
+                time.sleep(delay)
+                waited += delay
+                delay = min(delay * 2, self.max_backoff)
+                self.raw_write(ENQ)
+                continue
+
+            retries += 1
+            if retries > self.max_retries:
+                raise TransmissionFailed(
+                    "no {} after {} retries; last reply:{!r}".format(
+                        CONTROL_CHARS[expected_ack], self.max_retries,
+                        CONTROL_CHARS.get(raw_block, raw_block)))
+            warn("wrong ack, will retry ({}/{}); got:{!r} expected:{!r}",
+                 retries, self.max_retries, raw_block, expected_ack)
+            self.raw_write(sent)
+        self.ack_bit = not self.ack_bit
+        return True
+
+    def read_block(self):
+        """
+        Return the next raw block of an incoming message. A TTD (the ERC is
+        delayed) is answered with NAK, an ENQ (the ERC missed our reply) with
+        the last ACK sent
+        """
+        while True:
+            raw_block = self.raw_read(self.reply_timeout)
+            if not raw_block:
+                raise TransmissionFailed(
+                    "the ERC stopped sending for {}s in the middle of a "
+                    "message".format(self.reply_timeout))
+            if raw_block == TTD:
+                self.raw_write(NAK)
+            elif raw_block == ENQ:
+                self.raw_write(ACK0 if self.ack_bit else ACK1)
             else:
-                warn("wrong ack? will retry.; got:{!r} expected:{!r}".format(
-                    raw_block, expected_ack))
-        return confirmed
+                return raw_block
+
+    def decode_block(self, raw_block):
+        """
+        Decode a raw block of an incoming message. An incomplete block is
+        completed from the wire; if it is damaged, reply NAK so the ERC
+        resends it, up to max_retries times
+        """
+        retries = 0
+        while True:
+            try:
+                return decode(raw_block)
+            except InvalidBlockNeedMore:
+                more = self.raw_read(self.reply_timeout)
+                if more:
+                    raw_block += more
+                    continue
+                reason = "incomplete block"
+            except (InvalidBlockBody, InvalidBlockChecksum) as error:
+                reason = "damaged block ({!r})".format(error)
+            retries += 1
+            if retries > self.max_retries:
+                raise TransmissionFailed("{} after {} retries".format(
+                    reason, self.max_retries))
+            warn("{}, sending NAK", reason)
+            self.raw_write(NAK)
+            raw_block = self.read_block()
 
     def short_message(self, header, body, autofix=True):
         """
@@ -525,6 +977,8 @@ class ERC(object):
         self.send_handshake()
         self.confirmed_write(encode(header, body)[0])
         self.send_eot()
+        if self.reverse_interrupt:
+            self.receive_interrupt()
 
     def handle_incoming_file(self, message, confirm=True):
         """
@@ -532,13 +986,16 @@ class ERC(object):
         - save the file to disk
         - send a properly formatted reply message to the yasnac
         """
-        (name, _, content) = message.body.partition('\r')
-        filename = name + header_extension_lookup(message.header)
-        # fixme: safety-check the filename
+        if isinstance(message.body, (IncomingFile, PooledIncomingFile)):
+            # already streamed to disk by read_message
+            filename = message.body.filename
+        else:
+            (filename, content) = parse_incoming_file(message)
+            # fixme: safety-check the filename
 
-        # Write the file
-        with open(filename, "w") as fileout:
-            fileout.write(content)
+            # Write the file
+            with open(filename, "w") as fileout:
+                fileout.write(content)
 
         if confirm:
             # Now we send back the higher-level transfer confirmation...
@@ -548,50 +1005,155 @@ class ERC(object):
 
     def handle_file_request(self, message):
         """
-        Handle a  a file request from the ERC system
+        Handle a  a file request from the ERC system. The file is looked up,
+        read and framed (by the worker pool, when loop() runs) while the
+        handshake for the reply is in progress
         """
         requested_name = message.body.strip()
         filename = requested_name + header_extension_lookup(message.header)
         # fixme: safety-check the filename
 
+        if self.pool is None:
+            prepared = self.prepare_file(filename)
+            self.send_handshake()
+        else:
+            done = self.pool.submit(filename, self.prepare_file, filename,
+                                    done=Queue.Queue(1))
+            self.send_handshake()
+            prepared = wait(done)
+
+        if isinstance(prepared, str):
+            # an error code instead of the file's blocks
+            self.send_message_blocks(encode("90,000", prepared + "\r"))
+            return None
+
+        if not self.send_message_blocks(prepared):
+            log("The ERC interrupted {}, it was not sent".format(filename))
+            return None
+        return filename
+
+    def prepare_file(self, filename):
+        """
+        Return the framed blocks of a file the ERC asked for, or the error
+        code to answer with if it doesn't exist or is a faulty job
+        """
         if not os.path.exists(filename):
             log('ERC requested nonexistant file: ' + filename)
-            self.short_message("90,000", "4040")
-            return
+            return "4040"
+        with open(filename) as inputfh:
+            content = inputfh.read()
+        if self.check_jobs and jobcheck.is_job(filename):
+            problems = jobcheck.check(content, filename_to_rootname(filename))
+            for problem in problems:
+                log("{}: {}".format(filename, jobcheck.describe(problem)))
+            problems = jobcheck.faults(problems)
+            if problems:
+                return problems[0].code
+        return list(encode_file(header_code_lookup("put", filename),
+                                filename, content.splitlines()))
 
-        self.put_file(filename, confirm=False)
+    def get_file(self, filename, header=None):
+        """ Request file data from the ERC, save it to the current directory """
+        message = self.request_file(filename, header, self.incoming_file)
+        return message.body.filename if message else None
 
-        return filename
+    def fetch_file(self, filename, header=None):
+        """
+        Request file data from the ERC, return the received (filename,
+        content) without saving it. Return None if the ERC replies with an
+        error code instead, which is kept in last_error
+        """
+        message = self.request_file(filename, header)
+        return parse_incoming_file(message) if message else None
 
-    def get_file(self, filename, header=None):
-        """ Request file data from the ERC """
+    def request_file(self, filename, header=None, sink=None):
+        """
+        Request file data from the ERC, return the incoming file Message
+        (read with the given read_message sink), or None if the ERC replies
+        with an error code instead, which is kept in last_error
+        """
         if not header:
             header = header_code_lookup("get", filename)
         self.short_message(header, filename_to_rootname(filename))
-
-        # The response is an incoming file transfer
-        self.receive_handshake()
-        message = self.read_message()
-        return self.handle_incoming_file(message, confirm=False)
+        self.last_error = None
+
+        # The response is an incoming file transfer, or an error message
+        message = self.next_message(sink=sink)
+        if message.header == "90,000":
+            self.last_error = message.body.strip()
+            warn("ERROR from ERC system: {}".format(ERRORS.get(
+                self.last_error, "Unknown error " + self.last_error)))
+            return None
+        return message
+
+    def incoming_file(self, header):
+        """
+        read_message sink: stream incoming file messages to the current
+        directory, keep any other message in memory
+        """
+        if header.startswith("02,") and \
+                TRANSACTIONS.get(header, "").startswith("put "):
+            if self.pool is not None:
+                return PooledIncomingFile(self.pool, IncomingFile(header))
+            return IncomingFile(header)
+        return None
 
     def put_file(self, filename, header=None, confirm=True):
         """
         Send the given file to the ERC with an automatically resolved header
-        code
+        code. The file is read, name fixed and framed as it is sent
         """
-        if not header:
-            header = header_code_lookup("put", filename)
+        with open(filename) as inputfh:
+            if self.check_jobs and jobcheck.is_job(filename):
+                content = inputfh.read()
+                if self.refuse_bad_job(filename, content):
+                    return False
+                return self.send_lines(filename, content.splitlines(), header,
+                                       confirm)
+            return self.send_lines(filename, inputfh, header, confirm)
+
+    def send_file(self, filename, content, header=None, confirm=True):
+        """
+        Send the given content to the ERC as the named file, with an
+        automatically resolved header code
+        """
+        if self.check_jobs and jobcheck.is_job(filename) and \
+                self.refuse_bad_job(filename, content):
+            return False
+        return self.send_lines(filename, content.splitlines(), header,
+                               confirm)
 
-        rootname = filename_to_rootname(filename)
+    def refuse_bad_job(self, filename, content):
+        """
+        Check a job before it is sent. If it has problems the ERC would
+        reject, print them, keep the error code the ERC would have given in
+        last_error and return True
+        """
+        problems = jobcheck.check(content, filename_to_rootname(filename))
+        for problem in problems:
+            warn("{}: {}".format(filename, jobcheck.describe(problem)),
+                 force=True)
+        problems = jobcheck.faults(problems)
+        if not problems:
+            return False
+        self.last_error = problems[0].code
+        warn("{} was not sent: {}".format(filename, ERRORS.get(
+            self.last_error)), force=True)
+        return True
 
-        with open(filename) as inputfh:
-            data = namefix(rootname, inputfh.read())
-        payload = rootname + "\r" + data
+    def send_lines(self, filename, lines, header=None, confirm=True):
+        """
+        Send the given iterable of lines to the ERC as the named file. Each
+        block is framed while the ERC checks the previous one, so only one
+        block of the file is ever held in memory
+        """
+        if not header:
+            header = header_code_lookup("put", filename)
 
-        self.send_handshake()
-        for block in encode(header, payload, name_block=True):
-            self.confirmed_write(block)
-        self.send_eot()
+        if not self.send_blocks(encode_file(header, filename, lines)):
+            raise TransmissionFailed(
+                "the ERC interrupted {}, only part of it was sent".format(
+                    filename))
 
         if confirm:
             # at this point the ERC will send a confirmation message
@@ -599,13 +1161,50 @@ class ERC(object):
 
         return True
 
+    def send_blocks(self, blocks):
+        """
+        Handshake, send each block of the given iterable as soon as the last
+        one is acknowledged, send EOT. The next block is produced while the
+        ERC acknowledges the current one. Return False if the ERC
+        interrupted the message before its last block (see
+        send_message_blocks), True if all of it was sent
+        """
+        self.send_handshake()
+        return self.send_message_blocks(blocks)
+
+    def send_message_blocks(self, blocks):
+        """
+        After the handshake: send each block of the given iterable as soon
+        as the last one is acknowledged, then EOT. If the ERC answers a
+        block with RVI, the rest of the message is not sent: the ERC's own
+        message is received instead (see receive_interrupt) and False is
+        returned
+        """
+        blocks = iter(blocks)
+        block = next(blocks)
+        while block is not None:
+            self.raw_write(block)
+            following = next(blocks, None)
+            self.await_ack(block)
+            if self.reverse_interrupt and following is not None:
+                warn("RVI: the ERC interrupted the message", force=True)
+                self.send_eot()
+                self.receive_interrupt()
+                return False
+            block = following
+        self.send_eot()
+        if self.reverse_interrupt:
+            self.receive_interrupt()
+        return True
+
     def execute_command(self, command_string):
         """ Issue a system control or status read command """
         if not command_string.endswith("\r"):
             command_string += "\r"
 
         self.short_message("01,000", command_string)
-        result = self.receive_execution_response()
+        result = self.receive_execution_response(
+            command_timeout(command_string, self.response_timeout))
         if type(result) != list:
             # this error condition was already warned about, this prevents
             # the error string from being interpreted as a result
@@ -614,12 +1213,101 @@ class ERC(object):
 
         return result
 
-    def receive_execution_response(self):
-        """ Receive an incoming 90,00x message, return the contained data """
+    def get_variable(self, kind, number):
+        """
+        Read a single variable from the ERC. kind is a VARIABLE_TYPES key such
+        as "byte" or "pulse"
+        """
+        return self.get_variables(kind, number, 1)[0]
+
+    def get_variables(self, kind, start, count):
+        """
+        Read count consecutive variables from the ERC, starting at the given
+        variable number. Scalar kinds are returned as an array, position kinds
+        as a list of arrays (one array of axis values per variable)
+
+        The ERC answers each 03,05x request with exactly one variable, so
+        the requests are issued back to back over the open link. The first
+        request the ERC refuses ends the range with InvalidTransaction; its
+        error code is kept in last_error
+        """
+        header = variable_header_lookup("get", kind)
+        values = dict()
+        for number in xrange(start, start + count):
+            self.short_message(header, str(number))
+            values.update(self.receive_variable_response(kind))
+            if number not in values:
+                raise InvalidTransaction(
+                    "{} variable {}".format(kind, number),
+                    "no value" if self.last_error is None else
+                    "error {}: {}".format(self.last_error, ERRORS.get(
+                        self.last_error, "unknown error")))
+
+        result = [values[number] for number in xrange(start, start + count)]
+        if kind in SCALAR_VARIABLES:
+            result = array.array(VARIABLE_TYPES[kind][1], result)
+        return result
+
+    def put_variable(self, kind, number, value):
+        """
+        Write a single variable to the ERC. Position values are given as a
+        sequence of axis values
+        """
+        return self.put_variables(kind, number, [value])
+
+    def put_variables(self, kind, start, values):
+        """
+        Write a range of consecutive variables to the ERC, starting at the
+        given variable number. All of the variables are sent as the lines of a
+        single 03,00x message, so the whole range costs one handshake
+        """
+        header = variable_header_lookup("put", kind)
+        lines = [format_variable(kind, start + index, value)
+                 for index, value in enumerate(values)]
+        payload = "\r".join(lines) + "\r"
+
+        if not self.send_blocks(encode(header, payload)):
+            raise TransmissionFailed(
+                "the ERC interrupted the {} variables, only some were "
+                "sent".format(kind))
+
+        return self.receive_execution_response()
+
+    def receive_variable_response(self, kind):
+        """
+        Receive the incoming 03,00x message answering a variable request,
+        return a dict mapping variable numbers to values. An error reply
+        gives an empty dict, and its code is kept in last_error
+        """
+        result = dict()
+        self.last_error = None
+
+        message = self.next_message()
+        if message.header == "90,000":
+            body = message.body.strip()
+            self.last_error = body
+            error_string = ERRORS.get(body, "Unknown error " + body)
+            warn("ERROR from ERC system: {}".format(error_string))
+            return result
+        if message.header != variable_header_lookup("put", kind):
+            raise InvalidTransaction("{} variable data".format(kind), message)
+
+        for line in message.body.splitlines():
+            if line.strip():
+                (number, value) = parse_variable(kind, line)
+                result[number] = value
+
+        return result
+
+    def receive_execution_response(self, timeout=None):
+        """
+        Receive an incoming 90,00x message, return the contained data. See
+        receive_handshake for timeout
+        """
         result = None
+        self.last_error = None
 
-        self.receive_handshake()
-        message = self.read_message()
+        message = self.next_message(timeout=timeout)
         body = message.body.strip()
         if message.header == "90,001":
             # join all the body lines together, split the result on commas
@@ -627,15 +1315,21 @@ class ERC(object):
         elif message.header != "90,000":
             raise InvalidTransaction("confirmation or error message", message)
         elif body != '0000':
+            self.last_error = body
             error_string = ERRORS.get(body, "Unknown error " + body)
             result = warn("ERROR from ERC system: {}".format(error_string))
 
         return result
 
-    def read_message(self, raw_block=None):
-        """ Read a complete message from the wire, including multi-block """
+    def read_message(self, raw_block=None, sink=None):
+        """
+        Read a complete message from the wire, including multi-block. sink is
+        an optional callable given the message header, which may return an
+        object (such as an IncomingFile) to receive the body block by block
+        with write() and close(); that object is then the message body
+        """
         if not raw_block:
-            raw_block = self.raw_read()
+            raw_block = self.read_block()
 
         if not (raw_block.startswith(SOH) or raw_block.startswith(STX)):
             if raw_block in CONTROL_CHARS:
@@ -644,24 +1338,48 @@ class ERC(object):
                 raise InvalidBlockStart("Block starts with invalid sequence: "
                                         + raw_block.__repr__())
 
-        block = decode(raw_block)
-        body = block.body
+        block = self.decode_block(raw_block)
         first_header = block.header
-        self.send_ack()
-
-        while block.footer == ETB:
-            # ETB means there is more message data in subsequent blocks
-            block = decode(self.raw_read())
-            body += block.body
-            self.send_ack()
-
-        self.receive_eot()
-
-        return Message(body, first_header, block.footer)
+        target = sink(first_header) if sink else None
+        body = list()
+        try:
+            while True:
+                if target is None:
+                    body.append(block.body)
+                else:
+                    target.write(block.body)
+                self.send_ack()
+                if block.footer != ETB:
+                    break
+                # ETB means there is more message data in subsequent blocks
+                block = self.decode_block(self.read_block())
+
+            self.receive_eot()
+            if target is not None:
+                target.close()
+        except BaseException:
+            if target is not None:
+                target.abort()
+            raise
+
+        if target is not None:
+            return Message(target, first_header, block.footer)
+        return Message("".join(body), first_header, block.footer)
 
     def loop(self):
-        """ A continuous event loop for handling ERC serial IO """
+        """
+        A continuous event loop for handling ERC serial IO. This thread only
+        speaks the protocol; reading, framing and writing files is done by
+        a pool of worker threads
+        """
+        if self.pool is None:
+            self.pool = WorkerPool(self.workers)
         while True:
+            if self.pending_message is not None:
+                # the ERC's message that interrupted one of ours
+                self.dispatch(self.next_message())
+                continue
+
             raw_block = self.raw_read()
 
             # raw block handlers
@@ -675,13 +1393,16 @@ class ERC(object):
                 continue
 
             if not raw_block.startswith(SOH):
-                warn("No handler for block: " + raw_block.__repr__())
+                warn("No handler for block: {!r}", raw_block)
                 continue
 
             # message handlers (block begins with SOH)
-            message = self.read_message(raw_block)
-            if message.header in self.handlers:
-                result = self.handlers[message.header](message)
-                log("handled {}, result: {!r}".format(message.header, result))
-            else:
-                warn("no handler for message " + message.header)
+            self.dispatch(self.read_message(raw_block, self.incoming_file))
+
+    def dispatch(self, message):
+        """ Pass a message from the ERC to its handler """
+        if message.header in self.handlers:
+            result = self.handlers[message.header](message)
+            log("handled {}, result: {!r}".format(message.header, result))
+        else:
+            warn("no handler for message {}", message.header)
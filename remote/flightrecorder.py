@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+A flight recorder for serial link events
+
+Every raw read and write is copied into a fixed-size binary ring buffer, at
+the cost of one struct.pack_into and one slice assignment. Nothing is
+formatted until the buffer is dumped, which happens automatically on an
+uncaught exception once install() is called, so the last moments before a
+field failure can be examined without running in debug mode. Run this
+module with a dump file name to print a dump.
+"""
+import struct
+import sys
+import time
+
+READ = 1
+WRITE = 2
+NOTE = 3
+KIND_NAMES = {READ: "read", WRITE: "write", NOTE: "note"}
+
+MAGIC = "YFR1"
+FILE_HEADER = struct.Struct("<4sII")  # magic, slot count, slot size
+SLOT_HEADER = struct.Struct("<dBxH")  # time, kind, original data length
+
+
+class FlightRecorder(object):
+    """ A ring buffer of the most recent link events, in fixed-size slots """
+    slots = 0
+    slot_size = 0
+    buffer = None
+    count = 0  # events recorded since the start
+    installed = False  # install() has hooked sys.excepthook
+    _payload = 0
+
+    def __init__(self, slots=1024, slot_size=288):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._payload = slot_size - SLOT_HEADER.size
+        self.buffer = bytearray(slots * slot_size)
+
+    def record(self, kind, data):
+        """ Store an event; data longer than a slot is truncated """
+        offset = (self.count % self.slots) * self.slot_size
+        SLOT_HEADER.pack_into(self.buffer, offset, time.time(), kind,
+                              min(len(data), 0xffff))
+        data = data[0:self._payload]
+        start = offset + SLOT_HEADER.size
+        self.buffer[start:start + len(data)] = data
+        self.count += 1
+
+    def ordered(self):
+        """ Return the used slots as one string, oldest event first """
+        used = min(self.count, self.slots) * self.slot_size
+        split = (self.count % self.slots) * self.slot_size
+        if self.count <= self.slots:
+            return str(self.buffer[0:used])
+        return str(self.buffer[split:] + self.buffer[0:split])
+
+    def events(self):
+        """ Return the recorded (time, kind, data) tuples, oldest first """
+        return list(parse_slots(self.ordered(), self.slot_size))
+
+    def dump(self, filename=None):
+        """ Write the buffer to a dump file, return the file name """
+        if filename is None:
+            filename = time.strftime("flightrecord-%Y%m%d-%H%M%S.bin")
+        with open(filename, "wb") as outputfh:
+            outputfh.write(FILE_HEADER.pack(MAGIC, self.slots,
+                                            self.slot_size))
+            outputfh.write(self.ordered())
+        return filename
+
+    def install(self):
+        """
+        Dump the buffer when the program dies of an uncaught exception.
+        Only the first call hooks sys.excepthook, so every link may call it
+        """
+        if self.installed:
+            return
+        self.installed = True
+        previous_hook = sys.excepthook
+
+        def hook(exception_type, value, traceback):
+            """ sys.excepthook: dump, then report as usual """
+            if self.count and exception_type is not KeyboardInterrupt:
+                sys.stderr.write("flight recorder dumped to {}\n".format(
+                    self.dump()))
+            previous_hook(exception_type, value, traceback)
+
+        sys.excepthook = hook
+
+
+def parse_slots(data, slot_size):
+    """ Yield (time, kind, data) for each slot of the given ring contents """
+    payload = slot_size - SLOT_HEADER.size
+    for offset in xrange(0, len(data), slot_size):
+        (timestamp, kind, length) = SLOT_HEADER.unpack_from(data, offset)
+        start = offset + SLOT_HEADER.size
+        yield (timestamp, kind, data[start:start + min(length, payload)])
+
+
+def read_dump(filename):
+    """ Return the (time, kind, data) events of a dump file """
+    with open(filename, "rb") as inputfh:
+        (magic, _, slot_size) = FILE_HEADER.unpack(
+            inputfh.read(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a flight recorder dump".format(
+                filename))
+        return list(parse_slots(inputfh.read(), slot_size))
+
+
+# the recorder shared by the erc library and motodisk
+RECORDER = FlightRecorder()
+record = RECORDER.record
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        events = read_dump(path)
+        for (timestamp, kind, data) in events:
+            print "{:.3f} +{:7.3f} {:5} {!r}".format(
+                timestamp, timestamp - events[0][0],
+                KIND_NAMES.get(kind, kind), data)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Library for reading and writing ERC job (.JBI/.JBR) files
+"""
+import collections
+import os
+import re
+
+POSITION_LINE = re.compile(r'^([A-Z]+)(\d+)=(.*)$')
+
+Instruction = collections.namedtuple("Instruction", 'opcode args tags line')
+
+
+def parse_instruction(line):
+    """
+    Split an instruction line into an Instruction, for example
+    "MOVJ C000 VJ=25.00 CONT" has the opcode "MOVJ", the args
+    ["C000", "CONT"] and the tags {"VJ": "25.00"}. Label lines such as "*1"
+    have the label as their opcode
+    """
+    words = line.split()
+    args = list()
+    tags = collections.OrderedDict()
+    for word in words[1:]:
+        (key, equals, value) = word.partition("=")
+        if equals and key.isalpha() and key != "IF":
+            tags[key] = value
+        else:
+            args.append(word)
+    return Instruction(words[0] if words else "", args, tags, line)
+
+
+def job_reference(instruction):
+    """
+    Return the name of the job referenced by a CALL JOB:NAME or JUMP JOB:NAME
+    instruction, or None
+    """
+    if instruction.opcode in ("CALL", "JUMP"):
+        for arg in instruction.args:
+            if arg.startswith("JOB:"):
+                return arg[4:]
+    return None
+
+
+def job_dependencies(job):
+    """ Return the sorted names of the jobs the given Job CALLs or JUMPs to """
+    return sorted(set(name for name in (
+        job_reference(instruction) for instruction
+        in job.parsed_instructions()) if name))
+
+
+class Job(object):
+    """
+    A parsed job file. The original lines are kept, so that dumps() returns
+    the job unchanged apart from any positions altered with set_position()
+    """
+    name = None
+    lines = None
+    positions = None
+    _position_lines = None
+
+    def __init__(self, content):
+        self.lines = content.splitlines()
+        self.positions = collections.OrderedDict()
+        self._position_lines = dict()
+
+        section = None
+        for index, line in enumerate(self.lines):
+            if line.startswith("//NAME "):
+                self.name = line[7:].strip()
+            if line.startswith("//") and not line.startswith("///"):
+                section = line[2:].split(" ", 1)[0]
+                continue
+            if section == "POS":
+                match = POSITION_LINE.match(line)
+                if match:
+                    name = "{}{}".format(match.group(1), match.group(2))
+                    self.positions[name] = match.group(3).split(",")
+                    self._position_lines[name] = index
+
+    def header(self, key):
+        """
+        Return the value of the first ///key header line, for example
+        header("TOOL") returns "0"; return None if there is no such line
+        """
+        prefix = "///{} ".format(key)
+        for line in self.lines:
+            if line.startswith(prefix):
+                return line[len(prefix):].strip()
+            if line == "///" + key:
+                return ""
+        return None
+
+    def set_header(self, key, value):
+        """ Replace the value of the first ///key header line """
+        prefix = "///{} ".format(key)
+        for index, line in enumerate(self.lines):
+            if line.startswith(prefix) or line == "///" + key:
+                self.lines[index] = prefix + str(value)
+                return
+        raise KeyError(key)
+
+    @property
+    def frame(self):
+        """ Return "PULSE" or "RECTAN", the form of the position data """
+        for key in ("PULSE", "RECTAN"):
+            if self.header(key) is not None:
+                return key
+        return None
+
+    @property
+    def npos(self):
+        """ Return the ///NPOS position counts as a list of integers """
+        value = self.header("NPOS")
+        return [int(count) for count in value.split(",")] if value else []
+
+    @property
+    def instructions(self):
+        """ Return the instruction lines of the job (those after //INST) """
+        result = list()
+        in_instructions = False
+        for line in self.lines:
+            if line.startswith("//INST"):
+                in_instructions = True
+                continue
+            if in_instructions and not line.startswith("/") and line.strip():
+                result.append(line)
+        return result
+
+    def parsed_instructions(self):
+        """ Return the instruction lines as a list of Instructions """
+        return [parse_instruction(line) for line in self.instructions]
+
+    def position_names(self, prefix="C"):
+        """ Return the names of the positions with the given prefix """
+        return [name for name in self.positions
+                if name.rstrip("0123456789") == prefix]
+
+    def position_values(self, prefix="C"):
+        """
+        Return the values of the positions with the given prefix as a list
+        of lists of floats; empty fields are returned as 0.0
+        """
+        return [[float(field or 0) for field in self.positions[name]]
+                for name in self.position_names(prefix)]
+
+    def set_position(self, name, fields):
+        """ Replace the fields of the named position """
+        fields = [str(field) for field in fields]
+        self.positions[name] = fields
+        self.lines[self._position_lines[name]] = "{}={}".format(
+            name, ",".join(fields))
+
+    def dumps(self):
+        """ Return the job file content with \r\n line endings """
+        return "\r\n".join(self.lines) + "\r\n"
+
+
+def read_job(filename):
+    """ Return a Job parsed from the named file """
+    with open(filename) as inputfh:
+        return Job(inputfh.read())
+
+
+def job_files(directory):
+    """ Return the sorted paths of the job files in the given directory """
+    return sorted(os.path.join(directory, filename)
+                  for filename in os.listdir(directory)
+                  if os.path.splitext(filename)[1].upper() in ('.JBI', '.JBR'))
+
+
+def find_job(directory, name):
+    """ Return the path of the named job's .JBI or .JBR file, or None """
+    for extension in (".JBI", ".JBR"):
+        candidate = os.path.join(directory, name + extension)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def dependency_graph(filenames):
+    """
+    Return an OrderedDict mapping job names (file rootnames, as the ERC
+    knows them) to (filename, dependency names) for the given job files and
+    every job they reference, looked up in the directory of the job that
+    references it. Jobs that can't be found map to (None, [])
+    """
+    graph = collections.OrderedDict()
+    pending = [(os.path.splitext(os.path.basename(filename))[0], filename)
+               for filename in filenames]
+    while pending:
+        (name, filename) = pending.pop(0)
+        if name in graph:
+            continue
+        if filename is None:
+            graph[name] = (None, [])
+            continue
+        dependencies = job_dependencies(read_job(filename))
+        graph[name] = (filename, dependencies)
+        directory = os.path.dirname(filename) or "."
+        pending.extend((dependency, find_job(directory, dependency))
+                       for dependency in dependencies)
+    return graph
+
+
+def topological_order(graph):
+    """
+    Return the job names of a dependency_graph() with every job after the
+    jobs it references. Raise ValueError if jobs reference each other in a
+    cycle
+    """
+    order = list()
+    state = dict()  # name -> "visiting" or "done"
+
+    def visit(name, path):
+        """ depth first search, appending each job after its dependencies """
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            cycle = path[path.index(name):] + [name]
+            raise ValueError("jobs reference each other in a cycle: " +
+                             " -> ".join(cycle))
+        state[name] = "visiting"
+        for dependency in graph[name][1]:
+            visit(dependency, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in graph:
+        visit(name, [])
+    return order
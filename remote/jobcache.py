@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+A cached copy of an ERC's job directory (the RJDIR * listing)
+
+The listing is fetched once per session and kept up to date locally as jobs
+are put and deleted. A 4030 (job of same name exists) or 4040 (no desired
+job) reply shows that the copy has gone stale, and it is fetched again. The
+listing can also be kept on disk for a short time, so consecutive commands
+share it.
+"""
+import hashlib
+import json
+import os
+import time
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "yasnac",
+                          "jobdir.json")
+
+UPLOADS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "yasnac",
+                            "uploads.json")
+
+# error codes that mean the job directory changed behind our back
+STALE_ERRORS = ('4030', '4040')
+
+
+class JobDirectory(object):
+    """ The job names on the robot, listed once and then tracked locally """
+    robot = None
+    ttl = 0  # seconds a persisted listing may be reused for, 0 disables it
+    path = None
+    fetched = False  # the listing was read from the robot in this session
+    uploads = None  # the UploadLog of this robot
+    _names = None
+
+    def __init__(self, robot, ttl=0, path=CACHE_PATH):
+        self.robot = robot
+        self.ttl = ttl
+        self.path = path
+        self.uploads = UploadLog(self.key())
+
+    def key(self):
+        """ Identify the robot, so one robot's listing isn't used for another """
+        return robot_key(self.robot)
+
+    def names(self):
+        """ Return the job names, listing them only if no copy is at hand """
+        if self.cached() is None:
+            self.refresh()
+        return list(self._names)
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def refresh(self):
+        """ Read the listing from the robot """
+        self._names = list(self.robot.execute_command("RJDIR *"))
+        self.fetched = True
+        self.save()
+
+    def cached(self):
+        """ Return the listing if one is at hand, without asking the robot """
+        if self._names is None:
+            self._names = self.load()
+        return self._names
+
+    def added(self, name):
+        """ Record a job that was put on the robot """
+        names = self.cached()
+        if names is not None and name not in names:
+            names.append(name)
+            self.save()
+
+    def removed(self, name):
+        """ Record a job that was deleted from the robot """
+        names = self.cached()
+        if names is not None and name in names:
+            names.remove(name)
+            self.save()
+
+    def stale(self, name):
+        """
+        Check the robot's last error code after an operation on the named
+        job. If a 4030 or 4040 contradicts the listing, read it again and
+        return True
+        """
+        error = self.robot.last_error
+        if error not in STALE_ERRORS:
+            return False
+        names = self.cached()
+        if names is not None and (name in names) == (error == '4030'):
+            return False  # the listing already agrees with the error
+        self.refresh()
+        return True
+
+    def absent(self, name):
+        """
+        Return True if the named job isn't on the robot. A listing from an
+        earlier session is confirmed before a job is reported missing
+        """
+        if name in self.names():
+            return False
+        if not self.fetched:
+            self.refresh()
+        return name not in self._names
+
+    def load(self):
+        """ Return the persisted listing if it is recent enough, else None """
+        if not self.ttl:
+            return None
+        try:
+            with open(self.path) as inputfh:
+                cached = json.load(inputfh)
+        except (IOError, ValueError):
+            return None
+        if cached.get("key") != self.key() or \
+                time.time() - cached.get("time", 0) > self.ttl:
+            return None
+        return [str(name) for name in cached["names"]]
+
+    def save(self):
+        """ Persist the listing, if persistence is enabled """
+        if not self.ttl or self._names is None:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, "w") as outputfh:
+                json.dump({"key": self.key(), "time": time.time(),
+                           "names": self._names}, outputfh)
+        except (IOError, OSError):
+            pass  # the cache is only an optimisation
+
+
+def robot_key(robot):
+    """ Return what identifies a robot: the port of its link """
+    return getattr(getattr(robot, "link", None), "port", None)
+
+
+def job_digest(filename):
+    """ Return the SHA-1 of a job file's lines, whatever its line endings """
+    with open(filename) as inputfh:
+        return lines_digest(inputfh)
+
+
+def lines_digest(lines):
+    """ Return the SHA-1 of a job's lines, as job_digest() does """
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line.rstrip("\r\n") + "\r\n")
+    return digest.hexdigest()
+
+
+class UploadLog(object):
+    """
+    The digests of the jobs last put on each robot, which tell whether the
+    robot's copy of a job still matches the local file
+    """
+    key = None
+    path = None
+    _log = None
+
+    def __init__(self, key, path=UPLOADS_PATH):
+        self.key = str(key)
+        self.path = path
+        try:
+            with open(path) as inputfh:
+                self._log = json.load(inputfh)
+        except (IOError, ValueError):
+            self._log = dict()
+
+    def get(self, name):
+        """ Return the digest of the named job as last put, or None """
+        return self._log.get(self.key, {}).get(name)
+
+    def record(self, name, digest):
+        """ Remember the digest of a job that was just put, and persist it """
+        self._log.setdefault(self.key, {})[name] = digest
+        self.save()
+
+    def forget(self, name):
+        """ Remove a job that was deleted from the robot, and persist it """
+        if self._log.get(self.key, {}).pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        """ Write the log """
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, "w") as outputfh:
+                json.dump(self._log, outputfh, indent=1, sort_keys=True)
+        except (IOError, OSError):
+            pass  # without the log, changed jobs are only found by name
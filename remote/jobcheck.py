@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+A static checker for ERC job (.JBI/.JBR) files
+
+The ERC only reports a broken job after all of it has been sent, with one of
+the 5xxx errors (or 4190 for a bad name). check() finds the same faults on
+the host, before anything crosses the wire: the header layout, the job
+name, position data against the ///NPOS counts, NOP and END, the syntax of
+each instruction, the positions and labels it refers to and the range of
+its values. Each fault is reported with the error code the ERC would give.
+Instructions the checker doesn't know are reported as warnings, with no
+code: the ERC may well accept them, so they don't stop a job being sent.
+"""
+import collections
+import os
+import re
+
+import jbi
+
+# the ERC error codes (see erc.ERRORS) reported for each kind of fault
+INSTRUCTION_SYNTAX = '5110'
+POSITION_FAULT = '5120'
+NO_NOP_OR_END = '5130'
+FORMAT_ERROR = '5170'
+DATA_NUMBER = '5180'
+RANGE_EXCEEDED = '5200'
+BAD_JOB_NAME = '4190'
+WARNING = None  # the code of a Problem the ERC may not reject
+
+JOB_NAME = re.compile(r"^[A-Z0-9_\-`'!#$%&()@^{}~]{1,8}$")
+LABEL = re.compile(r'^\*[A-Z0-9_]{1,8}$')
+POSITION = re.compile(r'^([CPE])(\d{3})$')
+VARIABLE = re.compile(r'^([BIDR])(\d{2,3})$')
+CONDITION = re.compile(
+    r'^([BIDR]\d{2,3}|IN#\(\d+\)|OT#\(\d+\))(=|<>|<=|>=|<|>)(\S+)$')
+SIGNAL = re.compile(r'^(IN|OT)#\(\d+\)$')
+NUMBER = re.compile(r'^-?\d+(\.\d*)?$')
+INTEGER = re.compile(r'^-?\d+$')
+
+# the allowed range of each tag value and variable type
+TAG_RANGES = {
+    "VJ": (0.01, 100.0),  # % of the maximum joint speed
+    "V": (0.1, 1500.0),  # mm/s
+    "VR": (0.1, 180.0),  # degrees/s
+    "PL": (0, 4),
+    "T": (0.01, 655.35),  # s
+}
+VARIABLE_RANGES = {
+    "B": (0, 255),
+    "I": (-32768, 32767),
+    "D": (-2147483648, 2147483647),
+    "R": (-3.4e38, 3.4e38),
+}
+VARIABLE_COUNT = 100  # B000-B099 and so on
+
+# opcode -> (required tags, optional tags)
+MOTION = {
+    "MOVJ": (("VJ",), ("PL",)),
+    "MOVL": (("V",), ("PL",)),
+    "MOVC": (("V",), ("PL",)),
+    "MOVS": (("V",), ("PL",)),
+}
+MOTION_WORDS = ("CONT", "NWAIT")
+
+Problem = collections.namedtuple("Problem", 'code line message')
+
+
+def describe(problem):
+    """ Return a one line description of a Problem """
+    code = "warning" if problem.code is WARNING else problem.code
+    if problem.line is None:
+        return "{} ({})".format(problem.message, code)
+    return "line {}: {} ({})".format(problem.line, problem.message, code)
+
+
+def faults(problems):
+    """ Return the Problems the ERC would reject the job for """
+    return [problem for problem in problems if problem.code is not WARNING]
+
+
+def in_range(value, limits):
+    """ Return True if the numeric string value is within (low, high) """
+    return NUMBER.match(value) and limits[0] <= float(value) <= limits[1]
+
+
+class Checker(object):
+    """ The checks of one job; problems accumulate in self.problems """
+    job = None
+    problems = None
+    labels = None
+
+    def __init__(self, job):
+        self.job = job
+        self.problems = list()
+        self.labels = set()
+
+    def problem(self, code, line, message, *args):
+        """ Record a problem; line is an index into job.lines or None """
+        self.problems.append(Problem(
+            code, None if line is None else line + 1, message.format(*args)))
+
+    def check_header(self):
+        """ /JOB, //NAME, //POS, ///NPOS and //INST in that order """
+        lines = self.job.lines
+        if not lines or lines[0] != "/JOB":
+            self.problem(FORMAT_ERROR, 0, 'the job must start with "/JOB"')
+        if len(lines) < 2 or not lines[1].startswith("//NAME "):
+            self.problem(FORMAT_ERROR, 1, 'the second line must be "//NAME"')
+
+        sections = dict((line.split(" ", 1)[0], index)
+                        for index, line in enumerate(lines)
+                        if line.startswith("//") and not line.startswith("///"))
+        for section in ("//POS", "//INST"):
+            if section not in sections:
+                self.problem(FORMAT_ERROR, None, 'there is no "{}" line',
+                             section)
+        if sections.get("//POS", 0) > sections.get("//INST", len(lines)):
+            self.problem(FORMAT_ERROR, sections["//POS"],
+                         '"//POS" must come before "//INST"')
+
+        npos = self.job.header("NPOS")
+        if npos is None:
+            self.problem(FORMAT_ERROR, None, 'there is no "///NPOS" line')
+        elif not all(INTEGER.match(count) for count in npos.split(",")) \
+                or len(npos.split(",")) != 4:
+            self.problem(FORMAT_ERROR, self.line_of("///NPOS"),
+                         '"///NPOS {}" must be four counts', npos)
+
+    def check_name(self, name):
+        """ The job name the ERC will store the job under """
+        if not JOB_NAME.match(name or ""):
+            self.problem(BAD_JOB_NAME, None, 'the job name "{}" must be 1-8 '
+                         'characters: A-Z, 0-9 or {}', name,
+                         "_-`'!#$%&()@^{}~")
+
+    def check_positions(self):
+        """ Each position's fields, and the counts against ///NPOS """
+        frame = self.job.frame
+        if self.job.positions and frame is None:
+            self.problem(FORMAT_ERROR, None, 'positions need a "///PULSE" or '
+                         '"///RECTAN" line')
+        for name, fields in self.job.positions.items():
+            line = self.line_of(name + "=")
+            if not POSITION.match(name):
+                self.problem(POSITION_FAULT, line, "{} is not a position "
+                             "name", name)
+                continue
+            pattern = INTEGER if frame == "PULSE" and name[0] == "C" \
+                else NUMBER
+            if name[0] == "C" and (len(fields) != 6 or not all(
+                    pattern.match(field) for field in fields)):
+                self.problem(POSITION_FAULT, line, "{} must have 6 {}", name,
+                             "pulse counts" if pattern is INTEGER
+                             else "coordinates")
+            elif not all(NUMBER.match(field) for field in fields if field):
+                self.problem(POSITION_FAULT, line, "{} has non-numeric data",
+                             name)
+
+        npos = self.job.header("NPOS") or ""
+        counts = [int(count) for count in npos.split(",")
+                  if INTEGER.match(count)]
+        robot = len(self.job.position_names("C"))
+        if counts and counts[0] != robot:
+            self.problem(DATA_NUMBER, self.line_of("///NPOS"),
+                         "///NPOS gives {} robot positions, there are {}",
+                         counts[0], robot)
+        elif sum(counts) != len(self.job.positions) and len(counts) == 4:
+            self.problem(DATA_NUMBER, self.line_of("///NPOS"),
+                         "///NPOS gives {} positions, there are {}",
+                         sum(counts), len(self.job.positions))
+
+    def check_instructions(self):
+        """ NOP first, END last, then each instruction """
+        instructions = self.instruction_list()
+        opcodes = [instruction.opcode for (_, instruction) in instructions]
+        if not opcodes or opcodes[0] != "NOP" or opcodes[-1] != "END":
+            self.problem(NO_NOP_OR_END, None, "the instructions must start "
+                         "with NOP and finish with END")
+
+        self.labels = set(opcode for opcode in opcodes
+                          if opcode.startswith("*"))
+        for (line, instruction) in instructions:
+            self.check_instruction(line, instruction)
+
+    def instruction_list(self):
+        """ Return (line index, Instruction) for each instruction line """
+        result = list()
+        in_instructions = False
+        for index, line in enumerate(self.job.lines):
+            if line.startswith("//INST"):
+                in_instructions = True
+            elif in_instructions and not line.startswith("/") and line.strip():
+                result.append((index, jbi.parse_instruction(line)))
+        return result
+
+    def check_instruction(self, line, instruction):
+        """ One instruction's operands, references and values """
+        opcode = instruction.opcode
+        args = list(instruction.args)
+        tags = instruction.tags
+
+        if opcode.startswith("*"):
+            if not LABEL.match(opcode) or args or tags:
+                self.problem(INSTRUCTION_SYNTAX, line, '"{}" is not a label',
+                             instruction.line)
+            return
+
+        if "IF" in args:
+            condition = args[args.index("IF") + 1:]
+            del args[args.index("IF"):]
+            if opcode not in ("JUMP", "CALL", "RET", "PAUSE") or \
+                    len(condition) != 1 or not CONDITION.match(condition[0]):
+                self.problem(INSTRUCTION_SYNTAX, line, 'bad condition in "{}"',
+                             instruction.line)
+            else:
+                self.check_variable(line, CONDITION.match(
+                    condition[0]).group(1), CONDITION.match(
+                        condition[0]).group(3))
+
+        for key, value in tags.items():
+            if key in TAG_RANGES and not in_range(value, TAG_RANGES[key]):
+                self.problem(RANGE_EXCEEDED, line, "{}={} is out of the range "
+                             "{} to {}", key, value, *TAG_RANGES[key])
+
+        if opcode in MOTION:
+            self.check_motion(line, instruction, args)
+        elif opcode in ("NOP", "END", "PAUSE", "RET"):
+            self.expect(line, instruction, not args and not tags)
+        elif opcode == "TIMER":
+            self.expect(line, instruction, not args and tags.keys() == ["T"])
+        elif opcode in ("JUMP", "CALL"):
+            self.check_jump(line, instruction, args)
+        elif opcode in ("SET", "ADD", "SUB"):
+            if self.expect(line, instruction, len(args) == 2 and not tags):
+                self.check_variable(line, args[0], args[1])
+        elif opcode in ("INC", "DEC"):
+            if self.expect(line, instruction, len(args) == 1 and not tags):
+                self.check_variable(line, args[0])
+        elif opcode == "DOUT":
+            self.expect(line, instruction, len(args) == 2 and SIGNAL.match(
+                args[0]) and args[1] in ("ON", "OFF"))
+        elif opcode == "WAIT":
+            self.expect(line, instruction, len(args) == 1 and CONDITION.match(
+                args[0]) and set(tags) <= set(["T"]))
+        else:
+            self.problem(WARNING, line, '"{}" is not checked', opcode)
+
+    def expect(self, line, instruction, condition):
+        """ Report a syntax error unless condition holds, return condition """
+        if not condition:
+            self.problem(INSTRUCTION_SYNTAX, line, 'bad operands in "{}"',
+                         instruction.line)
+        return bool(condition)
+
+    def check_motion(self, line, instruction, args):
+        """ MOVJ C000 [E000] VJ=50.00 [PL=n] [CONT] and the like """
+        (required, optional) = MOTION[instruction.opcode]
+        positions = [arg for arg in args if arg not in MOTION_WORDS]
+        if not self.expect(line, instruction, 1 <= len(positions) <= 2 and
+                           set(required) <= set(instruction.tags) and
+                           set(instruction.tags) <= set(required + optional)):
+            return
+        for position in positions:
+            if not POSITION.match(position):
+                self.problem(INSTRUCTION_SYNTAX, line, '"{}" is not a '
+                             'position', position)
+            elif position not in self.job.positions:
+                self.problem(POSITION_FAULT, line, "{} is not defined in "
+                             "//POS", position)
+
+    def check_jump(self, line, instruction, args):
+        """ JUMP *LABEL, JUMP JOB:NAME, CALL JOB:NAME """
+        if not self.expect(line, instruction, len(args) == 1 and
+                           not instruction.tags):
+            return
+        target = args[0]
+        if target.startswith("JOB:"):
+            if not JOB_NAME.match(target[4:]):
+                self.problem(BAD_JOB_NAME, line, '"{}" is not a job name',
+                             target[4:])
+        elif instruction.opcode == "JUMP" and LABEL.match(target):
+            if target not in self.labels:
+                self.problem(INSTRUCTION_SYNTAX, line, "the label {} is not "
+                             "defined", target)
+        else:
+            self.problem(INSTRUCTION_SYNTAX, line, 'bad target in "{}"',
+                         instruction.line)
+
+    def check_variable(self, line, name, value=None):
+        """ A B/I/D/R variable name and optionally the value given to it """
+        match = VARIABLE.match(name)
+        if not match:
+            if not SIGNAL.match(name):
+                self.problem(INSTRUCTION_SYNTAX, line, '"{}" is not a '
+                             'variable', name)
+            return
+        if int(match.group(2)) >= VARIABLE_COUNT:
+            self.problem(RANGE_EXCEEDED, line, "there is no variable {}",
+                         name)
+            return
+        limits = VARIABLE_RANGES[match.group(1)]
+        if value is None or VARIABLE.match(value) or value in ("ON", "OFF"):
+            return
+        if match.group(1) != "R" and not INTEGER.match(value):
+            self.problem(INSTRUCTION_SYNTAX, line, "{} takes whole numbers, "
+                         "not {}", name, value)
+        elif not in_range(value, limits):
+            self.problem(RANGE_EXCEEDED, line, "{} is out of the range of {}",
+                         value, name)
+
+    def line_of(self, prefix):
+        """ Return the index of the first line starting with prefix """
+        for index, line in enumerate(self.job.lines):
+            if line.startswith(prefix):
+                return index
+        return None
+
+
+def check(content, name=None):
+    """
+    Return the list of Problems of the given job file content, sorted by
+    line. name is the job name the ERC will store it under; the //NAME line
+    is used if it isn't given
+    """
+    job = jbi.Job(content)
+    checker = Checker(job)
+    checker.check_header()
+    checker.check_name(job.name if name is None else name)
+    checker.check_positions()
+    checker.check_instructions()
+    return sorted(checker.problems, key=lambda problem: problem.line or 0)
+
+
+def check_file(filename):
+    """
+    Return the Problems of the named job file. The job is checked under the
+    name it will be sent as, the file's rootname
+    """
+    with open(filename) as inputfh:
+        return check(inputfh.read(),
+                     os.path.splitext(os.path.basename(filename))[0])
+
+
+def is_job(filename):
+    """ Return True if the file name has a job extension """
+    return os.path.splitext(filename)[1].upper() in ('.JBI', '.JBR')
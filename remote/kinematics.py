@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Forward and inverse kinematics for ERC-series manipulators, computed from the
+controller's own RC parameters (see dat/PARAM.DAT and dat/params-edited.txt)
+
+Every function works on whole arrays of positions at once: pulse positions
+are (n, 6) arrays of S,L,U,R,B,T pulse counts and poses are (n, 6) arrays of
+x,y,z (mm) and tx,ty,tz (degrees), the same form RPOS reports. The angles are
+fixed axis rotations applied in x, y, z order.
+"""
+import numpy
+
+import datfile
+
+
+def read_parameters(filename, cache=None):
+    """
+    Return a dict mapping each //xxPRM section name of a PARAM.DAT file to
+    the array of its integer values, for example result["RC"][2] is RC002.
+    cache is passed to datfile.load: False never touches ~/.cache
+    """
+    return datfile.load(filename, cache).parameters()
+
+
+def rot_x(angles):
+    """ Return an (n, 3, 3) stack of rotations about x by the given radians """
+    (cos, sin) = (numpy.cos(angles), numpy.sin(angles))
+    (zero, one) = (numpy.zeros_like(cos), numpy.ones_like(cos))
+    return numpy.stack([one, zero, zero,
+                        zero, cos, -sin,
+                        zero, sin, cos], axis=-1).reshape(-1, 3, 3)
+
+
+def rot_y(angles):
+    """ Return an (n, 3, 3) stack of rotations about y by the given radians """
+    (cos, sin) = (numpy.cos(angles), numpy.sin(angles))
+    (zero, one) = (numpy.zeros_like(cos), numpy.ones_like(cos))
+    return numpy.stack([cos, zero, sin,
+                        zero, one, zero,
+                        -sin, zero, cos], axis=-1).reshape(-1, 3, 3)
+
+
+def rot_z(angles):
+    """ Return an (n, 3, 3) stack of rotations about z by the given radians """
+    (cos, sin) = (numpy.cos(angles), numpy.sin(angles))
+    (zero, one) = (numpy.zeros_like(cos), numpy.ones_like(cos))
+    return numpy.stack([cos, -sin, zero,
+                        sin, cos, zero,
+                        zero, zero, one], axis=-1).reshape(-1, 3, 3)
+
+
+def matmul(first, second):
+    """ Multiply two stacks of 3x3 matrices """
+    return numpy.matmul(first, second)
+
+
+def angles_to_matrices(angles):
+    """
+    Return (n, 3, 3) rotation matrices for an (n, 3) array of tx,ty,tz
+    degrees
+    """
+    radians = numpy.radians(numpy.asarray(angles, dtype=float))
+    return matmul(rot_z(radians[:, 2]),
+                  matmul(rot_y(radians[:, 1]), rot_x(radians[:, 0])))
+
+
+def matrices_to_angles(matrices):
+    """ Return the (n, 3) tx,ty,tz degrees of a stack of rotation matrices """
+    tx = numpy.arctan2(matrices[:, 2, 1], matrices[:, 2, 2])
+    ty = numpy.arctan2(-matrices[:, 2, 0],
+                       numpy.hypot(matrices[:, 0, 0], matrices[:, 1, 0]))
+    tz = numpy.arctan2(matrices[:, 1, 0], matrices[:, 0, 0])
+    return numpy.degrees(numpy.stack([tx, ty, tz], axis=-1))
+
+
+def poses_to_transforms(poses):
+    """ Return (n, 4, 4) homogeneous transforms for an (n, 6) pose array """
+    poses = numpy.atleast_2d(numpy.asarray(poses, dtype=float))
+    result = numpy.zeros((len(poses), 4, 4))
+    result[:, 0:3, 0:3] = angles_to_matrices(poses[:, 3:6])
+    result[:, 0:3, 3] = poses[:, 0:3]
+    result[:, 3, 3] = 1.0
+    return result
+
+
+def transforms_to_poses(transforms):
+    """ Return the (n, 6) pose array of a stack of homogeneous transforms """
+    return numpy.hstack([transforms[:, 0:3, 3],
+                         matrices_to_angles(transforms[:, 0:3, 0:3])])
+
+
+# maps the flange frame (z out of the flange) onto the wrist chain (x along
+# the forearm), so that the approach vector at the zero pose points forward
+FLANGE = rot_y(numpy.array([numpy.pi / 2]))[0]
+
+# below this B (radians, about 0.006 degrees) R and T turn about the same
+# line, so only their sum is known
+STRAIGHT_WRIST = 1e-4
+
+
+class Geometry(object):
+    """
+    The arm dimensions (mm) and axis resolutions (pulses per revolution) of a
+    manipulator. At zero pulses the L arm is vertical, the U arm horizontal
+    and the flange faces forward along the U arm. A parallel link arm (e.g.
+    the K series) measures the U angle from the horizontal; otherwise it is
+    measured relative to the L arm
+    """
+    s_l_offset = 0.0  # RC001, x offset from the S axis to the L axis
+    l_arm = 0.0  # RC002, L axis to U axis
+    lateral_offset = 0.0  # RC003, y offset of the U arm from the S axis
+    u_offset = 0.0  # RC004, U axis to the R axis center line
+    u_arm = 0.0  # RC005, U axis offset end to the B axis
+    flange = 0.0  # RC007, B axis to the flange surface
+    base_height = 0.0  # z of the L axis in the robot frame
+    resolution = None  # RC046 - RC051, signed pulses per 360 degrees
+    zero = None  # the pulse counts of the zero pose, if not all 0
+    parallel_link = True
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise TypeError("Unknown geometry value {!r}".format(key))
+            setattr(self, key, value)
+        self.resolution = numpy.asarray(self.resolution, dtype=float)
+        if self.zero is None:
+            self.zero = numpy.zeros(6)
+        self.zero = numpy.asarray(self.zero, dtype=float)
+
+    @classmethod
+    def from_parameters(cls, parameters, **kwargs):
+        """ Return the Geometry described by a read_parameters() dict """
+        rc_values = parameters["RC"]
+        values = dict(s_l_offset=rc_values[1] / 1000.0,
+                      l_arm=rc_values[2] / 1000.0,
+                      lateral_offset=rc_values[3] / 1000.0,
+                      u_offset=rc_values[4] / 1000.0,
+                      u_arm=rc_values[5] / 1000.0,
+                      flange=rc_values[7] / 1000.0,
+                      resolution=rc_values[46:52])
+        values.update(kwargs)
+        return cls(**values)
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """ Return the Geometry described by the given PARAM.DAT file """
+        return cls.from_parameters(read_parameters(filename), **kwargs)
+
+    def pulses_to_radians(self, pulses):
+        """ Convert an (n, 6) pulse array to joint angles in radians """
+        pulses = numpy.atleast_2d(numpy.asarray(pulses, dtype=float))
+        return (pulses[:, 0:6] - self.zero) / self.resolution * 2 * numpy.pi
+
+    def radians_to_pulses(self, radians):
+        """ Convert an (n, 6) joint angle array to whole pulse counts """
+        pulses = radians / (2 * numpy.pi) * self.resolution + self.zero
+        return numpy.rint(pulses).astype(numpy.int64)
+
+    def forearm_elevation(self, theta_l, theta_u):
+        """ Return the angle of the U arm above the horizontal """
+        return theta_u if self.parallel_link else theta_u - theta_l
+
+
+def forward_transforms(geometry, pulses):
+    """ Return the (n, 4, 4) flange transforms for an (n, 6) pulse array """
+    theta = geometry.pulses_to_radians(pulses)
+    elevation = geometry.forearm_elevation(theta[:, 1], theta[:, 2])
+
+    reach = (geometry.s_l_offset + geometry.l_arm * numpy.sin(theta[:, 1]) +
+             geometry.u_arm * numpy.cos(elevation) -
+             geometry.u_offset * numpy.sin(elevation))
+    height = (geometry.base_height + geometry.l_arm * numpy.cos(theta[:, 1]) +
+              geometry.u_arm * numpy.sin(elevation) +
+              geometry.u_offset * numpy.cos(elevation))
+    (cos_s, sin_s) = (numpy.cos(theta[:, 0]), numpy.sin(theta[:, 0]))
+    wrist = numpy.stack([reach * cos_s - geometry.lateral_offset * sin_s,
+                         reach * sin_s + geometry.lateral_offset * cos_s,
+                         height], axis=-1)
+
+    arm = matmul(rot_z(theta[:, 0]), rot_y(-elevation))
+    wrist_rotation = matmul(rot_x(theta[:, 3]),
+                            matmul(rot_y(theta[:, 4]), rot_x(theta[:, 5])))
+    rotation = numpy.matmul(matmul(arm, wrist_rotation), FLANGE)
+
+    result = numpy.zeros((len(theta), 4, 4))
+    result[:, 0:3, 0:3] = rotation
+    result[:, 0:3, 3] = wrist + rotation[:, :, 2] * geometry.flange
+    result[:, 3, 3] = 1.0
+    return result
+
+
+def forward(geometry, pulses):
+    """ Convert an (n, 6) pulse array to an (n, 6) pose array """
+    return transforms_to_poses(forward_transforms(geometry, pulses))
+
+
+def wrap_towards(angles, reference):
+    """ Add whole turns to the given radians to bring them near reference """
+    return angles + 2 * numpy.pi * numpy.round((reference - angles) /
+                                               (2 * numpy.pi))
+
+
+def arm_solution(geometry, wrist, back=False, elbow_up=True):
+    """
+    Return the (S, L, U, U arm elevation) radians that put the B axis at the
+    given (n, 3) wrist centers. back chooses the solution reaching over the
+    back of the S axis, elbow_up whether the U arm bends down from L
+    """
+    radius = numpy.hypot(wrist[:, 0], wrist[:, 1])
+    theta_s = (numpy.arctan2(wrist[:, 1], wrist[:, 0]) -
+               numpy.arcsin(geometry.lateral_offset / radius))
+    reach = numpy.sqrt(radius ** 2 - geometry.lateral_offset ** 2)
+    if back:
+        theta_s = theta_s + numpy.pi
+        reach = -reach
+    reach = reach - geometry.s_l_offset
+    height = wrist[:, 2] - geometry.base_height
+
+    # the U arm and its offset act as one link at a fixed angle
+    forearm = numpy.hypot(geometry.u_arm, geometry.u_offset)
+    offset_angle = numpy.arctan2(geometry.u_offset, geometry.u_arm)
+    cos_elbow = ((reach ** 2 + height ** 2 - geometry.l_arm ** 2 -
+                  forearm ** 2) / (2 * geometry.l_arm * forearm))
+    elbow = numpy.arccos(numpy.clip(cos_elbow, -1.0, 1.0))
+    if elbow_up:
+        elbow = -elbow
+    l_elevation = (numpy.arctan2(height, reach) -
+                   numpy.arctan2(forearm * numpy.sin(elbow),
+                                 geometry.l_arm + forearm * numpy.cos(elbow)))
+    theta_l = numpy.pi / 2 - l_elevation
+    elevation = l_elevation + elbow - offset_angle
+    theta_u = elevation if geometry.parallel_link else elevation + theta_l
+    return (theta_s, theta_l, theta_u, elevation)
+
+
+def wrist_solution(elevation, theta_s, rotation, flipped=False,
+                   reference_r=None):
+    """
+    Return the (R, B, T) radians that give the flange the (n, 3, 3) rotation
+    with the arm in the given pose. flipped chooses the solution with B
+    negated. With the wrist straight (B within STRAIGHT_WRIST of 0) R is
+    kept at reference_r radians (or 0) and T makes up the rest
+    """
+    arm = matmul(rot_z(theta_s), rot_y(-elevation))
+    wrist_rotation = numpy.matmul(matmul(arm.transpose(0, 2, 1), rotation),
+                                  FLANGE.T)
+    sin_b = numpy.hypot(wrist_rotation[:, 1, 0], wrist_rotation[:, 2, 0])
+    theta_b = numpy.arctan2(sin_b, wrist_rotation[:, 0, 0])
+    theta_r = numpy.arctan2(wrist_rotation[:, 1, 0], -wrist_rotation[:, 2, 0])
+    theta_t = numpy.arctan2(wrist_rotation[:, 0, 1], wrist_rotation[:, 0, 2])
+
+    straight = (sin_b < STRAIGHT_WRIST) & (wrist_rotation[:, 0, 0] > 0)
+    if straight.any():
+        # take R as given, then B and T from what is left: rot_y(B) rot_x(T)
+        theta_r[straight] = 0.0 if reference_r is None else \
+            numpy.broadcast_to(reference_r, theta_r.shape)[straight]
+        rest = matmul(rot_x(-theta_r[straight]), wrist_rotation[straight])
+        theta_b[straight] = numpy.arctan2(-rest[:, 2, 0], rest[:, 0, 0])
+        theta_t[straight] = numpy.arctan2(-rest[:, 1, 2], rest[:, 1, 1])
+    if flipped:
+        return (theta_r + numpy.pi, -theta_b, theta_t + numpy.pi)
+    return (theta_r, theta_b, theta_t)
+
+
+def inverse_transforms(geometry, transforms, reference=None):
+    """
+    Return the (n, 6) pulse array that puts the flange at each of the given
+    (n, 4, 4) transforms. When reference pulses are given, each row uses
+    the arm and wrist solution (and the R and T turns) nearest to its
+    reference, otherwise the front, elbow up solution with B positive
+    """
+    rotation = transforms[:, 0:3, 0:3]
+    wrist = transforms[:, 0:3, 3] - rotation[:, :, 2] * geometry.flange
+
+    if reference is None:
+        (theta_s, theta_l, theta_u, elevation) = arm_solution(geometry, wrist)
+        theta = numpy.stack(
+            [theta_s, theta_l, theta_u] +
+            list(wrist_solution(elevation, theta_s, rotation)), axis=-1)
+        return geometry.radians_to_pulses(theta)
+
+    reference = geometry.pulses_to_radians(reference)
+    best = None
+    best_distance = None
+    for back in (False, True):
+        for elbow_up in (True, False):
+            arm = arm_solution(geometry, wrist, back, elbow_up)
+            for flipped in (False, True):
+                theta = numpy.stack(
+                    list(arm[0:3]) +
+                    list(wrist_solution(arm[3], arm[0], rotation, flipped,
+                                        reference[:, 3])),
+                    axis=-1)
+                theta = wrap_towards(theta, reference)
+                distance = abs(theta - reference).sum(axis=1)
+                if best is None:
+                    (best, best_distance) = (theta, distance)
+                    continue
+                closer = distance < best_distance
+                best[closer] = theta[closer]
+                best_distance = numpy.minimum(distance, best_distance)
+    return geometry.radians_to_pulses(best)
+
+
+def inverse(geometry, poses, reference=None):
+    """ Convert an (n, 6) pose array to an (n, 6) pulse array """
+    return inverse_transforms(geometry, poses_to_transforms(poses), reference)
+
+
+def pose_errors(expected, actual):
+    """
+    Return (position, angle) arrays with the distance in mm and the rotation
+    in degrees between each pair of expected and actual poses
+    """
+    expected = numpy.atleast_2d(numpy.asarray(expected, dtype=float))
+    actual = numpy.atleast_2d(numpy.asarray(actual, dtype=float))
+    position = numpy.linalg.norm(expected[:, 0:3] - actual[:, 0:3], axis=1)
+    relative = matmul(angles_to_matrices(expected[:, 3:6]).transpose(0, 2, 1),
+                      angles_to_matrices(actual[:, 3:6]))
+    cos_angle = (numpy.trace(relative, axis1=1, axis2=2) - 1) / 2
+    angle = numpy.degrees(numpy.arccos(numpy.clip(cos_angle, -1.0, 1.0)))
+    return (position, angle)
+
+
+def read_captures(filename):
+    """
+    Read captured RPOS/RPOSJ pairs, as printed by repeated runs of
+    `motocommand RPOS RPOSJ`: alternating lines holding the rectangular and
+    then the pulse position. Return a (poses, pulses) tuple of arrays
+    """
+    with open(filename) as inputfh:
+        lines = [line.strip() for line in inputfh if line.strip()]
+    if len(lines) % 2:
+        raise ValueError("{} has an unpaired RPOS line".format(filename))
+    poses = [[float(value) for value in line.split(",")[0:6]]
+             for line in lines[0::2]]
+    pulses = [[int(value) for value in line.split(",")[0:6]]
+              for line in lines[1::2]]
+    return (numpy.array(poses), numpy.array(pulses))
+
+
+def validate(geometry, poses, pulses, tool=None):
+    """
+    Compare the model against captured RPOS/RPOSJ pairs. Return a dict of
+    the worst and mean forward position (mm) and angle (degree) errors, and
+    the worst inverse error in pulses. tool is the (6,) pose of the tool
+    that was selected when the captures were taken, if not the flange
+    """
+    tool = numpy.eye(4) if tool is None else poses_to_transforms(tool)[0]
+    (position, angle) = pose_errors(poses, transforms_to_poses(
+        numpy.matmul(forward_transforms(geometry, pulses), tool)))
+    round_trip = inverse_transforms(
+        geometry, numpy.matmul(poses_to_transforms(poses),
+                               numpy.linalg.inv(tool)), reference=pulses)
+    return {'samples': len(pulses),
+            'position_max': float(position.max()),
+            'position_mean': float(position.mean()),
+            'angle_max': float(angle.max()),
+            'angle_mean': float(angle.mean()),
+            'pulse_max': int(abs(round_trip - pulses).max())}
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Compiler and simulator for the concurrent I/O ladder program (dat/CIO.PRO)
+
+compile_ladder() turns the ladder's STR/AND/OR/OUT/TMR lines into a flat
+numpy instruction array. The ladder's block stack is resolved at compile
+time, so each instruction names the register it works on. A Simulation
+holds every relay of many input scenarios at once, one bit per scenario in
+packed 64 bit words. A scan runs each instruction once as a numpy bitwise
+operation over all the scenarios, so running every combination of a
+dozen or more inputs is a matter of seconds. run() reports how many scans
+each scenario takes to settle.
+"""
+import re
+
+import numpy
+
+# opcodes of the compiled program
+(STR, STR_NOT, AND, AND_NOT, OR, OR_NOT, AND_STR, OR_STR, OUT, TMR) = \
+    range(10)
+OPCODES = {"STR": STR, "STR-NOT": STR_NOT, "AND": AND, "AND-NOT": AND_NOT,
+           "OR": OR, "OR-NOT": OR_NOT, "AND-STR": AND_STR, "OR-STR": OR_STR,
+           "OUT": OUT, "TMR": TMR}
+
+INSTRUCTION = re.compile(r'^([A-Z]+(?:-[A-Z]+)?)(?:\s+#(\d+)(?:,(\d+))?)?$')
+
+# the first relay of each IONAME.DAT section; signals are numbered in
+# octal, eight to a relay group (#2010-#2017, #2020-...)
+IONAME_BASES = {"IN": 2010, "OUT": 3010}
+
+ALL_ONES = numpy.uint64(0xffffffffffffffff)
+BIT_WEIGHTS = numpy.left_shift(numpy.uint64(1),
+                               numpy.arange(64, dtype=numpy.uint64))
+
+
+class LadderFormatError(ValueError):
+    """ A line of the ladder program can't be compiled """
+    def __init__(self, line_number, line, reason):
+        super(LadderFormatError, self).__init__("line {}: {}: {}".format(
+            line_number, reason, line))
+
+
+class Program(object):
+    """
+    A compiled ladder. code has one row per instruction: the opcode, the
+    register it works on, the relay index it reads or writes, and the timer
+    set value (TMR) or the index of the timer (TMR's count slot)
+    """
+    relays = None  # relay numbers in index order, as written (2010 for #2010)
+    index = None  # relay number -> index
+    code = None
+    lines = None  # the source line number of each instruction
+    registers = 0  # the depth of the block stack
+    timers = None  # (relay index, set value) of each TMR
+    outputs = None  # indexes of the relays written by OUT or TMR
+    inputs = None  # indexes of the relays only read: the program's inputs
+
+    def relay(self, number):
+        """ Return the index of a relay given as 2010 or "#2010" """
+        return self.index[int(str(number).lstrip("#"))]
+
+
+def compile_ladder(content):
+    """
+    Compile the ladder of a CIO.PRO file (the lines up to END) into a
+    Program. Raise LadderFormatError for unknown or unbalanced instructions
+    """
+    program = Program()
+    program.relays = list()
+    program.index = dict()
+    program.timers = list()
+    rows = list()
+    lines = list()
+    written = set()
+    depth = -1  # the register holding the current block, -1 before a rung
+    rung_closed = True
+
+    def relay_index(number):
+        """ The index of a relay, adding it on first use """
+        if number not in program.index:
+            program.index[number] = len(program.relays)
+            program.relays.append(number)
+        return program.index[number]
+
+    for line_number, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("/") or line.startswith("NODE "):
+            continue
+        if line == "END":
+            break
+        match = INSTRUCTION.match(line)
+        if not match or match.group(1) not in OPCODES:
+            raise LadderFormatError(line_number, line, "unknown instruction")
+        opcode = OPCODES[match.group(1)]
+        takes_relay = opcode not in (AND_STR, OR_STR)
+        if takes_relay != bool(match.group(2)) or \
+                (opcode == TMR) != bool(match.group(3)):
+            raise LadderFormatError(line_number, line, "bad operands")
+        relay = relay_index(int(match.group(2))) if takes_relay else -1
+
+        if opcode in (STR, STR_NOT):
+            # a STR after an OUT starts a new rung, otherwise a new block
+            depth = 0 if rung_closed else depth + 1
+            rung_closed = False
+        elif depth < 0 or (opcode in (AND_STR, OR_STR) and depth < 1):
+            raise LadderFormatError(line_number, line, "nothing to combine")
+        if opcode in (AND_STR, OR_STR):
+            depth -= 1
+        if opcode in (OUT, TMR):
+            written.add(relay)
+            rung_closed = True
+        argument = 0
+        if opcode == TMR:
+            argument = len(program.timers)
+            program.timers.append((relay, int(match.group(3))))
+        program.registers = max(program.registers, depth + 1)
+        rows.append((opcode, depth, relay, argument))
+        lines.append(line_number)
+
+    program.code = numpy.array(rows, dtype=numpy.int32).reshape(-1, 4)
+    program.lines = lines
+    program.outputs = sorted(written)
+    program.inputs = [index for index in range(len(program.relays))
+                      if index not in written]
+    return program
+
+
+def load(filename):
+    """ Return the compiled Program of the named CIO.PRO file """
+    with open(filename) as inputfh:
+        return compile_ladder(inputfh.read())
+
+
+def relay_number(base, signal):
+    """ Return the relay number of the given (0 based) signal of a group """
+    group = (base // 10) * 8 + base % 10 + signal
+    return (group // 8) * 10 + group % 8
+
+
+def signal_names(datfile):
+    """
+    Return a dict mapping relay numbers to the signal names given in an
+    IONAME.DAT DatFile. Unnamed signals are left out
+    """
+    names = dict()
+    for section, base in IONAME_BASES.items():
+        if section not in datfile:
+            continue
+        for signal, row in enumerate(datfile.rows(section)):
+            if row and row[0].strip():
+                names[relay_number(base, signal)] = row[0].strip()
+    return names
+
+
+def pack(bits):
+    """ Pack a boolean array of scenarios into 64 bit words """
+    bits = numpy.asarray(bits, dtype=bool)
+    padded = numpy.zeros(-(-len(bits) // 64) * 64, dtype=numpy.uint64)
+    padded[0:len(bits)] = bits
+    return numpy.bitwise_or.reduce(
+        padded.reshape(-1, 64) * BIT_WEIGHTS, axis=1).astype(numpy.uint64)
+
+
+def unpack(words, count):
+    """ Return the first count scenario bits of packed words as booleans """
+    bits = numpy.bitwise_and(words[:, numpy.newaxis], BIT_WEIGHTS) != 0
+    return bits.reshape(-1)[0:count]
+
+
+def counting_pattern(bit, count):
+    """
+    Return packed words where scenario s has the given bit of s, so that
+    inputs given bits 0, 1, 2... run through every combination
+    """
+    words = -(-count // 64)
+    if bit >= 6:
+        selected = (numpy.arange(words) >> (bit - 6)) & 1
+        return numpy.where(selected, ALL_ONES, numpy.uint64(0))
+    pattern = 0
+    for position in range(64):
+        if (position >> bit) & 1:
+            pattern |= 1 << position
+    return numpy.full(words, pattern, dtype=numpy.uint64)
+
+
+class Simulation(object):
+    """
+    The relay states of a number of scenarios. state has a row of packed
+    words per relay, with bit s of the row for scenario s
+    """
+    program = None
+    scenarios = 0
+    state = None
+    registers = None
+    counts = None  # the count of each timer, per scenario
+    timer_scale = 1.0  # scans per unit of a TMR set value
+
+    def __init__(self, program, scenarios, timer_scale=1.0):
+        self.program = program
+        self.scenarios = scenarios
+        self.timer_scale = timer_scale
+        words = -(-scenarios // 64)
+        self.state = numpy.zeros((len(program.relays), words),
+                                 dtype=numpy.uint64)
+        self.registers = numpy.zeros((max(program.registers, 1), words),
+                                     dtype=numpy.uint64)
+        self.counts = numpy.zeros((len(program.timers), scenarios),
+                                  dtype=numpy.int32)
+
+    def set_input(self, relay, value):
+        """
+        Drive a relay (a number or index, see Program.relay) in every
+        scenario: value is a bool, or packed words with a bit per scenario
+        """
+        words = value if isinstance(value, numpy.ndarray) else \
+            numpy.uint64(ALL_ONES if value else 0)
+        self.state[self.program.relay(relay)] = words
+
+    def scan(self):
+        """
+        Run the ladder once, in order, each OUT taking effect immediately.
+        Return the packed words of the scenarios whose state changed
+        """
+        state = self.state
+        registers = self.registers
+        before = state.copy()
+        counts = self.counts.copy()
+        for (opcode, depth, relay, argument) in self.program.code:
+            if opcode == STR:
+                registers[depth] = state[relay]
+            elif opcode == STR_NOT:
+                numpy.invert(state[relay], out=registers[depth])
+            elif opcode == AND:
+                registers[depth] &= state[relay]
+            elif opcode == AND_NOT:
+                registers[depth] &= ~state[relay]
+            elif opcode == OR:
+                registers[depth] |= state[relay]
+            elif opcode == OR_NOT:
+                registers[depth] |= ~state[relay]
+            elif opcode == AND_STR:
+                registers[depth] &= registers[depth + 1]
+            elif opcode == OR_STR:
+                registers[depth] |= registers[depth + 1]
+            elif opcode == OUT:
+                state[relay] = registers[depth]
+            else:
+                registers[depth] = state[relay] = self.timer(
+                    argument, registers[depth])
+        changed = numpy.bitwise_or.reduce(before ^ state, axis=0)
+        if len(self.counts):
+            changed |= pack((counts != self.counts).any(axis=0))
+        return changed
+
+    def timer(self, timer, enabled):
+        """
+        Advance an on-delay timer: it counts scans while enabled and turns
+        on once the count reaches its set value. Return the timer output,
+        which is off whenever the timer isn't enabled, even with a set value
+        of 0
+        """
+        preset = self.program.timers[timer][1] * self.timer_scale
+        counts = self.counts[timer]
+        running = unpack(enabled, self.scenarios)
+        numpy.copyto(counts, numpy.where(
+            running, numpy.minimum(counts + 1, preset), 0).astype(
+                numpy.int32))
+        return pack((counts >= preset) & running)
+
+    def run(self, max_scans=100):
+        """
+        Scan until nothing changes, at most max_scans times. Return an array
+        of the number of scans after which each scenario stopped changing;
+        scenarios still changing (oscillating, or with timers running) have
+        max_scans
+        """
+        settled = numpy.zeros(self.scenarios, dtype=numpy.int32)
+        for scan in range(1, max_scans + 1):
+            changed = self.scan()
+            if not changed.any():
+                break
+            settled[unpack(changed, self.scenarios)] = scan
+        return settled
+
+    def relay_bits(self, relay):
+        """ Return a relay's state in each scenario as booleans """
+        return unpack(self.state[self.program.relay(relay)], self.scenarios)
+
+
+def exhaustive(program, relays, fixed=None, timer_scale=1.0):
+    """
+    Return a Simulation of every combination of the given input relays:
+    scenario s has relays[i] on if bit i of s is set. fixed maps other
+    relays to the value they have in every scenario
+    """
+    simulation = Simulation(program, 2 ** len(relays), timer_scale)
+    for relay, value in (fixed or {}).items():
+        simulation.set_input(relay, value)
+    for bit, relay in enumerate(relays):
+        simulation.set_input(relay, counting_pattern(bit,
+                                                     simulation.scenarios))
+    return simulation
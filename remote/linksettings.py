@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Serial settings for the link to an ERC-series robot
+
+Each setting is taken from the first place that gives it: the command line
+(see add_serial_arguments), the YASNAC_PORT, YASNAC_BAUDRATE, YASNAC_PARITY
+and YASNAC_STOPBITS environment variables, the [serial] section of the
+config file (~/.yasnac.cfg, or the file YASNAC_CONFIG names), the setting
+motoprobe recorded for the port, and the controller's factory setting of
+/dev/ttyS0 at 9600 baud, 8 data bits, even parity, 1 stop bit. The
+recorded setting is used whole or not at all: once anything else gives a
+baud rate, parity or stop bits, none of it is used.
+
+probe() finds the setting a controller is actually using by sending ENQ at
+each candidate rate and parity, fastest first, until one is answered with
+ACK0.
+"""
+import ConfigParser
+import json
+import os
+import time
+
+import serial
+
+CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".yasnac.cfg")
+
+PROBED_PATH = os.path.join(os.path.expanduser("~"), ".cache", "yasnac",
+                           "serial.json")
+
+SETTINGS = ('port', 'baudrate', 'parity', 'stopbits')
+
+DEFAULTS = {'port': '/dev/ttyS0', 'baudrate': 9600, 'parity': 'E',
+            'stopbits': 1}
+
+# the transmission rates the ERC's parameters can select, fastest first
+RATES = (19200, 9600, 4800, 2400, 1200, 600, 300, 150)
+PARITIES = ('E', 'N', 'O')
+
+# as in erc.py, which imports this module
+ENQ = chr(0x05)
+EOT = chr(0x04)
+ACK0 = chr(0x10) + chr(0x30)
+
+
+def convert(name, value):
+    """ Return a setting from its string form, raise ValueError if invalid """
+    if name == 'port':
+        return value
+    if name == 'parity':
+        value = value.strip().upper()[0:1]
+        if value not in PARITIES:
+            raise ValueError("parity is one of E, N or O, not {!r}".format(
+                value))
+        return value
+    value = int(value)
+    if name == 'stopbits' and value not in (1, 2):
+        raise ValueError("stopbits is 1 or 2, not {}".format(value))
+    if name == 'baudrate' and value <= 0:
+        raise ValueError("baudrate must be positive, not {}".format(value))
+    return value
+
+
+def from_environment(environ=None):
+    """ Return the settings given by YASNAC_* environment variables """
+    environ = os.environ if environ is None else environ
+    return dict((name, convert(name, environ["YASNAC_" + name.upper()]))
+                for name in SETTINGS if "YASNAC_" + name.upper() in environ)
+
+
+def from_config(path=None):
+    """ Return the settings in the [serial] section of the config file """
+    path = path or os.environ.get("YASNAC_CONFIG", CONFIG_PATH)
+    parser = ConfigParser.SafeConfigParser()
+    if not parser.read(path) or not parser.has_section("serial"):
+        return dict()
+    return dict((name, convert(name, parser.get("serial", name)))
+                for name in SETTINGS if parser.has_option("serial", name))
+
+
+def load_probed(path=PROBED_PATH):
+    """ Return the recorded probe results, a dict keyed by port """
+    try:
+        with open(path) as inputfh:
+            return json.load(inputfh)
+    except (IOError, ValueError):
+        return dict()
+
+
+def record_probed(port, settings, path=PROBED_PATH):
+    """ Record the setting probe() found working for a port """
+    probed = load_probed(path)
+    probed[port] = dict((name, settings[name]) for name in SETTINGS
+                        if name != 'port')
+    probed[port]['probed'] = time.time()
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as outputfh:
+            json.dump(probed, outputfh, indent=1, sort_keys=True)
+    except (IOError, OSError):
+        pass  # the record only saves probing again
+
+
+def resolve(probed_path=PROBED_PATH, **given):
+    """
+    Return the settings dict to open a link with: the given settings that
+    are not None, then those of the environment, the config file, the
+    probe record for the port, and the defaults. The probe record is left
+    out if any of the others gives a baudrate, parity or stopbits
+    """
+    result = dict(DEFAULTS)
+    layers = [from_config(), from_environment(),
+              dict((name, value) for name, value in given.items()
+                   if value is not None)]
+    port = DEFAULTS['port']
+    for layer in layers:
+        port = layer.get('port', port)
+    probed = load_probed(probed_path).get(port, dict())
+    if any(name in layer for layer in layers for name in SETTINGS
+           if name != 'port'):
+        probed = dict()  # only the whole record is known to work
+    result.update((name, convert(name, str(probed[name])))
+                  for name in SETTINGS if name in probed)
+    for layer in layers:
+        result.update(layer)
+    return result
+
+
+def open_link(settings, timeout=None):
+    """ Return a serial.Serial opened with the given settings """
+    return serial.Serial(port=settings['port'],
+                         baudrate=settings['baudrate'],
+                         bytesize=8,
+                         parity=settings['parity'],
+                         stopbits=settings['stopbits'],
+                         timeout=timeout)
+
+
+def handshake(link, timeout=1.0, attempts=2):
+    """
+    Send ENQ on an open link and return True if the ERC answers ACK0. The
+    exchange is ended with EOT, so the ERC is left waiting for nothing
+    """
+    for _ in range(attempts):
+        link.flushInput()
+        link.write(ENQ)
+        reply = ""
+        deadline = time.time() + timeout
+        while time.time() < deadline and len(reply) < len(ACK0):
+            reply += link.read(len(ACK0) - len(reply))
+        if reply == ACK0:
+            link.write(EOT)
+            return True
+        # line noise from a wrong rate may follow, let it pass
+        time.sleep(timeout / 4)
+        link.flushInput()
+    return False
+
+
+def candidates(rates=RATES, parities=PARITIES, stopbits=(1,)):
+    """ Return the (baudrate, parity, stopbits) settings to try, fastest first """
+    return [(rate, parity, stop) for rate in sorted(rates, reverse=True)
+            for parity in parities for stop in stopbits]
+
+
+def probe(port, tries, timeout=1.0, stop_at_first=True, report=None):
+    """
+    Try each (baudrate, parity, stopbits) in turn on the port, return the
+    list of settings dicts that got an ACK0. report, if given, is called
+    with each settings dict and whether it worked
+    """
+    working = list()
+    for (baudrate, parity, stopbits) in tries:
+        settings = dict(port=port, baudrate=baudrate, parity=parity,
+                        stopbits=stopbits)
+        link = open_link(settings, timeout=timeout / 4)
+        try:
+            success = handshake(link, timeout)
+        finally:
+            link.close()
+        if report is not None:
+            report(settings, success)
+        if success:
+            working.append(settings)
+            if stop_at_first:
+                break
+    return working
+
+
+def add_serial_arguments(argp):
+    """ Add the --port, --baud, --parity and --stopbits options """
+    group = argp.add_argument_group("serial link")
+    group.add_argument('--port', help=(
+        "The serial port of the robot. Settings not given are taken from "
+        "YASNAC_PORT, YASNAC_BAUDRATE, YASNAC_PARITY and YASNAC_STOPBITS, "
+        "the [serial] section of ~/.yasnac.cfg, the setting motoprobe "
+        "recorded for the port, or else /dev/ttyS0 at 9600 8E1"))
+    group.add_argument('--baud', type=int, dest="baudrate", help=(
+        "The transmission rate"))
+    group.add_argument('--parity', choices=PARITIES, help=(
+        "Even, none or odd parity"))
+    group.add_argument('--stopbits', type=int, choices=(1, 2), help=(
+        "The number of stop bits"))
+    return group
+
+
+def serial_options(args):
+    """ Return the ERC keyword arguments given by add_serial_arguments """
+    return dict((name, getattr(args, name)) for name in SETTINGS)
+
+
+def describe(settings):
+    """ Return a setting in the usual form, for example "/dev/ttyS0 9600 8E1" """
+    return "{} {} 8{}{}".format(settings['port'], settings['baudrate'],
+                                settings['parity'], settings['stopbits'])
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Helpers for commanding ERC manipulator motion over the serial link
+"""
+import operator
+import time
+
+import erc
+import jobcache
+
+MATHOPS = {"+=": operator.add,
+           "-=": operator.sub,
+           "*=": operator.mul,
+           "/=": operator.truediv,
+           "^=": operator.pow}
+
+# rejected while the manipulator is still busy with the previous motion
+BUSY_ERRORS = ('2010',)
+# a job too big for the controller's job (4010) or position (4012) memory
+MEMORY_ERRORS = ('4010', '4012')
+MAX_JOB_POSITIONS = 1000  # C000 to C999
+
+
+def resolve_maths(given, current_value):
+    """
+    If the given input starts with a math operator symbol, perform that
+    operation on the current value. All numbers, including the return value
+    will be converted to floats with 3 decimal places. If there is no operator
+    symbol, return the input. Examples:
+    resolve_maths("/=2", 5) will return "2.500"
+    resolve_maths("2", "5") will return "2.000"
+    """
+    result = given
+
+    if given[0:2] in MATHOPS:
+        a = float(current_value)
+        b = float(given[2:].strip())
+        operation = MATHOPS[given[0:2]]
+        result = operation(a, b)
+
+    return "{:.3f}".format(float(result))
+
+
+def resolve_position(position, current):
+    """
+    Return the 6 target coordinates for the given comma separated position
+    string, resolving empty and relative values against the given current
+    coordinates
+    """
+    target = list(current[0:6])
+    for index, coordinate in enumerate(position.split(',')[:6]):
+        if coordinate.strip():
+            target[index] = resolve_maths(coordinate.strip(), target[index])
+    return target
+
+
+def read_waypoints(source):
+    """
+    Yield waypoint strings from the given open file (e.g. sys.stdin), skipping
+    blank lines and # comments. Each line is read as it arrives, not after a
+    buffer fills, so waypoints can be streamed in by another process
+    """
+    for line in iter(source.readline, ''):
+        line = line.split('#', 1)[0].strip()
+        if line:
+            yield line
+
+
+def movl_command(speed_string, target):
+    """ Return the MOVL system command string for the given target """
+    return ("MOVL 0,{speed},0,{pos},0,0,0,0,0,0,0,0").format(
+        speed=speed_string, pos=",".join(target))
+
+
+def is_running(robot):
+    """ Return True if RSTATS reports that the manipulator is in motion """
+    return "running" in erc.decode_rstats(robot.execute_command("RSTATS"))
+
+
+def wait_until_idle(robot, poll=0.1):
+    """ Poll RSTATS until the manipulator is no longer running """
+    while is_running(robot):
+        time.sleep(poll)
+
+
+def stream_waypoints(robot, waypoints, speed_string, poll=0.1):
+    """
+    Issue a MOVL for each of the given waypoint strings as soon as it is
+    read, returning the number of segments issued. Relative coordinates are
+    resolved against a locally tracked position, so RPOS is only read once.
+    Each MOVL is offered to the controller as soon as the previous one is
+    accepted; while it answers "during robot operation" we watch RSTATS
+    rather than blocking on JWAIT. Only after the last one does JWAIT wait
+    for the arm to stop, since RSTATS may not show that motion yet
+    """
+    position = robot.execute_command("RPOS")[0:6]
+    issued = 0
+
+    def issue(command):
+        """ Send the command, retrying while the robot is busy """
+        while True:
+            robot.execute_command(command)
+            if robot.last_error is None:
+                return
+            if robot.last_error not in BUSY_ERRORS:
+                raise RuntimeError(erc.warn(
+                    "Motion rejected: {}".format(erc.ERRORS.get(
+                        robot.last_error, robot.last_error)), force=True))
+            wait_until_idle(robot, poll)
+
+    for waypoint in waypoints:
+        position = resolve_position(waypoint, position)
+        issue(movl_command(speed_string, position))
+        issued += 1
+
+    if issued:
+        robot.execute_command("JWAIT -1")
+    return issued
+
+
+def resolve_waypoints(waypoints, current, pulse=False):
+    """
+    Yield the 6 target fields of each waypoint string, resolving empty and
+    relative values against the previous waypoint, the first against the
+    given current position. Pulse counts are rounded to whole pulses
+    """
+    position = list(current[0:6])
+    for waypoint in waypoints:
+        position = resolve_position(waypoint, position)
+        if pulse:
+            position = [str(int(round(float(value)))) for value in position]
+        yield position
+
+
+def path_job(name, positions, speed_string, pulse=False, joint=False,
+             tool=0, smoothing=None):
+    """
+    Return the content of a job that moves through the given positions in
+    turn: a MOVL (or with joint, a MOVJ whose speed is a % of the maximum)
+    to each. smoothing is the PL level of every move but the last, letting
+    the controller blend them into one continuous motion
+    """
+    lines = ["/JOB", "//NAME " + name, "//POS",
+             "///NPOS {},0,0,0".format(len(positions)),
+             "///TOOL {}".format(tool)]
+    lines += ["///PULSE"] if pulse else ["///RECTAN", "///RCONF 0,0,0,0,0"]
+    lines += ["C{:03}={}".format(index, ",".join(position))
+              for index, position in enumerate(positions)]
+    # the frame line as the controller writes it: BASE for pulse jobs (see
+    # jobs/K0.JBI), 1 for positions in robot coordinates, the frame RPOS
+    # reports (see jobs/BABY.JBI)
+    lines += ["//INST", time.strftime("///DATE %Y/%m/%d %H:%M"),
+              "///ATTR " + ",".join(["0"] * 16),
+              "///FRAME " + ("BASE" if pulse else "1"), "NOP"]
+    move = "MOVJ C{:03} VJ={}" if joint else "MOVL C{:03} V={}"
+    for index in range(len(positions)):
+        line = move.format(index, speed_string)
+        if smoothing is not None and index < len(positions) - 1:
+            line += " PL={}".format(smoothing)
+        lines.append(line)
+    lines.append("END")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def batch_name(name, index):
+    """ Return the job name of the given batch: NAME, NAME1, NAME2... """
+    if not index:
+        return name
+    return name[0:8 - len(str(index))] + str(index)
+
+
+def run_path(robot, positions, speed_string, name="MOTOPATH", batch=500,
+             keep=False, replace=False, uploads=None, **options):
+    """
+    Move through the given positions by sending them to the robot as jobs
+    of up to batch positions (see path_job for the options), each started
+    and waited for in turn. A job the controller has no memory for is split
+    in half and tried again. The jobs are deleted once they have run,
+    unless keep is set, in which case each batch gets its own name. Return
+    the number of jobs run.
+
+    Each job sent is recorded in the robot's jobcache.UploadLog (uploads).
+    A job of the same name already on the robot is only deleted to make
+    way if it is recorded there, or if replace is set; otherwise
+    RuntimeError is raised
+    """
+    if uploads is None:
+        uploads = jobcache.UploadLog(jobcache.robot_key(robot))
+    positions = list(positions)
+    batch = min(batch, MAX_JOB_POSITIONS)
+    done = 0
+    runs = 0
+
+    def check(action):
+        """ Raise RuntimeError if the last command was refused """
+        if robot.last_error is not None:
+            raise RuntimeError(erc.warn("{} failed: {}".format(
+                action, erc.ERRORS.get(robot.last_error, robot.last_error)),
+                                        force=True))
+
+    while done < len(positions):
+        size = min(batch, len(positions) - done)
+        jobname = batch_name(name, runs) if keep else name
+        content = path_job(jobname, positions[done:done + size],
+                           speed_string, **options)
+        robot.send_file(jobname + ".JBI", content)
+        if robot.last_error == '4030':
+            # a job of the same name is left over from an earlier path, or
+            # is someone else's
+            if uploads.get(jobname) is None and not replace:
+                raise RuntimeError(erc.warn(
+                    'A job named "{}" is already on the robot and was not '
+                    'left there by an earlier path, delete it or replace '
+                    'it (--replace)'.format(jobname), force=True))
+            robot.execute_command("DELETE " + jobname)
+            robot.send_file(jobname + ".JBI", content)
+        if robot.last_error in MEMORY_ERRORS and size > 1:
+            robot.execute_command("DELETE " + jobname)
+            batch = size // 2
+            erc.warn("{} positions don't fit in the controller's memory, "
+                     "trying {}".format(size, batch), force=True)
+            continue
+        check("Sending " + jobname)
+        uploads.record(jobname, jobcache.lines_digest(content.splitlines()))
+        robot.execute_command("START " + jobname)
+        check("Starting " + jobname)
+        robot.execute_command("JWAIT -1")
+        if not keep:
+            robot.execute_command("DELETE " + jobname)
+            uploads.forget(jobname)
+        done += size
+        runs += 1
+    return runs
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Retargeting of job positions after a fixture has moved or a tool has changed
+
+Each job's C positions are loaded into one array and moved in a single
+vectorized pass: the tool center point of every position is found (from
+the pulse counts through the forward kinematics and the taught tool, or
+directly from rectangular positions), moved by the change of user frame,
+and turned back into the job's own form for the new tool, pulse positions
+through the inverse kinematics nearest to the taught pulses. The result
+reports how far each position moved and which ones the new pulse counts
+put outside the software limits (SC000 - SC011 of PARAM.DAT), miss in
+position or orientation because the arm can't reach them, or turn to a
+different wrist configuration though the flange stays where it was.
+"""
+import collections
+
+import numpy
+
+import datfile
+import jbi
+import kinematics
+
+Result = collections.namedtuple("Result", (
+    'filename name frame names displacement rotation pulses outside '
+    'unreachable rewound job'))
+
+AXES = ("S", "L", "U", "R", "B", "T")
+REACH_TOLERANCE = 0.5  # mm the new pulses may miss the moved point by
+ANGLE_TOLERANCE = 0.05  # degrees they may miss the moved orientation by
+REWIND_TOLERANCE = 1.0  # degrees a joint may turn for an unmoved flange
+
+
+def parse_pose(text):
+    """ Return the (6,) array of an "x,y,z,tx,ty,tz" string """
+    values = [float(value or 0) for value in text.split(",")]
+    if len(values) != 6:
+        raise ValueError("{!r} is not x,y,z,tx,ty,tz".format(text))
+    return numpy.array(values)
+
+
+def read_poses(filename, kind):
+    """
+    Return a dict mapping each number n of the "//kind n" sections of a DAT
+    file (kind is TOOL for TOOL.DAT, UFRAME for UFRAME.DAT) to the (6,)
+    pose of its first line of six values
+    """
+    data = datfile.load(filename)
+    result = dict()
+    for name in data.names():
+        (title, _, number) = name.partition(" ")
+        if title != kind or not number.isdigit():
+            continue
+        for row in data.rows(name):
+            if len(row) == 6:
+                result[int(number)] = parse_pose(",".join(row))
+                break
+    if not result:
+        raise ValueError("{} has no //{} sections of six values".format(
+            filename, kind))
+    return result
+
+
+def pose_spec(spec, kind):
+    """
+    Return the (6,) pose a command-line spec names: "x,y,z,tx,ty,tz", or
+    "FILE:n" for entry n of a TOOL.DAT or UFRAME.DAT file
+    """
+    if "," in spec:
+        return parse_pose(spec)
+    (filename, _, number) = spec.rpartition(":")
+    poses = read_poses(filename, kind)
+    if int(number) not in poses:
+        raise ValueError("{} has no {} {}".format(filename, kind, number))
+    return poses[int(number)]
+
+
+def joint_limits(parameters):
+    """
+    Return the (lower, upper) pulse arrays of the software limits, SC006 -
+    SC011 and SC000 - SC005, from a kinematics.read_parameters() dict
+    """
+    values = numpy.asarray(parameters["SC"][0:12], dtype=numpy.int64)
+    return (values[6:12], values[0:6])
+
+
+def frame_change(old_frame, new_frame):
+    """
+    Return the (4, 4) transform that moves points fixed to a user frame at
+    the old pose along with it to the new pose
+    """
+    (old, new) = kinematics.poses_to_transforms([old_frame, new_frame])
+    return numpy.dot(new, numpy.linalg.inv(old))
+
+
+def format_pulses(pulses):
+    """ Return the position fields of a row of pulse counts """
+    return [str(int(value)) for value in pulses]
+
+
+def format_pose(pose):
+    """ Return the position fields of a row of x,y,z,tx,ty,tz """
+    return (["{:.3f}".format(value) for value in pose[0:3]] +
+            ["{:.2f}".format(value) for value in pose[3:6]])
+
+
+class Retargeter(object):
+    """
+    How to move jobs: a frame change transform (see frame_change), the
+    tool data the jobs were taught with (a dict of tool number to pose) and
+    the tool to move them to, as a (number, pose) pair. Pulse positions and
+    the limit check need the arm's kinematics.Geometry and joint limits
+    """
+    geometry = None
+    change = None  # (4, 4), or None to leave the frame as it is
+    tools = None  # tool number -> (6,) pose of the tool the job was taught with
+    new_tool = None  # (number, (6,) pose), or None to keep each job's tool
+    limits = None  # (lower, upper) pulses, or None not to check
+
+    def __init__(self, geometry=None, change=None, tools=None, new_tool=None,
+                 limits=None):
+        self.geometry = geometry
+        self.change = change
+        self.tools = tools or dict()
+        self.new_tool = new_tool
+        self.limits = limits
+
+    def tool_transform(self, number):
+        """ Return the (4, 4) flange to tool center point transform """
+        pose = self.tools.get(number, numpy.zeros(6))
+        return kinematics.poses_to_transforms(pose)[0]
+
+    def retarget(self, job, filename=None):
+        """
+        Move the C positions of a jbi.Job in place, return a Result. Raise
+        ValueError for jobs that can't be moved
+        """
+        names = job.position_names("C")
+        frame = job.frame
+        if job.header("USER") is not None:
+            raise ValueError("positions are in a user frame, redefine the "
+                             "frame instead")
+        if frame is None:
+            raise ValueError("no ///PULSE or ///RECTAN positions")
+        if not names:
+            raise ValueError("no C positions")
+        if frame == "PULSE" and self.geometry is None:
+            raise ValueError("pulse positions need the arm's PARAM.DAT")
+
+        old_number = int(job.header("TOOL") or 0)
+        (new_number, new_pose) = self.new_tool or (old_number, None)
+        old_tool = self.tool_transform(old_number)
+        new_tool = old_tool if new_pose is None else \
+            kinematics.poses_to_transforms(new_pose)[0]
+
+        values = numpy.array(job.position_values("C"))[:, 0:6]
+        if frame == "PULSE":
+            pulses = values.astype(numpy.int64)
+            flange = kinematics.forward_transforms(self.geometry, pulses)
+            points = numpy.matmul(flange, old_tool)
+        else:
+            pulses = None
+            points = kinematics.poses_to_transforms(values)
+        moved = points if self.change is None else \
+            numpy.matmul(self.change, points)
+        (displacement, rotation) = kinematics.pose_errors(
+            kinematics.transforms_to_poses(points),
+            kinematics.transforms_to_poses(moved))
+
+        new_pulses = None
+        if self.geometry is not None:
+            new_flange = numpy.matmul(moved, numpy.linalg.inv(new_tool))
+            reference = pulses
+            if reference is None:
+                # the arm configuration the rectangular positions were taught in
+                reference = kinematics.inverse_transforms(
+                    self.geometry, numpy.matmul(points,
+                                                numpy.linalg.inv(old_tool)))
+            new_pulses = kinematics.inverse_transforms(
+                self.geometry, new_flange, reference)
+            # the inverse clamps points out of reach, so check where they land
+            (missed, turned) = kinematics.pose_errors(
+                kinematics.transforms_to_poses(new_flange),
+                kinematics.forward(self.geometry, new_pulses))
+            unreachable = [name for name, distance, angle in
+                           zip(names, missed, turned)
+                           if distance > REACH_TOLERANCE or
+                           angle > ANGLE_TOLERANCE]
+        else:
+            unreachable = list()
+
+        rewound = list()
+        if pulses is not None:
+            # a flange that stays put should keep its joint angles too
+            (shift, tilt) = kinematics.pose_errors(
+                kinematics.transforms_to_poses(flange),
+                kinematics.transforms_to_poses(new_flange))
+            joints = numpy.degrees(abs(
+                self.geometry.pulses_to_radians(new_pulses) -
+                self.geometry.pulses_to_radians(pulses))).max(axis=1)
+            rewound = [name for name, distance, angle, joint in
+                       zip(names, shift, tilt, joints)
+                       if distance <= REACH_TOLERANCE and
+                       angle <= ANGLE_TOLERANCE and joint > REWIND_TOLERANCE]
+
+        rows = [format_pulses(row) for row in new_pulses] \
+            if frame == "PULSE" else \
+            [format_pose(row) for row in kinematics.transforms_to_poses(moved)]
+        for name, row in zip(names, rows):
+            # keep any fields after the six of the position, such as RCONF's
+            job.set_position(name, row + job.positions[name][6:])
+        if new_number != old_number:
+            job.set_header("TOOL", new_number)
+
+        outside = list()
+        if self.limits is not None and new_pulses is not None:
+            (lower, upper) = self.limits
+            for name, row in zip(names, new_pulses):
+                axes = [axis for axis, value, low, high in
+                        zip(AXES, row, lower, upper)
+                        if not low <= value <= high]
+                if axes:
+                    outside.append((name, axes))
+        pulse_change = None if pulses is None else \
+            abs(new_pulses - pulses).max(axis=1)
+        return Result(filename, job.name, frame, names, displacement, rotation,
+                      pulse_change, outside, unreachable, rewound, job)
+
+    def retarget_file(self, filename):
+        """ Return the Result of retargeting the named job file """
+        return self.retarget(jbi.read_job(filename), filename)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+A content-addressed, compressed store of controller file snapshots
+
+Every file is stored once, zlib compressed, under the SHA-1 of its content
+(objects/ab/cdef...). A snapshot is a small JSON manifest mapping filenames
+to content hashes, so files that didn't change since the last snapshot cost
+no extra disk.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+
+
+def atomic_write(path, data):
+    """ Write data to path via a temporary file, so readers never see part """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    (handle, temporary) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, "wb") as outputfh:
+        outputfh.write(data)
+    os.rename(temporary, path)
+
+
+class BlobStore(object):
+    """ Compressed file contents stored under their SHA-1 hex digest """
+    root = None
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        """ Return the path of the object with the given digest """
+        return os.path.join(self.root, digest[0:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, content):
+        """ Store content unless it is already present, return its digest """
+        digest = hashlib.sha1(content).hexdigest()
+        if digest not in self:
+            atomic_write(self.path(digest), zlib.compress(content, 9))
+        return digest
+
+    def get(self, digest):
+        """ Return the content with the given digest """
+        with open(self.path(digest), "rb") as inputfh:
+            return zlib.decompress(inputfh.read())
+
+
+class SnapshotStore(object):
+    """
+    Named snapshots of a set of files. Each manifest records the filename to
+    digest mapping, and the files that couldn't be fetched
+    """
+    root = None
+    blobs = None
+
+    def __init__(self, root):
+        self.root = root
+        self.blobs = BlobStore(os.path.join(root, "objects"))
+
+    def manifest_path(self, name):
+        """ Return the path of the named snapshot's manifest """
+        return os.path.join(self.root, "snapshots", name + ".json")
+
+    def names(self):
+        """ Return the names of the stored snapshots, oldest first """
+        directory = os.path.join(self.root, "snapshots")
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.splitext(filename)[0]
+                      for filename in os.listdir(directory)
+                      if filename.endswith(".json"))
+
+    def load(self, name):
+        """ Return the named snapshot's manifest dict """
+        if name == "latest":
+            names = self.names()
+            if not names:
+                raise IOError("No snapshots in {}".format(self.root))
+            name = names[-1]
+        with open(self.manifest_path(name)) as inputfh:
+            return json.load(inputfh)
+
+    def save(self, files, missing=(), name=None, skipped=None):
+        """
+        Store a snapshot of the given {filename: content} dict; missing lists
+        the files that didn't exist or weren't asked for, skipped maps those
+        that weren't asked for to the number of snapshots in a row they have
+        been skipped. Return the manifest
+        """
+        if not name:
+            name = base = time.strftime("%Y%m%d-%H%M%S")
+            suffix = 1
+            while os.path.exists(self.manifest_path(name)):
+                name = "{}-{}".format(base, suffix)
+                suffix += 1
+        manifest = {"name": name,
+                    "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "files": dict((filename, self.blobs.put(content))
+                                  for filename, content in files.items()),
+                    "missing": sorted(missing),
+                    "skipped": dict(skipped or {})}
+        atomic_write(self.manifest_path(name),
+                     json.dumps(manifest, indent=1, sort_keys=True))
+        return manifest
+
+    def contents(self, manifest):
+        """ Yield the (filename, content) pairs of a snapshot manifest """
+        for filename, digest in sorted(manifest["files"].items()):
+            yield (str(filename), self.blobs.get(digest))
+
+    def extract(self, name, directory):
+        """ Write the files of the named snapshot into directory """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filenames = list()
+        for filename, content in self.contents(self.load(name)):
+            filenames.append(os.path.basename(filename))
+            with open(os.path.join(directory, filenames[-1]), "wb") as outputfh:
+                outputfh.write(content)
+        return filenames
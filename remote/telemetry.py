@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Position and status telemetry sampling for ERC-series robots
+
+A Sampler keeps one ERC session open and interleaves RPOS, RPOSJ and RSTATS
+reads on a schedule. Each read produces a sample row holding the freshest
+value of every field. Rows go into a fixed-size RingBuffer, which can live in
+a shared memory file so other processes can read the latest samples without
+touching the serial link. Completed segments of the ring can be flushed to a
+compact columnar binary file.
+"""
+import mmap
+import struct
+import time
+
+import numpy
+
+import erc
+
+SAMPLE_DTYPE = numpy.dtype([
+    ('time', '<f8'),  # seconds since the epoch when the read completed
+    ('source', 'u1'),  # index into SOURCES of the read that made this row
+    ('rpos', '<f8', (6,)),  # x,y,z,tx,ty,tz
+    ('rposj', '<i4', (6,)),  # s,l,u,r,b,t pulses
+    ('rstats', '<u2')  # RSTATS bits, see erc.RSTATS_BITS
+])
+
+SOURCES = ('RPOS', 'RPOSJ', 'RSTATS')
+
+# shared ring header: magic, capacity, total number of rows ever written
+RING_HEADER = struct.Struct("<8sQQ")
+RING_MAGIC = "YTLMRING"
+
+# segment header: magic, number of rows, number of columns
+SEGMENT_HEADER = struct.Struct("<4sII")
+SEGMENT_MAGIC = "YTLM"
+COLUMN_HEADER = struct.Struct("<16s16sI")  # name, dtype, items per row
+
+
+def encode_rstats(rstats):
+    """
+    Return the given RSTATS result as a 16 bit integer, bit n set when
+    erc.RSTATS_BITS[n] is reported by erc.decode_rstats
+    """
+    result = 0
+    for name in erc.decode_rstats(rstats):
+        result |= 1 << erc.RSTATS_BITS.index(name)
+    return result
+
+
+def decode_flags(rstats):
+    """
+    Return a dict mapping each erc.RSTATS_BITS name to a boolean array, given
+    an array of encoded RSTATS values (e.g. the rstats column of samples)
+    """
+    rstats = numpy.asarray(rstats)
+    return dict((name, (rstats & (1 << index)) != 0)
+                for index, name in enumerate(erc.RSTATS_BITS))
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of sample rows. When given a path (e.g. under /dev/shm)
+    the rows are kept in a memory mapped file that other processes can
+    attach() to
+    """
+    capacity = None
+    rows = None
+    total = 0
+    _map = None
+    _header = None
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        if path is None:
+            self.rows = numpy.zeros(capacity, dtype=SAMPLE_DTYPE)
+            return
+
+        size = RING_HEADER.size + capacity * SAMPLE_DTYPE.itemsize
+        with open(path, "w+b") as ringfh:
+            ringfh.truncate(size)
+            self._map = mmap.mmap(ringfh.fileno(), size)
+        self._map[0:RING_HEADER.size] = RING_HEADER.pack(RING_MAGIC,
+                                                         capacity, 0)
+        self._header = numpy.frombuffer(self._map, dtype='<u8', count=3)
+        self.rows = numpy.frombuffer(self._map, dtype=SAMPLE_DTYPE,
+                                     count=capacity, offset=RING_HEADER.size)
+
+    @classmethod
+    def attach(cls, path):
+        """ Return a read-only view of a ring shared by another process """
+        ring = cls.__new__(cls)
+        with open(path, "rb") as ringfh:
+            ring._map = mmap.mmap(ringfh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, ring.capacity, _) = RING_HEADER.unpack(
+            ring._map[0:RING_HEADER.size])
+        if magic != RING_MAGIC:
+            raise ValueError("{} is not a telemetry ring buffer".format(path))
+        ring._header = numpy.frombuffer(ring._map, dtype='<u8', count=3)
+        ring.rows = numpy.frombuffer(ring._map, dtype=SAMPLE_DTYPE,
+                                     count=ring.capacity,
+                                     offset=RING_HEADER.size)
+        return ring
+
+    def written(self):
+        """ Return the number of rows ever appended to the ring """
+        if self._header is not None:
+            return int(self._header[2])
+        return self.total
+
+    def append(self, row):
+        """ Add a row, overwriting the oldest row once the ring is full """
+        total = self.written()
+        self.rows[total % self.capacity] = row
+        if self._header is not None:
+            # publish the row only after it has been completely written
+            self._map[16:24] = struct.pack("<Q", total + 1)
+        self.total = total + 1
+
+    def since(self, start):
+        """
+        Return a copy of the rows appended since the given written() count,
+        oldest first. Rows that have already been overwritten are skipped
+        """
+        end = self.written()
+        start = max(start, end - self.capacity)
+        indexes = numpy.arange(start, end) % self.capacity
+        result = self.rows[indexes].copy()
+        # a concurrent writer may have overwritten the oldest rows meanwhile
+        overwritten = self.written() - self.capacity - start
+        if overwritten > 0:
+            result = result[overwritten:]
+        return result
+
+    def latest(self, count):
+        """ Return a copy of the newest count rows, oldest first """
+        return self.since(self.written() - count)
+
+    def close(self):
+        """ Release the shared memory mapping, if any """
+        if self._map is not None:
+            self._header = None
+            self.rows = None
+            self._map.close()
+            self._map = None
+
+
+def write_segment(outputfh, rows):
+    """
+    Append the given sample rows to an open file as one columnar segment: a
+    header followed by the contiguous bytes of each column in turn
+    """
+    outputfh.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(rows),
+                                       len(rows.dtype.names)))
+    for name in rows.dtype.names:
+        column = numpy.ascontiguousarray(rows[name])
+        items = int(numpy.prod(column.shape[1:]))
+        outputfh.write(COLUMN_HEADER.pack(name, column.dtype.str, items))
+        outputfh.write(column.tobytes())
+
+
+def read_segments(path):
+    """ Yield each segment of a telemetry file as an array of sample rows """
+    with open(path, "rb") as inputfh:
+        while True:
+            header = inputfh.read(SEGMENT_HEADER.size)
+            if not header:
+                return
+            (magic, count, columns) = SEGMENT_HEADER.unpack(header)
+            if magic != SEGMENT_MAGIC:
+                raise ValueError("Bad telemetry segment in {}".format(path))
+            fields = list()
+            data = dict()
+            for _ in xrange(columns):
+                (name, dtype, items) = COLUMN_HEADER.unpack(
+                    inputfh.read(COLUMN_HEADER.size))
+                (name, dtype) = (name.rstrip("\0"), dtype.rstrip("\0"))
+                dtype = numpy.dtype(dtype)
+                shape = (items,) if items > 1 else ()
+                fields.append((name, dtype, shape) if shape else (name, dtype))
+                data[name] = numpy.frombuffer(
+                    inputfh.read(count * items * dtype.itemsize),
+                    dtype=dtype).reshape((count,) + shape)
+            rows = numpy.zeros(count, dtype=fields)
+            for name, column in data.items():
+                rows[name] = column
+            yield rows
+
+
+class Sampler(object):
+    """
+    Sample the robot's position and status over one persistent ERC session
+    """
+    robot = None
+    schedule = None
+    interval = 0.0
+    ring = None
+    output = None
+    segment = 1024
+    flushed = 0
+    current = None
+    samples = 0
+    last_time = None
+    # running interval statistics (Welford), so a long run stays small
+    intervals = 0
+    interval_mean = 0.0
+    interval_m2 = 0.0
+    max_interval = 0.0
+
+    def __init__(self, robot, ring, schedule=SOURCES, interval=0.0,
+                 output=None, segment=1024):
+        for command in schedule:
+            if command not in SOURCES:
+                raise ValueError("Can't sample {!r}, choose from {}".format(
+                    command, ", ".join(SOURCES)))
+        self.robot = robot
+        self.ring = ring
+        self.schedule = tuple(schedule)
+        self.interval = interval
+        self.output = output
+        self.segment = segment
+        self.flushed = ring.written()
+        self.current = numpy.zeros(1, dtype=SAMPLE_DTYPE)[0]
+
+    def sample(self, command):
+        """ Issue one read command, store the resulting row in the ring """
+        result = self.robot.execute_command(command)
+        now = time.time()
+        if not result:
+            erc.warn("No result for {}, sample dropped".format(command))
+            return None
+
+        if command == 'RPOS':
+            self.current['rpos'] = [float(value) for value in result[0:6]]
+        elif command == 'RPOSJ':
+            self.current['rposj'] = [int(value) for value in result[0:6]]
+        elif command == 'RSTATS':
+            self.current['rstats'] = encode_rstats(result)
+        self.current['time'] = now
+        self.current['source'] = SOURCES.index(command)
+
+        self.ring.append(self.current)
+        self.record_time(now)
+        if self.output and self.ring.written() - self.flushed >= self.segment:
+            self.flush()
+        return self.current
+
+    def record_time(self, now):
+        """ Update the interval statistics with the time of a new sample """
+        self.samples += 1
+        if self.last_time is not None:
+            interval = now - self.last_time
+            self.intervals += 1
+            delta = interval - self.interval_mean
+            self.interval_mean += delta / self.intervals
+            self.interval_m2 += delta * (interval - self.interval_mean)
+            self.max_interval = max(self.max_interval, interval)
+        self.last_time = now
+
+    def flush(self):
+        """ Write the rows that have not been flushed yet as a segment """
+        rows = self.ring.since(self.flushed)
+        self.flushed = self.ring.written()
+        if len(rows):
+            write_segment(self.output, rows)
+            self.output.flush()
+        return len(rows)
+
+    def run(self, count=None, duration=None):
+        """
+        Sample until count reads have been made or duration seconds have
+        passed (or forever if neither is given). Reads are paced on an
+        absolute schedule of one every self.interval seconds, so that a slow
+        read doesn't push every later read back
+        """
+        start = time.time()
+        made = 0
+        while count is None or made < count:
+            if duration is not None and time.time() - start >= duration:
+                break
+            due = start + made * self.interval
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.sample(self.schedule[made % len(self.schedule)])
+            made += 1
+        if self.output:
+            self.flush()
+        return made
+
+    def statistics(self):
+        """
+        Return a dict with the achieved sample rate (Hz) and the jitter, the
+        standard deviation of the interval between samples (seconds)
+        """
+        if not self.intervals or not self.interval_mean:
+            return {'samples': self.samples, 'rate': 0.0, 'jitter': 0.0}
+        return {'samples': self.samples,
+                'rate': 1.0 / self.interval_mean,
+                'jitter': (self.interval_m2 / self.intervals) ** 0.5,
+                'max_interval': self.max_interval}
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Tests of the erc link protocol against a scripted serial port
+
+Run with: python -m unittest test_erc
+"""
+import unittest
+
+import erc
+
+
+class ScriptedLink(object):
+    """
+    A stand-in for serial.Serial: each write is answered with the next
+    reply of the script ("" for no reply)
+    """
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.written = list()
+        self.incoming = ""
+
+    def write(self, data):
+        self.written.append(data)
+        if self.replies:
+            self.incoming += self.replies.pop(0)
+
+    def inWaiting(self):
+        return len(self.incoming)
+
+    def read(self, size=1):
+        (result, self.incoming) = (self.incoming[:size], self.incoming[size:])
+        return result
+
+
+def scripted_robot(replies):
+    """ Return an ERC on a ScriptedLink, with short timeouts """
+    robot = erc.ERC.__new__(erc.ERC)
+    robot.link = ScriptedLink(replies)
+    robot.handlers = dict()
+    robot.reply_timeout = 0.1
+    robot.response_timeout = 0.1
+    return robot
+
+
+class ReverseInterruptTest(unittest.TestCase):
+    """ RVI stops our message so the ERC can send its own """
+
+    def setUp(self):
+        erc.DEBUG = False
+
+    def test_rvi_mid_message(self):
+        error = erc.encode("90,000", "4010\r")[0]
+        robot = scripted_robot([
+            erc.ACK0,  # our ENQ
+            erc.RVI,  # the first block: the ERC has something to say
+            erc.ENQ,  # our EOT: the ERC opens its message
+            error,  # our ACK0
+            erc.EOT,  # our ACK1
+        ])
+        blocks = ["first block", "second block", "third block"]
+        robot.send_handshake()
+        self.assertFalse(robot.send_message_blocks(iter(blocks)))
+        self.assertEqual(robot.link.written,
+                         [erc.ENQ, "first block", erc.EOT, erc.ACK0,
+                          erc.ACK1])
+        self.assertFalse(robot.reverse_interrupt)
+        robot.receive_execution_response()
+        self.assertEqual(robot.last_error, "4010")
+        self.assertTrue(robot.pending_message is None)
+
+    def test_rvi_after_last_block(self):
+        done = erc.encode("90,000", "0000\r")[0]
+        robot = scripted_robot([erc.ACK0, erc.RVI, erc.ENQ, done, erc.EOT])
+        self.assertTrue(robot.send_blocks(["only block"]))
+        self.assertEqual(robot.link.written,
+                         [erc.ENQ, "only block", erc.EOT, erc.ACK0,
+                          erc.ACK1])
+        self.assertEqual(robot.pending_message.header, "90,000")
+
+    def test_rvi_truncates_upload(self):
+        error = erc.encode("90,000", "4010\r")[0]
+        robot = scripted_robot([erc.ACK0, erc.RVI, erc.ENQ, error, erc.EOT])
+        self.assertFalse(robot.send_blocks(["first block", "second block"]))
+        robot = scripted_robot([erc.ACK0, erc.RVI, erc.ENQ, error, erc.EOT])
+        self.assertRaises(erc.TransmissionFailed, robot.send_lines,
+                          "TEST.JBI", ["/JOB"] + ["x" * 60] * 20)
+        self.assertEqual(robot.pending_message.header, "90,000")
+
+    def test_rvi_to_handshake(self):
+        done = erc.encode("90,000", "0000\r")[0]
+        robot = scripted_robot([erc.RVI, erc.ENQ, done, erc.EOT, erc.ACK0])
+        robot.send_handshake()
+        self.assertEqual(robot.link.written,
+                         [erc.ENQ, erc.EOT, erc.ACK0, erc.ACK1, erc.ENQ])
+        self.assertEqual(robot.pending_message.header, "90,000")
+
+
+class TimeoutTest(unittest.TestCase):
+    """ A silent ERC ends the transaction with TransmissionFailed """
+
+    def setUp(self):
+        erc.DEBUG = False
+
+    def test_no_response(self):
+        robot = scripted_robot([])
+        self.assertRaises(erc.TransmissionFailed,
+                          robot.receive_execution_response)
+
+    def test_stall_mid_message(self):
+        first = erc.encode("90,001", "x" * 600 + "\r")[0]
+        robot = scripted_robot([first, ""])  # no second block
+        robot.link.incoming = erc.ENQ
+        self.assertRaises(erc.TransmissionFailed,
+                          robot.receive_execution_response)
+
+    def test_command_timeout(self):
+        self.assertEqual(erc.command_timeout("RSTATS\r", 60), 60)
+        self.assertEqual(erc.command_timeout("JWAIT 10\r", 60), 70)
+        self.assertEqual(erc.command_timeout("JWAIT -1\r", 60), -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Round trip tests of the kinematics against the arm of dat/PARAM.DAT
+
+Run with: python -m unittest test_kinematics
+"""
+import os
+import unittest
+
+import numpy
+
+import kinematics
+
+PARAMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'dat', 'PARAM.DAT')
+
+
+class StraightWristTest(unittest.TestCase):
+    """ With B at 0, R and T turn about one line and only their sum counts """
+
+    def setUp(self):
+        self.geometry = kinematics.Geometry.from_file(PARAMS)
+
+    def round_trip(self, pulses, reference):
+        """ Return the (position, angle) errors of forward, then inverse """
+        poses = kinematics.forward(self.geometry, pulses)
+        found = kinematics.inverse(self.geometry, poses, reference)
+        return (found, kinematics.pose_errors(
+            poses, kinematics.forward(self.geometry, found)))
+
+    def test_straight_wrist(self):
+        pulses = numpy.array([[1000, 2000, -3000, 4000, 0, 2000]])
+        for reference in (None, pulses):
+            (found, (position, angle)) = self.round_trip(pulses, reference)
+            self.assertLess(position.max(), 0.001)
+            self.assertLess(angle.max(), 0.001)
+            self.assertEqual(found[0, 4], 0)
+        # from the taught pulses, the same R and T come back
+        self.assertEqual(found.tolist(), pulses.tolist())
+
+    def test_random_poses(self):
+        random = numpy.random.RandomState(1)
+        pulses = (random.uniform(-0.3, 0.3, (1000, 6)) *
+                  self.geometry.resolution).astype(numpy.int64)
+        pulses[::2, 4] = 0
+        (_, (position, angle)) = self.round_trip(pulses, pulses)
+        self.assertLess(position.max(), 0.1)
+        self.assertLess(angle.max(), 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Change-driven watching of an ERC-series robot's status
+
+A Watcher keeps one ERC session open and reports only what changes: the
+RSTATS flags (servo power, the hold sources, running, alarm...), the alarm
+codes given by RALARM, and the job and line given by RJSEQ. RSTATS is read
+on every poll, the other two only when it gives a reason to: RALARM while
+the alarm or error flag is set or has just changed, RJSEQ while a job is
+running and every few polls otherwise. Polls come every fast seconds while
+the robot is running or in alarm, and back off towards every slow seconds
+while nothing changes.
+"""
+import time
+
+import erc
+
+# RSTATS flags that make the watcher poll quickly, and read RALARM
+BUSY_FLAGS = ('running', 'alarm', 'error')
+ALARM_FLAGS = ('alarm', 'error')
+
+
+def alarm_codes(ralarm):
+    """
+    Return the alarm and error codes in a RALARM result as a sorted tuple,
+    leaving out the zero fields of unused slots
+    """
+    return tuple(sorted(set(field.strip() for field in ralarm
+                            if field.strip().strip("0"))))
+
+
+def job_position(rjseq):
+    """ Return (job, line, step) from a RJSEQ result """
+    fields = [field.strip() for field in rjseq] + ["", "", ""]
+    return (fields[0], fields[1], fields[2])
+
+
+class Watcher(object):
+    """
+    Poll a robot and pass an event dict to callback for each change. Every
+    event has a "time" and an "event": "flag" (with "flag" and "on"),
+    "alarm" (with "code", "raised" and the error "text") or "job" (with
+    "job", "line" and "step"). The first poll reports the starting state
+    as changes
+    """
+    robot = None
+    callback = None
+    fast = 0.1  # seconds between polls while busy, or just after a change
+    slow = 2.0  # the longest time between polls while idle
+    refresh = 10  # idle polls between RJSEQ reads
+    interval = 0.1
+    flags = None  # the RSTATS flags set at the last poll
+    alarms = None
+    job = None
+    polls = 0
+    idle_polls = 0
+    transactions = 0
+    events = 0
+
+    def __init__(self, robot, callback, fast=0.1, slow=2.0, refresh=10):
+        self.robot = robot
+        self.callback = callback
+        self.fast = fast
+        self.slow = slow
+        self.refresh = refresh
+        self.interval = fast
+
+    def read(self, command):
+        """ Issue one status read, counting the transaction """
+        self.transactions += 1
+        result = self.robot.execute_command(command)
+        if not result:
+            erc.warn("No result for {}".format(command))
+        return result
+
+    def emit(self, now, event, **fields):
+        """ Pass an event to the callback """
+        fields.update(time=now, event=event)
+        self.events += 1
+        self.callback(fields)
+
+    def poll(self):
+        """
+        Read RSTATS, and RALARM and RJSEQ if there is reason to, emit the
+        changes. Return True if anything changed
+        """
+        before = self.events
+        rstats = self.read("RSTATS")
+        if not rstats:
+            return False
+        now = time.time()
+        flags = set(erc.decode_rstats(rstats))
+        first = self.flags is None
+        previous = set() if first else self.flags
+        for flag in erc.RSTATS_BITS:
+            if (flag in flags) != (flag in previous):
+                self.emit(now, "flag", flag=flag, on=flag in flags)
+        self.flags = flags
+
+        alarm_changed = first or any(
+            (flag in flags) != (flag in previous) for flag in ALARM_FLAGS)
+        if alarm_changed or flags.intersection(ALARM_FLAGS):
+            if flags.intersection(ALARM_FLAGS):
+                ralarm = self.read("RALARM")
+                alarms = alarm_codes(ralarm) if ralarm else self.alarms
+            else:
+                alarms = ()  # cleared, no need to ask
+            self.update_alarms(now, alarms or ())
+
+        running = 'running' in flags or 'running' in previous
+        if first or running or self.idle_polls >= self.refresh:
+            rjseq = self.read("RJSEQ")
+            if rjseq:
+                self.update_job(now, job_position(rjseq))
+            self.idle_polls = 0
+        else:
+            self.idle_polls += 1
+
+        self.polls += 1
+        changed = self.events != before
+        if changed or flags.intersection(BUSY_FLAGS):
+            self.interval = self.fast
+        else:
+            self.interval = min(self.interval * 2, self.slow)
+        return changed
+
+    def update_alarms(self, now, alarms):
+        """ Emit the alarm codes raised and cleared since the last poll """
+        previous = self.alarms or ()
+        for code in alarms:
+            if code not in previous:
+                self.emit(now, "alarm", code=code, raised=True,
+                          text=erc.ERRORS.get(code))
+        for code in previous:
+            if code not in alarms:
+                self.emit(now, "alarm", code=code, raised=False,
+                          text=erc.ERRORS.get(code))
+        self.alarms = alarms
+
+    def update_job(self, now, job):
+        """ Emit a job event if the job, line or step has changed """
+        if job != self.job:
+            self.emit(now, "job", job=job[0], line=job[1], step=job[2])
+        self.job = job
+
+    def run(self, count=None, duration=None):
+        """
+        Poll until count changes have been reported or duration seconds
+        have passed, or forever if neither is given
+        """
+        start = time.time()
+        while count is None or self.events < count:
+            if duration is not None and time.time() - start >= duration:
+                break
+            started = time.time()
+            self.poll()
+            delay = started + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return self.events
+
+    def statistics(self):
+        """ Return a dict of the polls, transactions and events so far """
+        return {'polls': self.polls, 'transactions': self.transactions,
+                'events': self.events,
+                'transactions_per_event': (
+                    float(self.transactions) / self.events
+                    if self.events else None)}
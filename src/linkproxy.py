@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""
+linkproxy: a serial link impairment proxy, for stress-testing the ERC
+protocol (remote/erc.py) and the FC1 disk protocol (disk/motodisk.py)
+
+Like mitm.py it relays bytes between two ports, but each direction is also
+held to the line rate of a real link (start, 8 data, parity and stop bits
+per byte), delayed by a latency with jitter, and damaged at set rates: bits
+flipped, bytes dropped, whole frames sent twice and ACKs held back. Either
+side can be a serial port or a new pty, so both ends can be programs on one
+host. A seed makes a run reproducible; the statistics printed at exit (or
+on SIGUSR1) show what was done to the link and what it did to throughput
+and retries.
+"""
+import argparse
+import collections
+import os
+import random
+import select
+import signal
+import struct
+import sys
+import time
+import tty
+
+import serial
+
+# frames are recognised with the protocol modules of both tools
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'remote'))
+sys.path.append(os.path.join(HERE, '..', 'disk'))
+import erc
+import packets
+
+BITS_PER_BYTE = 11  # start bit, 8 data bits, even parity, stop bit
+MAX_FRAME = 1024  # bytes to look for the end of a frame in before giving up
+
+# the factory line rate of each protocol: the ERC's link and the FC1 drive's
+BAUDRATES = {"erc": 9600, "disk": 4800, "raw": 9600}
+
+
+def log(message, *args):
+    """ Print a message on stderr """
+    sys.stderr.write((message.format(*args) if args else message) + "\n")
+
+
+def printable(data):
+    """ Return data with control characters as \\xNN, as mitm.py does """
+    return "".join(char if 32 <= ord(char) <= 126 else
+                   "\\x" + char.encode('hex') for char in data)
+
+
+class Framer(object):
+    """
+    Splits a byte stream into the frames of a protocol: "erc" (control
+    sequences, and SOH/STX blocks up to ETX/ETB and the checksum), "disk"
+    (STX, a 2 byte length, payload and checksum) or "raw" (whatever arrived
+    together)
+    """
+    protocol = "erc"
+    buffer = ""
+
+    def __init__(self, protocol="erc"):
+        self.protocol = protocol
+        self.buffer = ""
+
+    def feed(self, data):
+        """ Add received bytes, return the complete frames """
+        if self.protocol == "raw":
+            return [data]
+        self.buffer += data
+        frames = list()
+        while self.buffer:
+            length = self.frame_length(self.buffer)
+            if length is None and len(self.buffer) >= MAX_FRAME:
+                length = len(self.buffer)  # garbage, not a frame
+            if length is None:
+                break
+            frames.append(self.buffer[0:length])
+            self.buffer = self.buffer[length:]
+        return frames
+
+    def flush(self):
+        """ Return the bytes of an unfinished frame as a frame of their own """
+        frame, self.buffer = self.buffer, ""
+        return [frame] if frame else []
+
+    def frame_length(self, data):
+        """ Return the length of the frame data starts with, or None """
+        if self.protocol == "disk":
+            if data[0] != "\x02":
+                return 1
+            if len(data) < 3:
+                return None
+            length = struct.unpack("<H", data[1:3])[0] + 5
+            return length if len(data) >= length else None
+        if data[0] == erc.DLE:
+            return 2 if len(data) >= 2 else None
+        if data[0] not in (erc.SOH, erc.STX):
+            return 1
+        if data[1:2] == erc.ENQ:
+            return 2  # TTD
+        ends = [data.find(stop, 1) for stop in (erc.ETX, erc.ETB)]
+        ends = [end for end in ends if end >= 0]
+        if not ends or len(data) < min(ends) + 3:
+            return None
+        return min(ends) + 3
+
+    def is_ack(self, frame):
+        """ Return True if a frame is a positive acknowledgement """
+        if self.protocol == "erc":
+            return frame in (erc.ACK0, erc.ACK1)
+        if self.protocol == "disk":
+            try:
+                return packets.decode(frame)[0] == "ACK"
+            except (packets.InvalidPacketHeader, packets.NeedMoreInput,
+                    ValueError, struct.error):
+                return False
+        return False
+
+
+class Endpoint(object):
+    """ One side of the proxy: a serial port, or the master side of a pty """
+    name = None
+    port = None  # a serial.Serial, or None for a pty
+    fd = None
+    slave = None  # the pty's slave fd, kept open so the master never EIOs
+
+    def __init__(self, spec, baudrate):
+        if spec == "pty" or spec.startswith("pty:"):
+            (self.fd, self.slave) = os.openpty()
+            tty.setraw(self.slave)
+            self.name = os.ttyname(self.slave)
+            link = spec[4:]
+            if link:
+                if os.path.lexists(link):
+                    os.unlink(link)
+                os.symlink(self.name, link)
+                self.name = link
+        else:
+            self.port = serial.Serial(port=spec, baudrate=baudrate,
+                                      parity=serial.PARITY_EVEN, timeout=0)
+            self.fd = self.port.fileno()
+            self.name = spec
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """ Return the bytes waiting to be read """
+        if self.port is not None:
+            return self.port.read(max(self.port.in_waiting, 1))
+        return os.read(self.fd, 4096)
+
+    def write(self, data):
+        if self.port is not None:
+            self.port.write(data)
+        else:
+            os.write(self.fd, data)
+
+
+class Impairments(object):
+    """ What to do to the link, the same in both directions """
+    baudrate = 4800
+    latency = 0.0  # seconds added to every frame
+    jitter = 0.0  # up to this many more seconds, at random, per frame
+    flip_rate = 0.0  # chance of a bit being flipped, per byte
+    drop_rate = 0.0  # chance of a byte being lost
+    duplicate_rate = 0.0  # chance of a frame being delivered twice
+    ack_delay_rate = 0.0  # chance of an acknowledgement being held back
+    ack_delay = 0.0  # seconds an acknowledgement is held back for
+
+    def byte_time(self):
+        """ The seconds a byte takes on the line """
+        return BITS_PER_BYTE / float(self.baudrate) if self.baudrate else 0.0
+
+
+class Direction(object):
+    """
+    Frames travelling from one endpoint to the other: each is damaged, then
+    given a time at which each of its bytes goes out
+    """
+    STATS = ('frames', 'bytes_in', 'bytes_out', 'repeats', 'flips', 'drops',
+             'duplicates', 'delayed_acks')
+
+    name = None
+    source = None
+    sink = None
+    framer = None
+    impairments = None
+    rng = None
+    logfh = None
+    stats = None
+    queue = None  # (time due, byte) pairs, in time order
+    line_free = 0.0  # when the line has sent everything queued
+    last_frame = None
+    last_received = 0.0
+    first_received = None
+    last_sent = None
+    total_delay = 0.0  # the sum of each byte's time in the proxy
+
+    def __init__(self, name, source, sink, framer, impairments, rng,
+                 logfh=None):
+        self.name = name
+        self.source = source
+        self.sink = sink
+        self.framer = framer
+        self.impairments = impairments
+        self.rng = rng
+        self.logfh = logfh
+        self.queue = collections.deque()
+        self.stats = collections.Counter()
+
+    def receive(self, now):
+        """ Read from the source and queue what arrived """
+        data = self.source.read()
+        if not data:
+            return
+        self.stats['bytes_in'] += len(data)
+        self.first_received = self.first_received or now
+        self.last_received = now
+        for frame in self.framer.feed(data):
+            self.forward(frame, now)
+
+    def idle(self, now):
+        """ Pass on an unfinished frame once its sender has gone quiet """
+        if self.framer.buffer and now - self.last_received > max(
+                0.1, 20 * self.impairments.byte_time()):
+            for frame in self.framer.flush():
+                self.forward(frame, now)
+
+    def forward(self, frame, now):
+        """ Damage a frame as configured and queue it for sending """
+        impairments = self.impairments
+        notes = list()
+        self.stats['frames'] += 1
+        is_ack = self.framer.is_ack(frame)
+        if frame == self.last_frame and len(frame) > 2 and not is_ack:
+            self.stats['repeats'] += 1  # the sender retrying
+        self.last_frame = frame
+        due = now + impairments.latency + self.rng.uniform(
+            0, impairments.jitter)
+        if is_ack and self.rng.random() < impairments.ack_delay_rate:
+            due += impairments.ack_delay
+            self.stats['delayed_acks'] += 1
+            notes.append("delayed")
+        copies = 1
+        if self.rng.random() < impairments.duplicate_rate:
+            copies = 2
+            self.stats['duplicates'] += 1
+            notes.append("duplicated")
+        damaged = list()
+        for char in frame:
+            if self.rng.random() < impairments.drop_rate:
+                self.stats['drops'] += 1
+                notes.append("dropped byte")
+                continue
+            if self.rng.random() < impairments.flip_rate:
+                char = chr(ord(char) ^ (1 << self.rng.randrange(8)))
+                self.stats['flips'] += 1
+                notes.append("flipped bit")
+            damaged.append(char)
+        if self.logfh:
+            self.logfh.write("{:.3f} {}: {}{}\n".format(
+                now, self.name, printable(frame),
+                " [{}]".format(", ".join(notes)) if notes else ""))
+            self.logfh.flush()
+
+        byte_time = impairments.byte_time()
+        for _ in range(copies):
+            for char in damaged:
+                # bytes leave no sooner than the line can carry them
+                self.line_free = max(self.line_free, due) + byte_time
+                self.queue.append((self.line_free, char))
+                self.total_delay += self.line_free - now
+
+    def next_due(self):
+        """ Return when the next queued byte is due, or None """
+        return self.queue[0][0] if self.queue else None
+
+    def send(self, now):
+        """ Write the queued bytes that are due """
+        data = list()
+        while self.queue and self.queue[0][0] <= now:
+            data.append(self.queue.popleft()[1])
+        if data:
+            self.sink.write("".join(data))
+            self.stats['bytes_out'] += len(data)
+            self.last_sent = now
+
+    def __str__(self):
+        fields = ", ".join("{} {}".format(self.stats[key],
+                                          key.replace("_", " "))
+                           for key in self.STATS)
+        text = "{}: {}".format(self.name, fields)
+        if self.stats['bytes_out'] and self.last_sent > self.first_received:
+            rate = self.stats['bytes_out'] / (self.last_sent -
+                                              self.first_received)
+            line = self.impairments.baudrate / float(BITS_PER_BYTE)
+            useful = self.stats['bytes_in'] * (
+                1 - self.stats['repeats'] / float(self.stats['frames']))
+            text += (", {:.0f} bytes/s ({:.0%} of the line), {:.0%} of "
+                     "frames new, {:.1f}ms mean delay").format(
+                         rate, rate / line if line else 1,
+                         useful / self.stats['bytes_in'],
+                         1000 * self.total_delay /
+                         (self.stats['bytes_out'] or 1))
+        return text
+
+
+def proxy(directions):
+    """ Relay between the endpoints until interrupted """
+    sources = dict((direction.source.fileno(), direction)
+                   for direction in directions)
+    while True:
+        now = time.time()
+        dues = [due for due in (direction.next_due()
+                                for direction in directions) if due]
+        timeout = max(0, min(dues) - now) if dues else 0.1
+        try:
+            readable, _, _ = select.select(list(sources), [], [],
+                                           min(timeout, 0.1))
+        except select.error as error:
+            if error.args[0] == 4:  # EINTR: a signal, such as SIGUSR1
+                continue
+            raise
+        now = time.time()
+        for fd in readable:
+            sources[fd].receive(now)
+        for direction in directions:
+            direction.idle(now)
+            direction.send(now)
+
+
+def main():
+    """
+    primary handler for command-line execution. return an exit status integer
+    or a bool type (where True indicates successful exection)
+    """
+    argp = argparse.ArgumentParser(description=(
+        "Relay a serial link between two ports or ptys while limiting it to "
+        "a baud rate and adding latency, jitter and errors"))
+    argp.add_argument('robot', help=(
+        'the robot side: a serial port, "pty", or "pty:NAME" for a pty '
+        'with a symlink called NAME'))
+    argp.add_argument('host', help=(
+        'the host side, where erc.py or motodisk.py connects: a serial '
+        'port, "pty" or "pty:NAME"'))
+    argp.add_argument('-b', '--baud', type=int, default=None, help=(
+        "the line rate to hold each direction to, and of serial ports. 0 "
+        "means no limit. The default is the protocol's: 9600 for erc and "
+        "raw, 4800 for disk"))
+    argp.add_argument('-P', '--protocol', choices=('erc', 'disk', 'raw'),
+                      default='erc', help=(
+                          "how to find frames for --duplicate and "
+                          "--ack-delay. The default is erc"))
+    argp.add_argument('--latency', type=float, default=0.0, metavar="MS",
+                      help="milliseconds added to every frame")
+    argp.add_argument('--jitter', type=float, default=0.0, metavar="MS",
+                      help="up to this many more milliseconds per frame")
+    argp.add_argument('--flip', type=float, default=0.0, metavar="RATE",
+                      help="the chance of a bit flip in each byte")
+    argp.add_argument('--drop', type=float, default=0.0, metavar="RATE",
+                      help="the chance of each byte being lost")
+    argp.add_argument('--duplicate', type=float, default=0.0,
+                      metavar="RATE", help=(
+                          "the chance of each frame being sent twice"))
+    argp.add_argument('--ack-delay', type=float, default=0.0, metavar="MS",
+                      help="how long to hold back delayed acknowledgements")
+    argp.add_argument('--ack-delay-rate', type=float, default=1.0,
+                      metavar="RATE", help=(
+                          "the chance of an acknowledgement being delayed "
+                          "when --ack-delay is given. The default is 1"))
+    argp.add_argument('-s', '--seed', type=int, default=None, help=(
+        "seed the random impairments, to repeat a run exactly"))
+    argp.add_argument('-l', '--log', metavar="FILE", help=(
+        "write each frame, and what was done to it, to this file"))
+    args = argp.parse_args()
+    baudrate = BAUDRATES[args.protocol] if args.baud is None else args.baud
+
+    impairments = Impairments()
+    impairments.baudrate = baudrate
+    impairments.latency = args.latency / 1000.0
+    impairments.jitter = args.jitter / 1000.0
+    impairments.flip_rate = args.flip
+    impairments.drop_rate = args.drop
+    impairments.duplicate_rate = args.duplicate
+    impairments.ack_delay = args.ack_delay / 1000.0
+    impairments.ack_delay_rate = args.ack_delay_rate if args.ack_delay else 0
+
+    robot = Endpoint(args.robot, baudrate or BAUDRATES[args.protocol])
+    host = Endpoint(args.host, baudrate or BAUDRATES[args.protocol])
+    log("relaying {} (robot) <-> {} (host), seed {}", robot.name, host.name,
+        args.seed)
+    logfh = open(args.log, "a") if args.log else None
+    # each direction draws from its own generator, so the damage done to
+    # one doesn't depend on how the other's traffic interleaves with it
+    directions = [
+        Direction(name, source, sink, Framer(args.protocol), impairments,
+                  random.Random(None if args.seed is None else
+                                args.seed * 2 + index), logfh)
+        for index, (name, source, sink) in enumerate((
+            ("robot->host", robot, host), ("host->robot", host, robot)))]
+
+    def print_stats(*_):
+        for direction in directions:
+            log(str(direction))
+
+    signal.signal(signal.SIGUSR1, print_stats)
+    try:
+        proxy(directions)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print_stats()
+    return True
+
+
+if __name__ == '__main__':
+    RESULT = main()
+    sys.exit(int(not RESULT if isinstance(RESULT, bool) else RESULT))